@@ -0,0 +1,78 @@
+"""
+generates the synthetic media that benchmarks/run.py processes, with ffmpeg's lavfi sources so it's the same on
+every machine.
+usage (from the repo root): python benchmarks/corpus.py [--force]
+files that already exist are kept unless --force is passed. run.py generates it automatically if it's missing.
+"""
+import argparse
+import os
+import subprocess
+import sys
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "corpus")
+
+SIZES = {"small": (320, 240), "large": (1280, 720)}
+
+# strip anything that changes between ffmpeg runs/versions, so the files only differ if the encoders do
+BITEXACT = ["-fflags", "+bitexact", "-flags:v", "+bitexact", "-flags:a", "+bitexact", "-map_metadata", "-1"]
+
+
+def testsrc(w: int, h: int, duration: float, rate: int) -> str:
+    return f"testsrc2=s={w}x{h}:r={rate}:d={duration}"
+
+
+def palette(graph: str, transparent: bool = False) -> str:
+    """
+    gif needs a palette, make one from the video itself so colors don't depend on the default
+    """
+    if transparent:
+        return f"{graph},split[a][b];[a]palettegen=reserve_transparent=1[p];[b][p]paletteuse=alpha_threshold=128"
+    return f"{graph},split[a][b];[a]palettegen[p];[b][p]paletteuse"
+
+
+def specs() -> dict[str, list[str]]:
+    """
+    :return: filename -> ffmpeg args that make it
+    """
+    out = {}
+    for size, (w, h) in SIZES.items():
+        out[f"image-{size}.png"] = ["-f", "lavfi", "-i", testsrc(w, h, 1, 1), "-frames:v", "1"]
+        out[f"gif-{size}.gif"] = ["-filter_complex", palette(testsrc(w, h, 3, 15))]
+        # a checkerboard of transparent holes that moves every frame
+        out[f"gif-transparent-{size}.gif"] = [
+            "-filter_complex",
+            palette(f"{testsrc(w, h, 3, 15)},format=rgba,"
+                    f"geq=r='r(X,Y)':g='g(X,Y)':b='b(X,Y)':a='if(lt(mod(X+Y+N*4,64),32),255,0)'", True)
+        ]
+        out[f"apng-{size}.png"] = ["-f", "lavfi", "-i", f"{testsrc(w, h, 2, 10)},format=rgba", "-plays", "0",
+                                   "-f", "apng"]
+        for length, duration in [("short", 3), ("long", 60)]:
+            out[f"video-{length}-{size}.mp4"] = [
+                "-f", "lavfi", "-i", testsrc(w, h, duration, 30),
+                "-f", "lavfi", "-i", f"sine=frequency=440:sample_rate=48000:d={duration}",
+                "-c:v", "libx264", "-preset", "veryfast", "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest"
+            ]
+    out["audio.m4a"] = ["-f", "lavfi", "-i", "sine=frequency=440:sample_rate=48000:d=10", "-c:a", "aac"]
+    return out
+
+
+def generate(force: bool = False) -> list[str]:
+    """
+    :return: paths of every file in the corpus
+    """
+    os.makedirs(CORPUS_DIR, exist_ok=True)
+    files = []
+    for name, args in specs().items():
+        path = os.path.join(CORPUS_DIR, name)
+        if force or not os.path.isfile(path):
+            print(f"generating {name}", file=sys.stderr)
+            subprocess.run(["ffmpeg", "-hide_banner", "-loglevel", "error", "-y", *args, *BITEXACT, path],
+                           check=True)
+        files.append(path)
+    return files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="generate the benchmark corpus")
+    parser.add_argument("--force", action="store_true", help="regenerate files that already exist")
+    generate(parser.parse_args().force)
@@ -0,0 +1,60 @@
+"""
+checks processing.mediatype.mediatype() against the original classifier (mediatype_legacy()) on a corpus of files,
+and times both.
+usage (from the repo root): python benchmarks/mediatype.py [files or directories...]
+defaults to the media bundled with the repo. pass long videos to see the difference, the legacy classifier reads
+every packet of them.
+"""
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.join(os.getcwd(), "src"))
+
+from processing.mediatype import mediatype, mediatype_legacy, InvalidMediaType  # noqa: E402
+
+DEFAULT_CORPUS = ["rendering", "media/external"]
+
+
+def corpus(paths: list[str]) -> list[str]:
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files += [os.path.join(root, name) for name in sorted(names)]
+        else:
+            files.append(path)
+    return files
+
+
+async def classify(func, file) -> tuple[str, float]:
+    start = time.perf_counter()
+    try:
+        result = str(await func(file))
+    except InvalidMediaType:
+        result = "invalid"
+    return result, time.perf_counter() - start
+
+
+async def main():
+    files = corpus(sys.argv[1:] or DEFAULT_CORPUS)
+    mismatches = 0
+    new_total = legacy_total = 0
+    print(f"{'file':<60} {'new':>8} {'legacy':>8} {'new ms':>8} {'old ms':>8}")
+    for file in files:
+        new, new_time = await classify(mediatype, file)
+        legacy, legacy_time = await classify(mediatype_legacy, file)
+        new_total += new_time
+        legacy_total += legacy_time
+        flag = "" if new == legacy else "  MISMATCH"
+        mismatches += new != legacy
+        print(f"{file[-60:]:<60} {new:>8} {legacy:>8} {new_time * 1000:>8.1f} {legacy_time * 1000:>8.1f}{flag}")
+    print(f"\n{len(files)} files, {mismatches} mismatches. "
+          f"new: {new_total * 1000:.0f}ms total, legacy: {legacy_total * 1000:.0f}ms total")
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
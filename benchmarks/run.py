@@ -0,0 +1,276 @@
+"""
+benchmarks processing functions on the synthetic corpus (see benchmarks/corpus.py) and compares them to a saved
+baseline, so changes to processing.ffmpeg/processing.vips can be checked for speedups and regressions.
+every function is called directly, without the bot, the queue or ensuresize, inside a TempFileSession like a command.
+usage (from the repo root): python benchmarks/run.py [--save] [--baseline FILE] [--repeat N] [--threshold 0.15]
+    [--only CASE...]
+exits with 1 if anything regressed past the threshold. baselines are only comparable on the same machine.
+"""
+import argparse
+import asyncio
+import dataclasses
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.join(os.getcwd(), "src"))
+
+import config  # noqa: E402
+import corpus  # noqa: E402
+import processing.common  # noqa: E402
+import processing.ffmpeg.caption  # noqa: E402
+import processing.ffmpeg.conversion  # noqa: E402
+import processing.ffmpeg.ensuresize  # noqa: E402
+import processing.ffmpeg.other  # noqa: E402
+import processing.vips.caption  # noqa: E402
+import processing.vips.vipsutils  # noqa: E402
+from processing.ffmpeg.pipeline import materialize  # noqa: E402
+from processing.mediatype import VIDEO, GIF, IMAGE, AUDIO  # noqa: E402
+from processing.run_command import Usage, job_usage  # noqa: E402
+from utils import tempfiles  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+# differences smaller than this are noise no matter the threshold, in seconds
+MIN_DELTA = 0.05
+
+
+async def shrink(media):
+    """
+    assurefilesize() with the upload limit at half the input's size, so it always has to compress
+    """
+    limit = config.file_upload_limit
+    config.file_upload_limit = os.path.getsize(media) // 2
+    try:
+        return await processing.ffmpeg.ensuresize.assurefilesize(media)
+    finally:
+        config.file_upload_limit = limit
+
+
+async def with_gif_engine(engine: str, func, *args):
+    """
+    runs func with config.gif_engine set to engine, to compare gif encoders on the same cases
+    """
+    old = processing.ffmpeg.conversion.gif_engine
+    processing.ffmpeg.conversion.gif_engine = engine
+    try:
+        return await func(*args)
+    finally:
+        processing.ffmpeg.conversion.gif_engine = old
+
+
+async def emoji(media):
+    """
+    the downsizing add_emoji does
+    """
+    return await processing.ffmpeg.ensuresize.intelligentdownsize(
+        await processing.ffmpeg.conversion.allreencode(media), media, config.emoji_upload_limit)
+
+
+async def final_stage(media, predicted: bool):
+    """
+    the end of a command: a lossless output (from invert) encoded to fit in half the input's size, either with
+    finalize() or the old way of allreencode() then assurefilesize()
+    """
+    output = await processing.ffmpeg.other.invert(media)
+    limit = config.file_upload_limit
+    config.file_upload_limit = os.path.getsize(media) // 2
+    try:
+        if predicted:
+            return await processing.ffmpeg.ensuresize.finalize(output)
+        return await processing.ffmpeg.ensuresize.assurefilesize(
+            await processing.ffmpeg.conversion.allreencode(output), output)
+    finally:
+        config.file_upload_limit = limit
+
+
+@dataclasses.dataclass
+class Case:
+    name: str
+    func: callable
+    # media types it accepts, same as the command's
+    accepts: list
+    args: tuple = ()
+
+
+CASES = [
+    Case("caption", processing.vips.vipsutils.generic_caption_stack, [VIDEO, GIF, IMAGE],
+         (processing.vips.caption.mediaforge_caption, ["benchmark caption"])),
+    Case("motivate", processing.ffmpeg.caption.motivate, [VIDEO, GIF, IMAGE], (["top text", "bottom text"],)),
+    Case("speed", processing.ffmpeg.other.speed, [VIDEO, GIF, AUDIO], (2,)),
+    Case("reverse", processing.ffmpeg.other.reverse, [VIDEO, GIF]),
+    Case("invert", processing.ffmpeg.other.invert, [VIDEO, GIF, IMAGE]),
+    Case("jpeg", processing.ffmpeg.other.handle_jpeg, [VIDEO, GIF, IMAGE], (1, 10, 10)),
+    Case("videotogif", with_gif_engine, [VIDEO], ("ffmpeg", processing.ffmpeg.conversion.videotogif)),
+    Case("videotogif-vips", with_gif_engine, [VIDEO], ("vips", processing.ffmpeg.conversion.videotogif)),
+    Case("allreencode", processing.ffmpeg.conversion.allreencode, [VIDEO, GIF, IMAGE, AUDIO]),
+    Case("assurefilesize", shrink, [VIDEO, GIF, IMAGE]),
+    Case("assurefilesize-vips", with_gif_engine, [GIF], ("vips", shrink)),
+    Case("emoji", emoji, [GIF, IMAGE]),
+    Case("final-separate", final_stage, [VIDEO, GIF, IMAGE], (False,)),
+    Case("final-predicted", final_stage, [VIDEO, GIF, IMAGE], (True,)),
+]
+
+
+def dir_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(root, file))
+            except OSError:
+                pass
+    return size
+
+
+async def measure(case: Case, file: str) -> dict:
+    """
+    runs a case once
+    :return: wall and cpu seconds, peak memory of any process, bytes left in the temp dir and size of the output
+    """
+    # some ops are random (ie jpeg stretch), keep them the same every run
+    random.seed(0)
+    usage = Usage()
+    token = job_usage.set(usage)
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    async with tempfiles.TempFileSession():
+        try:
+            out = await materialize(await case.func(tempfiles.TempFile(file), *case.args))
+        finally:
+            job_usage.reset(token)
+        wall = time.perf_counter() - start
+        # before the session cleans up
+        temp_bytes = dir_size(tempfiles.temp_dir)
+        output_bytes = os.path.getsize(out)
+    return {
+        # subprocesses (and render workers, by wall time) plus this process
+        "cpu": usage.cpu_seconds + time.process_time() - cpu_start,
+        "wall": wall,
+        "peak_rss": usage.peak_memory,
+        "temp_bytes": temp_bytes,
+        "output_bytes": output_bytes,
+    }
+
+
+async def run_all(cases: list[Case], repeat: int) -> tuple[dict[str, dict], list[str]]:
+    """
+    :return: results of every case that ran, and the keys of the ones that failed
+    """
+    results = {}
+    failed = []
+    for file in corpus.generate():
+        mt = await tempfiles.TempFile(file).mediatype()
+        for case in cases:
+            if mt not in case.accepts:
+                continue
+            key = f"{case.name}/{os.path.basename(file)}"
+            try:
+                runs = [await measure(case, file) for _ in range(repeat)]
+            except Exception as e:
+                print(f"{key}: failed with {type(e).__name__}: {e}", file=sys.stderr)
+                failed.append(key)
+                continue
+            results[key] = {
+                "wall": statistics.median(r["wall"] for r in runs),
+                "cpu": statistics.median(r["cpu"] for r in runs),
+                "peak_rss": max(r["peak_rss"] for r in runs),
+                "temp_bytes": max(r["temp_bytes"] for r in runs),
+                "output_bytes": max(r["output_bytes"] for r in runs),
+            }
+            r = results[key]
+            print(f"{key:<50} {r['wall']:>8.2f}s wall {r['cpu']:>8.2f}s cpu {r['peak_rss'] / 1_000_000:>8.0f}MB rss "
+                  f"{r['temp_bytes'] / 1_000_000:>8.1f}MB temp {r['output_bytes'] / 1_000_000:>8.2f}MB out")
+    return results, failed
+
+
+def regressed(new: float, old: float, threshold: float, min_delta: float = 0) -> bool:
+    return new > old * (1 + threshold) and new - old > min_delta
+
+
+def compare(results: dict[str, dict], baseline: dict[str, dict], threshold: float, failed: list[str],
+            cases: list[Case]) -> int:
+    """
+    prints how results changed from the baseline
+    :param failed: keys of cases that failed, each is a regression
+    :param cases: the cases that were run. baseline entries of theirs that didn't run are regressions too.
+    :return: number of regressions
+    """
+    regressions = len(failed)
+    print(f"\n{'case':<50} {'wall':>16} {'cpu':>16} {'rss':>16} {'output':>16}")
+    for key, new in results.items():
+        old = baseline.get(key)
+        if old is None:
+            print(f"{key:<50} {'new':>16}")
+            continue
+        flags = []
+        if regressed(new["wall"], old["wall"], threshold, MIN_DELTA):
+            flags.append("wall")
+        if regressed(new["cpu"], old["cpu"], threshold, MIN_DELTA):
+            flags.append("cpu")
+        if regressed(new["peak_rss"], old["peak_rss"], threshold):
+            flags.append("rss")
+        regressions += bool(flags)
+
+        def change(metric):
+            # baselines saved before a metric existed don't have it
+            if metric not in old:
+                return "?"
+            return f"{(new[metric] / old[metric] - 1) * 100 if old[metric] else 0:+.0f}%"
+
+        print(f"{key:<50} {change('wall'):>16} {change('cpu'):>16} {change('peak_rss'):>16} "
+              f"{change('output_bytes'):>16}"
+              f"{'  REGRESSED: ' + ', '.join(flags) if flags else ''}")
+    for key in failed:
+        print(f"{key:<50} {'failed':>16}  REGRESSED")
+    names = {case.name for case in cases}
+    for key in sorted(baseline.keys() - results.keys() - set(failed)):
+        # --only leaves the other cases out on purpose
+        if key.split("/")[0] in names:
+            print(f"{key:<50} {'missing':>16}  REGRESSED")
+            regressions += 1
+    return regressions
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="benchmark processing functions against a baseline")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each case, the median is used")
+    parser.add_argument("--threshold", type=float, default=0.15,
+                        help="fraction slower than the baseline that counts as a regression")
+    parser.add_argument("--only", nargs="+", help="only run these cases")
+    args = parser.parse_args()
+
+    cases = [c for c in CASES if not args.only or c.name in args.only]
+    # tempfiles.init() empties every temp dir, so never use the bot's
+    tempfiles.temp_dir = os.path.join(tempfile.gettempdir(), "mediaforge-benchmark")
+    if tempfiles.spill_dir:
+        # next to the bot's, since that's where there's room for it
+        spill_parent = os.path.dirname(os.path.normpath(tempfiles.spill_dir))
+        tempfiles.spill_dir = os.path.join(spill_parent, "mediaforge-benchmark-spill")
+    tempfiles.init()
+    try:
+        results, failed = await run_all(cases, args.repeat)
+    finally:
+        processing.common.shutdown_pool()
+
+    # a case that fails is a regression even without a baseline
+    regressions = len(failed)
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold, failed, cases)
+    print(f"\n{regressions} regressions")
+    if args.save:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+        print(f"saved baseline to {args.baseline}")
+    sys.exit(1 if regressions and not args.save else 0)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -11,8 +11,51 @@ bot_list_data = None
 # number of commands that can be processed at once. set to None to automatically use OS cpu core count.
 # set to -1 to remove limit.
 workers = None
+# number of worker processes that run image rendering (pyvips/PIL) for all commands. they're kept running so they
+# don't have to start up for each command, and a crash in one doesn't take down the bot. set to None to use OS cpu
+# core count.
+render_workers = None
+# commands estimated to take more than this many seconds of CPU time are refused before they're queued. estimates are
+# learned from past runs, see the "cost" owner command. set to None for no limit.
+max_job_cost = None
+# every ffmpeg/magick/etc command's wall time, cpu time and peak memory is recorded, see the "cmdstats" owner command.
+# how many recent commands to keep.
+command_history_size = 1000
+# commands that take longer than this many seconds are logged as warnings. set to None to disable.
+slow_command_threshold = 30
+# port to serve prometheus metrics on, at /metrics. queue depth and wait/run times, downloads, subprocess cpu time, temp
+# dir size, result cache hits and shard latency. set to None to disable.
+metrics_port = None
+# address to serve metrics on. keep it local unless your prometheus scrapes from another host.
+metrics_host = "127.0.0.1"
+# how many commands to keep traces of. a trace shows how long each stage of a command took, see the "trace" owner
+# command.
+trace_history = 100
+# directory to write every command's trace to as OTLP JSON, for importing into jaeger/tempo/etc. set to None to disable.
+trace_export_dir = None
+# processing workers to send commands to, see src/worker.py. either "http://host:port" or "unix:/path/to/socket".
+# commands run on whichever worker (or this process) has the most room, and run here if no worker can be reached.
+remote_workers = []
+# shared secret the bot and workers use to authenticate. jobs are sent as pickles, so workers refuse to start without it
+# unless they listen on a unix socket (which is then only accessible to the user running the worker).
+remote_worker_token = None
 # manually specify tempdir rather than using OS's default
 override_temp_dir = None
+# temp files go in the temp dir above (ideally fast, ie /dev/shm) until it holds fast_temp_budget bytes, or if
+# they're expected to be bigger than small_temp_file_size. then they go here instead, which should be on disk. set to
+# None to only use the temp dir above.
+spill_temp_dir = None
+fast_temp_budget = 1_000_000_000
+small_temp_file_size = 50_000_000
+# bytes of temp storage all running commands together may use. commands wait for room (up to temp_budget_timeout
+# seconds) before they start. set to None for no limit.
+temp_budget = None
+# bytes of temp storage one command may use. every ffmpeg output is cut off at what the command has left and the
+# command fails cleanly. with temp_budget, every command reserves this much of it. set to None for no limit.
+temp_session_quota = None
+temp_budget_timeout = 60
+# temp files older than this many seconds that no running command owns are deleted every 10 minutes
+temp_max_age = 3600
 # NOTICE is recommended, INFO prints more information about what bot is doing, WARNING only prints errors.
 log_level = "NOTICE"
 # amount of seconds cooldown per user commands have. set to 0 to disable cooldown
@@ -61,6 +104,11 @@ sticker_upload_limit = 512 * 1024  # 512 KiB, sticker limit
 # fail. this is intended to block hateful language like slurs. not case sensitive.
 # its in the config so i dont have to upload slurs to github...
 blocked_words = []
+# directory to cache command results in. running the same command on the same media again is served from here
+# instead of being processed again.
+result_cache_dir = "cache"
+# maximum size, in bytes, of the result cache. least recently used results are removed first. set to 0 to disable.
+result_cache_size = 2_000_000_000
 # filename of the sqlite3 database. currently only used for storing server-specific prefixes.
 db_filename = "database.db"
 # default prefix for commands
@@ -83,4 +131,17 @@ max_fps = 100
 temp_vcodec = "utvideo"
 temp_vpixfmt = "rgba"
 temp_acodec = "pcm_s16le"
-temp_vipscodec = "tiff"
\ No newline at end of file
+temp_vipscodec = "tiff"
+# stream intermediates straight from one ffmpeg into the next over a pipe where possible, instead of writing them to
+# temp files in between. uses less disk and lets both run at once. has no effect on windows
+pipe_intermediates = True
+# what encodes gifs. "ffmpeg" (palettegen/paletteuse) or "vips" (libvips gifsave, needs libvips 8.15+ built with cgif,
+# falls back to ffmpeg otherwise). vips decodes once, shares palettes between frames, makes unchanged pixels transparent
+# and shrinks gifs to fit the upload limit without re-encoding from scratch. compare them with benchmarks/run.py
+gif_engine = "ffmpeg"
+# vips only. libimagequant effort, 1 (fast) to 10 (smallest)
+gif_effort = 7
+# vips only. how different a pixel can be from the last frame and still be made transparent, 0 to turn it off
+gif_interframe_maxerror = 8
+# vips only. how different a frame's colors can be from the last palette and still reuse it, 0 to never reuse
+gif_interpalette_maxerror = 3
\ No newline at end of file
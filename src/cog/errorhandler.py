@@ -126,7 +126,8 @@ class ErrorHandlerCog(commands.Cog):
             err = f"{config.emojis['x']} {errorstring}"
             await logandreply(err)
         elif isinstance(commanderror, discord.ext.commands.errors.CommandInvokeError) and \
-                isinstance(commanderror.original, processing.common.NonBugError):
+                isinstance(commanderror.original, (processing.common.NonBugError,
+                                                   utils.tempfiles.TempBudgetExceeded)):
             await logandreply(f"{config.emojis['2exclamation']} {str(commanderror.original)[:1000]}")
         else:
             if isinstance(commanderror, discord.ext.commands.errors.CommandInvokeError) or \
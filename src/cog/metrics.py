@@ -0,0 +1,100 @@
+import asyncio
+
+import discord
+from aiohttp import web
+from discord.ext import commands
+
+import config
+import core.queue
+import core.resultcache
+import processing.run_command
+from core import metrics
+from core.clogs import logger
+from utils import tempfiles
+
+metrics_host = config.metrics_host if hasattr(config, "metrics_host") else "127.0.0.1"
+metrics_port = config.metrics_port if hasattr(config, "metrics_port") else None
+
+
+class Metrics(commands.Cog):
+    """
+    serves core.metrics and the bot's current state at http://metrics_host:metrics_port/metrics
+    """
+
+    def __init__(self, bot):
+        self.bot: commands.Bot = bot
+        self.runner: web.AppRunner | None = None
+
+    async def cog_load(self):
+        app = web.Application()
+        app.add_routes([web.get("/metrics", self.serve)])
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, metrics_host, metrics_port).start()
+        logger.info(f"Serving metrics on http://{metrics_host}:{metrics_port}/metrics")
+
+    async def cog_unload(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def collect(self) -> list[str]:
+        """
+        :return: metrics that are read when scraped instead of measured as they happen
+        """
+        out = []
+        scheduler = core.queue.scheduler
+        out += metrics.header("mediaforge_queue_slots", "gauge", "Commands that can run at once.")
+        out.append(metrics.sample("mediaforge_queue_slots", scheduler.slots))
+        out += metrics.header("mediaforge_queue_running", "gauge", "Commands currently processing.")
+        out.append(metrics.sample("mediaforge_queue_running",
+                                  len(scheduler.running) if core.queue.queue_enabled else core.queue.queued))
+        out += metrics.header("mediaforge_queue_waiting", "gauge", "Commands waiting in the queue.")
+        for cls, queue in scheduler.classes.items():
+            out.append(metrics.sample("mediaforge_queue_waiting", len(queue), {"class": cls}))
+
+        out += metrics.header("mediaforge_subprocess_cpu_seconds_total", "counter",
+                              "CPU time used by subprocesses, by binary.")
+        out += metrics.header("mediaforge_subprocess_runs_total", "counter", "Subprocesses run, by binary.")
+        cpu: dict[tuple[str, str], float] = {}
+        runs: dict[str, int] = {}
+        for (binary, _), stats in processing.run_command.command_stats.items():
+            cpu[(binary, "user")] = cpu.get((binary, "user"), 0) + stats.user
+            cpu[(binary, "system")] = cpu.get((binary, "system"), 0) + stats.sys
+            runs[binary] = runs.get(binary, 0) + stats.count
+        for (binary, mode), seconds in cpu.items():
+            out.append(metrics.sample("mediaforge_subprocess_cpu_seconds_total", seconds,
+                                      {"binary": binary, "mode": mode}))
+        for binary, count in runs.items():
+            out.append(metrics.sample("mediaforge_subprocess_runs_total", count, {"binary": binary}))
+
+        out += metrics.header("mediaforge_temp_bytes", "gauge", "Size of each temp directory.")
+        out += metrics.header("mediaforge_temp_files", "gauge", "Files in each temp directory.")
+        for tier, directory in zip(["fast", "spill"], tempfiles.tiers()):
+            size, count = await asyncio.to_thread(tempfiles.dir_usage, directory)
+            out.append(metrics.sample("mediaforge_temp_bytes", size, {"tier": tier}))
+            out.append(metrics.sample("mediaforge_temp_files", count, {"tier": tier}))
+        if tempfiles.global_budget is not None:
+            out += metrics.header("mediaforge_temp_budget_bytes", "gauge", "Temp storage all commands may use.")
+            out.append(metrics.sample("mediaforge_temp_budget_bytes", tempfiles.global_budget))
+            out += metrics.header("mediaforge_temp_reserved_bytes", "gauge",
+                                  "Temp storage reserved by running commands.")
+            out.append(metrics.sample("mediaforge_temp_reserved_bytes", tempfiles.reserved))
+
+        if core.resultcache.cache_enabled:
+            out += metrics.header("mediaforge_result_cache_hits_total", "counter", "Result cache hits.")
+            out.append(metrics.sample("mediaforge_result_cache_hits_total", core.resultcache.hits))
+            out += metrics.header("mediaforge_result_cache_misses_total", "counter", "Result cache misses.")
+            out.append(metrics.sample("mediaforge_result_cache_misses_total", core.resultcache.misses))
+            out += metrics.header("mediaforge_result_cache_bytes", "gauge", "Size of the result cache.")
+            out.append(metrics.sample("mediaforge_result_cache_bytes",
+                                      await asyncio.to_thread(core.resultcache.total_size)))
+
+        if isinstance(self.bot, discord.AutoShardedClient):
+            out += metrics.header("mediaforge_shard_latency_seconds", "gauge", "Heartbeat latency of each shard.")
+            for shard_id, shard in self.bot.shards.items():
+                out.append(metrics.sample("mediaforge_shard_latency_seconds", shard.latency, {"shard": shard_id}))
+        return out
+
+    async def serve(self, _: web.Request) -> web.Response:
+        body = metrics.render() + "\n".join(await self.collect()) + "\n"
+        return web.Response(text=body, content_type="text/plain", charset="utf-8")
@@ -0,0 +1,19 @@
+from discord.ext import commands, tasks
+
+import core.remote
+
+
+class RemoteWorkers(commands.Cog):
+    def __init__(self, bot):
+        self.bot = bot
+        # all exceptions should be handled
+        self.refresh.clear_exception_types()
+        self.refresh.add_exception_type(Exception)
+        self.refresh.start()
+
+    def cog_unload(self):
+        self.refresh.cancel()
+
+    @tasks.loop(seconds=30)
+    async def refresh(self):
+        await core.remote.refresh()
@@ -0,0 +1,25 @@
+import asyncio
+
+from discord.ext import commands, tasks
+
+from utils import tempfiles
+
+
+class TempSweeper(commands.Cog):
+    """
+    deletes temp files that outlived the command that made them, ie after a crash
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+        # all exceptions should be handled
+        self.sweep.clear_exception_types()
+        self.sweep.add_exception_type(Exception)
+        self.sweep.start()
+
+    def cog_unload(self):
+        self.sweep.cancel()
+
+    @tasks.loop(minutes=10)
+    async def sweep(self):
+        await asyncio.to_thread(tempfiles.sweep)
@@ -1,15 +1,19 @@
 import asyncio
 import glob
 import io
+import json
 import os
 import typing
 
 import discord
+import humanize
 from discord.ext import commands
 
 import config
 import core.queue
+import core.tracing
 import processing.common
+import processing.cost
 import processing.other
 import processing.run_command
 import utils.tempfiles
@@ -26,11 +30,15 @@ class Debug(commands.Cog, name="Owner Only", command_attrs=dict(hidden=True)):
 
     @commands.command(aliases=["segfault", "segmentationfault"])
     @commands.is_owner()
-    async def sigsegv(self, ctx, ftype: typing.Literal["overflow", "oskill", "ctypes"] = "oskill"):
+    async def sigsegv(self, ctx, ftype: typing.Literal["overflow", "oskill", "ctypes", "worker"] = "oskill"):
         """
         cause the main process to segfault. used for debugging purposes. seems it wont kill child processes.
+        "worker" segfaults a render worker instead, to test that the bot survives it.
         """
-        if ftype == "overflow":
+        if ftype == "worker":
+            import ctypes
+            await processing.common.run_parallel(ctypes.string_at, 0)
+        elif ftype == "overflow":
             # https://codegolf.stackexchange.com/a/62613
             exec('()' * 7 ** 6)
         elif ftype == "oskill":
@@ -106,10 +114,10 @@ class Debug(commands.Cog, name="Owner Only", command_attrs=dict(hidden=True)):
         """
         Clear the /temp folder
         """
-        l = len(glob.glob(utils.tempfiles.temp_dir + "/*"))
-        for f in glob.glob(utils.tempfiles.temp_dir + "/*"):
+        files = [f for d in utils.tempfiles.tiers() for f in glob.glob(d + "/*")]
+        for f in files:
             os.remove(f)
-        await ctx.send(f"✅ Removed {l} files.")
+        await ctx.send(f"✅ Removed {len(files)} files.")
 
     @commands.command(hidden=True, aliases=["stop", "close", "die", "kill", "murder", "death"])
     @commands.is_owner()
@@ -202,3 +210,67 @@ class Debug(commands.Cog, name="Owner Only", command_attrs=dict(hidden=True)):
         msg = await ctx.reply("Command entering queue...")
         await core.queue.enqueue(wait())
         await msg.edit(content="Command out of queue.")
+
+    @commands.command()
+    @commands.is_owner()
+    async def cost(self, ctx):
+        """
+        lists the learned cpu time and memory models of every op
+        """
+        out = ""
+        for op, model in sorted(processing.cost.models.items(), key=lambda x: -x[1].runs):
+            a, b = model.cpu.coefficients(processing.cost.DEFAULT_CPU)
+            ma, mb = model.memory.coefficients(processing.cost.DEFAULT_MEMORY)
+            out += (f"{op}: {model.runs} runs. cpu {a:.2f}s + {b:.4f}s per megapixel-frame. "
+                    f"memory {humanize.naturalsize(ma)} + {humanize.naturalsize(mb)} per megapixel.\n")
+        if not out:
+            await ctx.reply("No runs recorded yet.")
+            return
+        with io.StringIO() as buf:
+            buf.write(out)
+            buf.seek(0)
+            await ctx.reply(file=discord.File(buf, filename="costs.txt"))
+
+    @commands.command(aliases=["commandstats"])
+    @commands.is_owner()
+    async def cmdstats(self, ctx, job: typing.Optional[str] = None):
+        """
+        lists the cpu time and memory of the commands each function ran, most cpu first.
+        with a job (message id), lists that job's recent commands instead.
+        """
+        if job is not None:
+            out = "".join(f"{r.binary} from {r.caller}: {r.wall:.2f}s wall, {r.user:.2f}s user, {r.sys:.2f}s sys, "
+                          f"{humanize.naturalsize(r.max_rss)} peak, exit {r.returncode}\n"
+                          for r in processing.run_command.history if r.job == job)
+        else:
+            out = "".join(f"{binary} from {caller}: {s.count} runs ({s.failures} failed). {s.cpu:.1f}s cpu "
+                          f"({s.user:.1f}s user, {s.sys:.1f}s sys), {s.wall:.1f}s wall, "
+                          f"{humanize.naturalsize(s.max_rss)} peak\n"
+                          for (binary, caller), s in sorted(processing.run_command.command_stats.items(),
+                                                            key=lambda x: -x[1].cpu))
+        if not out:
+            await ctx.reply("No commands recorded.")
+            return
+        with io.StringIO() as buf:
+            buf.write(out)
+            buf.seek(0)
+            await ctx.reply(file=discord.File(buf, filename="commands.txt"))
+
+    @commands.command()
+    @commands.is_owner()
+    async def trace(self, ctx, job: str):
+        """
+        shows where the time went in a recent command, and attaches it as OTLP JSON
+        :param job: id of the message that ran the command
+        """
+        trace = core.tracing.traces.get(job)
+        if trace is None:
+            await ctx.reply(f"No trace for {job}. Only the last {core.tracing.trace_history} commands are kept.")
+            return
+        text = core.tracing.waterfall(trace)
+        files = [discord.File(io.StringIO(json.dumps(core.tracing.otlp(trace))), filename=f"trace-{job}.json")]
+        if len(text) > 1900:
+            files.append(discord.File(io.StringIO(text), filename=f"trace-{job}.txt"))
+            await ctx.reply(files=files)
+        else:
+            await ctx.reply(f"```\n{text}\n```", files=files)
@@ -1,3 +1,4 @@
+import asyncio
 import difflib
 import io
 import time
@@ -5,11 +6,13 @@ import typing
 
 import discord
 import docstring_parser
+import humanize
 import regex as re
 from discord.ext import commands
 
 import config
 import core.queue
+import core.resultcache
 import processing.common
 import processing.ffmpeg.ffprobe
 import processing.run_command
@@ -147,12 +150,19 @@ class Other(commands.Cog, name="Other"):
         """
         embed = discord.Embed(color=discord.Color(0xD262BA), title="Statistics")
         if core.queue.queue_enabled:
-            embed.add_field(name="Running Commands", value=f"{min(core.queue.queued, core.queue.workers)}")
+            embed.add_field(name="Running Commands", value=f"{len(core.queue.scheduler.running)}")
             embed.add_field(name="Max Running Commands", value=f"{core.queue.workers}")
-            embed.add_field(name="Queued Commands", value=f"{max(0, core.queue.queued - core.queue.workers)}")
+            embed.add_field(name="Queued Commands", value=f"{core.queue.scheduler.waiting}")
         else:
             embed.add_field(name="Running Commands", value=f"{core.queue.queued}")
             embed.add_field(name="Number of tasks this instance can run at once", value=f"{core.queue.workers}")
+        if core.resultcache.cache_enabled:
+            lookups = core.resultcache.hits + core.resultcache.misses
+            ratio = f" ({round(core.resultcache.hits / lookups * 100)}% hits)" if lookups else ""
+            embed.add_field(name="Result Cache",
+                            value=f"{core.resultcache.hits} hits, {core.resultcache.misses} misses{ratio}\n"
+                                  f"{humanize.naturalsize(await asyncio.to_thread(core.resultcache.total_size))} / "
+                                  f"{humanize.naturalsize(core.resultcache.cache_size)}")
         if isinstance(self.bot, discord.AutoShardedClient):
             embed.add_field(name="Total Bot Shards", value=f"{len(self.bot.shards)}")
         await ctx.reply(embed=embed)
@@ -0,0 +1,59 @@
+"""
+the part of a command that actually processes media. shared by the bot (core.process) and remote workers (worker.py),
+so a job gives the same result wherever it runs.
+"""
+import dataclasses
+import inspect
+
+import processing.common
+import processing.ffmpeg.ensuresize
+import processing.ffmpeg.pipeline
+from core import tracing
+from core.clogs import logger
+from utils.tempfiles import TempBudget
+
+
+@dataclasses.dataclass
+class Job:
+    func: callable
+    # inputs, after ensuresize.normalize. may be lazy Pipelines
+    files: list
+    args: tuple
+    kwargs: dict
+    # if the files are passed to func
+    has_inputs: bool
+    run_parallel: bool
+    expectimage: bool
+
+
+async def execute(job: Job):
+    """
+    runs a job
+    :return: the processed file, or a string if the job doesn't expect an image
+    """
+    # temp storage is only reserved once the job actually runs, not while it waits in the queue
+    async with TempBudget():
+        files = job.files
+        # fusable commands add their filters to the same pipeline, so it all runs as one ffmpeg call
+        if not (len(files) == 1 and processing.ffmpeg.pipeline.is_fusable(job.func)):
+            with tracing.span("materialize"):
+                files = [await processing.ffmpeg.pipeline.materialize(f) for f in files]
+        # prepare args
+        args = list(job.args)
+        if job.has_inputs:
+            args = files + args
+        with tracing.span(getattr(job.func, "__qualname__", "func")):
+            # some commands arent coros (usually no-ops) so this is a good check to make
+            if inspect.iscoroutinefunction(job.func):
+                command_result = await job.func(*args, **job.kwargs)
+            else:
+                if job.run_parallel:
+                    command_result = await processing.common.run_parallel(job.func, *args, **job.kwargs)
+                else:
+                    logger.warning(f"{job.func} is not coroutine")
+                    command_result = job.func(*args, **job.kwargs)
+            command_result = await processing.ffmpeg.pipeline.materialize(command_result)
+        if job.expectimage and command_result:
+            with tracing.span("finalize"):
+                command_result = await processing.ffmpeg.ensuresize.finalize(command_result)
+        return command_result
@@ -0,0 +1,112 @@
+"""
+metrics in the prometheus text format, served by cog.metrics for grafana/prometheus to scrape.
+this module only holds what's measured as it happens (counters and histograms). things that can be read at any time
+(queue depth, temp dir size, shard latency...) are collected by the cog when scraped.
+"""
+import math
+
+# default histogram buckets, in seconds
+TIME_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+# in bytes
+SIZE_BUCKETS = (100_000, 1_000_000, 5_000_000, 10_000_000, 25_000_000, 50_000_000, 100_000_000, 500_000_000)
+
+registry: list["Metric"] = []
+
+
+def escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{escape(v)}"' for k, v in labels.items()) + "}"
+
+
+def format_value(value: float) -> str:
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def header(name: str, kind: str, doc: str) -> list[str]:
+    return [f"# HELP {name} {doc}", f"# TYPE {name} {kind}"]
+
+
+def sample(name: str, value: float, labels: dict | None = None) -> str:
+    return f"{name}{format_labels(labels or {})} {format_value(value)}"
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, doc: str):
+        self.name = name
+        self.doc = doc
+        registry.append(self)
+
+    def samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> list[str]:
+        return header(self.name, self.kind, self.doc) + self.samples()
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str):
+        super().__init__(name, doc)
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        return [sample(self.name, v, dict(k)) for k, v in self.values.items()]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, buckets: tuple = TIME_BUCKETS):
+        super().__init__(name, doc)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # labels -> (count per bucket, sum)
+        self.values: dict[tuple, tuple[list[int], float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        counts, total = self.values.get(key, ([0] * len(self.buckets), 0.))
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+        self.values[key] = (counts, total + value)
+
+    def samples(self) -> list[str]:
+        out = []
+        for key, (counts, total) in self.values.items():
+            labels = dict(key)
+            # bucket counts are cumulative
+            for bound, count in zip(self.buckets, counts):
+                out.append(sample(f"{self.name}_bucket", count, labels | {"le": format_value(float(bound))}))
+            out.append(sample(f"{self.name}_sum", total, labels))
+            out.append(sample(f"{self.name}_count", counts[-1], labels))
+        return out
+
+
+queue_wait = Histogram("mediaforge_queue_wait_seconds", "Time commands spent waiting in the queue.")
+run_time = Histogram("mediaforge_command_run_seconds", "Time commands spent processing once out of the queue.")
+download_bytes = Histogram("mediaforge_download_bytes", "Size of downloaded media.", SIZE_BUCKETS)
+download_time = Histogram("mediaforge_download_seconds", "Time taken to download media.")
+download_errors = Counter("mediaforge_download_errors_total", "Downloads that failed.")
+
+
+def render() -> str:
+    """
+    :return: every registered metric in the prometheus text format
+    """
+    return "\n".join(line for metric in registry for line in metric.render()) + "\n"
@@ -1,19 +1,25 @@
 import asyncio
-import inspect
+import os
+import sys
+import time
 import typing
 from urllib.parse import urlparse
 
 import discord
+import humanize
 from discord.ext import commands
 
 import config
+import core.jobs
+import core.remote
 import processing.common
-import processing.ffmpeg.conversion
+import processing.cost
 import processing.ffmpeg.ensuresize
 import processing.ffmpeg.ffprobe
 import processing.mediatype
+import processing.run_command
 import utils.tempfiles
-from core import queue
+from core import queue, resultcache, metrics, tracing
 from core.clogs import logger
 from utils.scandiscord import imagesearch
 from utils.web import saveurls
@@ -60,6 +66,10 @@ async def process(ctx: commands.Context, func: callable, inputs: list, *args,
         # nothing to download sometimes
         await updatestatus(f"Downloading...")
 
+    # every command this runs is tagged with the message that asked for it
+    job_token = processing.run_command.job_id.set(str(ctx.message.id))
+    trace_tokens = tracing.start_trace(str(ctx.message.id),
+                                       ctx.command.qualified_name if ctx.command else func.__name__, user=ctx.author.id)
     try:
         async with utils.tempfiles.TempFileSession():
             # get media from channel
@@ -77,7 +87,9 @@ async def process(ctx: commands.Context, func: callable, inputs: list, *args,
                 if missing_file_count > 0:
                     # search for any missing
                     # pass the slashfiles so if we get attachments via the param via a text command, we can ignore them
-                    searched_urls = await imagesearch(ctx, missing_file_count, [s for s in slashfiles if s is not None])
+                    with tracing.span("imagesearch"):
+                        searched_urls = await imagesearch(ctx, missing_file_count,
+                                                          [s for s in slashfiles if s is not None])
                     # insert into list
                     index = 0
                     for i, url in enumerate(urls):
@@ -86,15 +98,18 @@ async def process(ctx: commands.Context, func: callable, inputs: list, *args,
                             index += 1
                 # spoiler if needed
                 spoiler = spoiler or any([urlparse(u).path.split("/")[-1].startswith("SPOILER_") for u in urls])
-                files = await saveurls(urls)
+                with tracing.span("saveurls", count=len(urls)):
+                    files = await saveurls(urls)
             else:
                 files = []
             # if media found or none needed
             if files or not inputs:
                 # check that each file is correct type
                 for i, file in enumerate(files):
+                    with tracing.span("typecheck", input=i):
+                        imtype = await file.mediatype()
                     # if file is incorrect type
-                    if (imtype := await file.mediatype()) not in inputs[i]:
+                    if imtype not in inputs[i]:
                         # send message and break
                         await ctx.reply(
                             f"{config.emojis['warning']} Media #{i + 1} is {imtype}, it must be: "
@@ -109,42 +124,73 @@ async def process(ctx: commands.Context, func: callable, inputs: list, *args,
                                       f"pect errors.", delete_after=10))
                 # files are of correcte type, begin to process
                 else:
-                    # only update with queue message if there is a queue
-                    if queue.queue_enabled and queue.sem.locked():
-                        await updatestatus("Your command is in the queue...")
+                    # identical command on identical media, skip the queue and go straight to upload
+                    cache_key = None
+                    if expectimage and uploadresult:
+                        # the owner's inputs aren't trimmed, so their results differ from everyone else's
+                        cache_key = await resultcache.cache_key(files, func, args, kwargs, resize,
+                                                                await ctx.bot.is_owner(ctx.author))
+                    if cache_key is not None:
+                        with tracing.span("resultcache") as span:
+                            result = await resultcache.get(cache_key)
+                            if span is not None:
+                                span.attributes["hit"] = result is not None
 
-                    # run func
+                    if result is None:
+                        # resize and remove too long videossss
+                        # this only builds up a lazy pipeline, nothing is encoded until it's materialized. it's done
+                        # before queueing so the estimate is of what the command will actually process
+                        minsize, maxsize = (config.min_size, config.max_size) if resize else (None, None)
+                        for i in range(len(files)):
+                            with tracing.span("normalize", input=i):
+                                files[i] = await processing.ffmpeg.ensuresize.normalize(ctx, files[i], minsize,
+                                                                                        maxsize)
+                        op = processing.cost.op_name(func, args)
+                        with tracing.span("estimate"):
+                            features = await processing.cost.features(files)
+                            estimate = processing.cost.estimate(op, features)
+                        if processing.cost.max_job_cost is not None \
+                                and estimate.cpu_seconds > processing.cost.max_job_cost:
+                            raise processing.common.NonBugError(
+                                f"This would take too long to process (about "
+                                f"{humanize.naturaldelta(estimate.cpu_seconds)} of CPU time). Try shorter or smaller "
+                                f"media.")
+
+                    # run func, recording what it uses so the cost estimates improve
                     async def run():
-                        nonlocal args
-                        nonlocal files
+                        metrics.queue_wait.observe(time.monotonic() - queued_at, command=command_name)
+                        tracing.add_span("queue", queued_ns, time.time_ns())
+                        started = time.monotonic()
+                        usage = processing.run_command.Usage()
+                        token = processing.run_command.job_usage.set(usage)
+                        try:
+                            res = await process_files()
+                        finally:
+                            processing.run_command.job_usage.reset(token)
+                            metrics.run_time.observe(time.monotonic() - started, command=command_name)
+                        await processing.cost.record(op, features, usage)
+                        return res
+
+                    async def process_files():
                         logger.info("Processing...")
                         await updatestatus("Forging...")
+                        # runs on a remote worker if one has more room than this process
+                        return await core.remote.execute(
+                            core.jobs.Job(func, files, args, kwargs, bool(inputs), run_parallel, expectimage))
 
-                        # remove too long videossss
-                        for i in range(len(files)):
-                            if resize:
-                                files[i] = await processing.ffmpeg.ensuresize.ensuresize(ctx, files[i], config.min_size,
-                                                                                         config.max_size)
-                            files[i] = await processing.ffmpeg.ensuresize.ensureduration(files[i], ctx)
-                        # prepare args
-                        if inputs:
-                            args = files + list(args)
-                        # some commands arent coros (usually no-ops) so this is a good check to make
-                        if inspect.iscoroutinefunction(func):
-                            command_result = await func(*args, **kwargs)
-                        else:
-                            if run_parallel:
-                                command_result = await processing.common.run_parallel(func, *args, **kwargs)
-                            else:
-                                logger.warning(f"{func} is not coroutine")
-                                command_result = func(*args, **kwargs)
-                        if expectimage and command_result:
-                            re_encoded = await processing.ffmpeg.conversion.allreencode(command_result)
-                            ensured_size = await processing.ffmpeg.ensuresize.assurefilesize(re_encoded, command_result)
-                            command_result = ensured_size
-                        return command_result
-
-                    result = await queue.enqueue(run())
+                    async def queue_status(ahead: int, eta: float):
+                        await updatestatus(f"Your command is in the queue. {ahead} command{'' if ahead == 1 else 's'}"
+                                           f" ahead of it, starting in about {humanize.naturaldelta(eta)}...")
+
+                    if result is None:
+                        command_name = ctx.command.qualified_name if ctx.command else func.__name__
+                        queued_at = time.monotonic()
+                        queued_ns = time.time_ns()
+                        result = await queue.enqueue(run(), user=ctx.author.id,
+                                                     guild=ctx.guild.id if ctx.guild else None,
+                                                     cost=estimate.cpu_seconds, on_wait=queue_status)
+                        if cache_key is not None and result:
+                            await resultcache.put(cache_key, result)
                     # check results are as expected
                     if expectimage:  # file expected
                         if not result:
@@ -160,11 +206,12 @@ async def process(ctx: commands.Context, func: callable, inputs: list, *args,
                         logger.info("Uploading...")
                         await updatestatus("Uploading...")
                         if uploadresult:
-                            if ctx.interaction:
-                                await msg.edit(content="",
-                                               attachments=[discord.File(result, spoiler=spoiler, filename=name)])
-                            else:
-                                await ctx.reply(file=discord.File(result, spoiler=spoiler, filename=name))
+                            with tracing.span("upload", size=os.path.getsize(result)):
+                                if ctx.interaction:
+                                    await msg.edit(content="",
+                                                   attachments=[discord.File(result, spoiler=spoiler, filename=name)])
+                                else:
+                                    await ctx.reply(file=discord.File(result, spoiler=spoiler, filename=name))
 
             else:  # no media found but media expected
                 logger.info("No media found.")
@@ -176,6 +223,9 @@ async def process(ctx: commands.Context, func: callable, inputs: list, *args,
         if msg is not None and not ctx.interaction:
             await msg.delete()
         raise e
+    finally:
+        processing.run_command.job_id.reset(job_token)
+        tracing.finish_trace(trace_tokens, sys.exc_info()[1])
     # delete message
     if msg is not None and not ctx.interaction:
         await msg.delete()
@@ -1,29 +1,287 @@
+"""
+fair scheduler for commands.
+only `workers` commands run at once. waiting commands are split into a light class (cheap, ie images) and a heavy
+class (long videos/gifs). light commands go first so a quick caption doesn't wait behind a 1000 frame reverse, but
+heavy commands are still let through regularly so they can't be starved.
+inside each class, users take turns by deficit round robin weighted by their estimated cost, and every guild gets an
+equal share split between its users, so one user (or one server) queuing lots of expensive commands can't block
+everyone else. each user's own commands run in the order they were sent.
+"""
 import asyncio
+import collections
+import dataclasses
+import math
 import os
+import time
 import typing
 
 import config
+from core.clogs import logger
 
 queue_enabled = config.workers != -1
-if queue_enabled:
-    workers = config.workers or os.cpu_count() or 1
-    sem = asyncio.Semaphore(workers)
+workers = (config.workers if queue_enabled else None) or os.cpu_count() or 1
 queued = 0
 
+# estimated cost at or below which a command is light
+LIGHT_COST = 5
+# at most this many light commands are started in a row while a heavy one is waiting
+LIGHT_BURST = 4
+# credit each guild gets per round
+QUANTUM = 1
+# slack for float error when comparing credit to cost
+EPSILON = 1e-9
+# how often to refresh the queue position shown to a waiting user, in seconds
+STATUS_INTERVAL = 5
 
-async def enqueue(task: typing.Coroutine):
+LIGHT = "light"
+HEAVY = "heavy"
+
+
+def core_budget() -> int:
+    """
+    :return: how many cores one job may use at once without taking them from the other jobs the queue lets run
+    """
+    cores = os.cpu_count() or 1
     if not queue_enabled:
-        return await task
+        return cores
+    return max(1, cores // workers)
+
+
+@dataclasses.dataclass(eq=False)
+class Job:
+    user: int | None
+    guild: int | None
+    # estimated run time, in seconds
+    cost: float
+    started: asyncio.Future
+    enqueued: float = dataclasses.field(default_factory=time.monotonic)
+    start_time: float | None = None
+
+    @property
+    def cls(self):
+        return LIGHT if self.cost <= LIGHT_COST else HEAVY
+
+    @property
+    def flow(self):
+        return self.user
+
+    @property
+    def guild_key(self):
+        # DMs count as their own guild
+        return ("guild", self.guild) if self.guild is not None else ("user", self.user)
+
+
+class FairQueue:
+    """
+    deficit round robin between users, weighted so each guild gets the same share
+    """
+
+    def __init__(self):
+        # flow -> that user's jobs, in the order they'll be visited
+        self.flows: collections.OrderedDict[typing.Any, collections.deque[Job]] = collections.OrderedDict()
+        self.deficit: dict[typing.Any, float] = {}
+        # guild -> number of flows whose next job is in it, so quantum() doesn't have to count
+        self.guild_flows: collections.Counter = collections.Counter()
+
+    def __len__(self):
+        return sum(len(q) for q in self.flows.values())
+
+    def __bool__(self):
+        return bool(self.flows)
+
+    def copy(self):
+        new = FairQueue()
+        new.flows = collections.OrderedDict((k, collections.deque(v)) for k, v in self.flows.items())
+        new.deficit = dict(self.deficit)
+        new.guild_flows = self.guild_flows.copy()
+        return new
+
+    def _drop_head(self, flow, q: collections.deque[Job], job: Job | None = None):
+        """
+        removes job (or the next job) from a flow, keeping guild_flows up to date
+        """
+        self.guild_flows[q[0].guild_key] -= 1
+        if job is None:
+            q.popleft()
+        else:
+            q.remove(job)
+        if q:
+            self.guild_flows[q[0].guild_key] += 1
+        else:
+            # idle users don't keep credit
+            del self.flows[flow]
+            del self.deficit[flow]
+
+    def push(self, job: Job):
+        if job.flow not in self.flows:
+            self.flows[job.flow] = collections.deque()
+            self.deficit[job.flow] = 0
+            self.guild_flows[job.guild_key] += 1
+        self.flows[job.flow].append(job)
+
+    def remove(self, job: Job):
+        q = self.flows.get(job.flow)
+        if q is not None and job in q:
+            self._drop_head(job.flow, q, job)
+
+    def quantum(self, flow) -> float:
+        return QUANTUM / self.guild_flows[self.flows[flow][0].guild_key]
+
+    def pop(self) -> Job:
+        flow, q = next(iter(self.flows.items()))
+        if q[0].cost > self.deficit[flow] + EPSILON:
+            # nobody can afford their next job. instead of crediting one quantum per visit until someone can, skip
+            # straight to the round where the first user can. quanta don't change in between since nothing is popped.
+            order = list(self.flows.items())
+            rounds = [max(0, math.ceil((fq[0].cost - self.deficit[f]) / self.quantum(f) - EPSILON)) for f, fq in order]
+            first = min(range(len(order)), key=lambda i: (rounds[i], i))
+            for i, (f, _) in enumerate(order):
+                # users before the one that's served were visited once more in the last round
+                self.deficit[f] += self.quantum(f) * (rounds[first] + (i < first))
+            for f, _ in order[:first]:
+                self.flows.move_to_end(f)
+            flow, q = order[first]
+        job = q[0]
+        # rounding can leave it a hair short
+        self.deficit[flow] = max(self.deficit[flow], job.cost) - job.cost
+        self._drop_head(flow, q)
+        return job
+
+
+class Scheduler:
+    def __init__(self, slots: int):
+        self.slots = slots
+        self.running: list[Job] = []
+        self.classes = {LIGHT: FairQueue(), HEAVY: FairQueue()}
+        self.light_streak = 0
+        # positions() of every waiting job, and when they were worked out. cleared whenever the queue changes
+        self._positions: dict[Job, tuple[int, float]] | None = None
+        self._positions_at = 0.
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(q) for q in self.classes.values())
+
+    def _next_class(self, classes: dict[str, FairQueue], light_streak: int) -> str | None:
+        if classes[LIGHT] and (not classes[HEAVY] or light_streak < LIGHT_BURST):
+            return LIGHT
+        if classes[HEAVY]:
+            return HEAVY
+        return None
+
+    def _pop(self, classes: dict[str, FairQueue], light_streak: int) -> tuple[Job | None, int]:
+        cls = self._next_class(classes, light_streak)
+        if cls is None:
+            return None, light_streak
+        light_streak = light_streak + 1 if cls == LIGHT else 0
+        return classes[cls].pop(), light_streak
+
+    def _dispatch(self):
+        self._positions = None
+        while len(self.running) < self.slots:
+            job, self.light_streak = self._pop(self.classes, self.light_streak)
+            if job is None:
+                return
+            job.start_time = time.monotonic()
+            self.running.append(job)
+            job.started.set_result(None)
+
+    def resize(self, slots: int):
+        """
+        change how many jobs can run at once, ie when remote workers come and go
+        """
+        if slots != self.slots:
+            logger.info(f"Queue now runs {slots} commands at once")
+            self.slots = slots
+            self._dispatch()
+
+    def submit(self, job: Job):
+        self.classes[job.cls].push(job)
+        self._dispatch()
+
+    def cancel(self, job: Job):
+        self.classes[job.cls].remove(job)
+        self._positions = None
+
+    def finish(self, job: Job):
+        self.running.remove(job)
+        self._dispatch()
+
+    def positions(self) -> dict[Job, tuple[int, float]]:
+        """
+        :return: for every waiting job, how many commands will start before it if nothing else is queued, and roughly
+            how many seconds until it starts
+        """
+        now = time.monotonic()
+        # every waiting job asks every STATUS_INTERVAL, so work it out once for all of them
+        if self._positions is not None and now - self._positions_at < 1:
+            return self._positions
+        classes = {k: v.copy() for k, v in self.classes.items()}
+        light_streak = self.light_streak
+        # when each slot will free up
+        slots = sorted(max(0., j.cost - (now - j.start_time)) for j in self.running)
+        slots += [0.] * (self.slots - len(slots))
+        positions = {}
+        while True:
+            nextjob, light_streak = self._pop(classes, light_streak)
+            if nextjob is None:
+                break
+            positions[nextjob] = (len(positions), slots[0])
+            # it takes the soonest free slot
+            slots[0] += nextjob.cost
+            slots.sort()
+        self._positions, self._positions_at = positions, now
+        return positions
+
+    def position(self, job: Job) -> tuple[int, float]:
+        """
+        :return: same as positions(), for one job
+        """
+        return self.positions().get(job, (0, 0.))
+
+
+scheduler = Scheduler(workers)
+
+
+async def enqueue(task: typing.Coroutine, user: int | None = None, guild: int | None = None, cost: float = 1,
+                  on_wait: typing.Callable[[int, float], typing.Awaitable] | None = None):
+    """
+    runs task once the scheduler gives it a slot
+    :param task: the command to run
+    :param user: id of the user who ran it
+    :param guild: id of the guild it was run in, None for DMs
+    :param cost: estimated run time in seconds
+    :param on_wait: if the task has to wait, awaited with (number of commands ahead, estimated wait in seconds) at first
+        and whenever that changes
+    :return: the result of task
+    """
     global queued
     queued += 1
-    # only allows a certain amount of tasks inside the context at once
-    # quick tests show that its roughly FIFO but there are libraries if needed
-    async with sem:
+    try:
+        if not queue_enabled:
+            return await task
+        job = Job(user, guild, cost, asyncio.get_running_loop().create_future())
+        scheduler.submit(job)
         try:
-            res = await task
-        except Exception as e:
-            queued -= 1
-            raise e
-        else:
-            queued -= 1
-            return res
+            last = None
+            while not job.started.done():
+                if on_wait is not None:
+                    ahead, eta = scheduler.position(job)
+                    if (ahead, round(eta)) != last:
+                        last = (ahead, round(eta))
+                        await on_wait(ahead, eta)
+                await asyncio.wait([job.started], timeout=STATUS_INTERVAL)
+        except BaseException:
+            if job.started.done():
+                scheduler.finish(job)
+            else:
+                scheduler.cancel(job)
+            task.close()
+            raise
+        logger.debug(f"Job for user {user} (cost {cost:.1f}) waited {time.monotonic() - job.enqueued:.1f}s")
+        try:
+            return await task
+        finally:
+            scheduler.finish(job)
+    finally:
+        queued -= 1
@@ -0,0 +1,249 @@
+"""
+sends jobs to remote processing workers (see worker.py), so processing isn't limited to the bot's own cores.
+the bot still downloads, normalizes inputs (it's lazy so that's cheap) and uploads. the worker gets
+the input files and the job, runs core.jobs.execute() on it, and streams the result back.
+if no worker has room, can't be reached, or the job can't be sent (ie func is a lambda), it runs locally instead.
+"""
+import asyncio
+import contextlib
+import dataclasses
+import os
+import pickle
+
+import aiofiles
+import aiohttp
+
+import config
+import core.jobs
+from core import queue, tracing
+from core.clogs import logger
+from processing.common import NonBugError, ReturnedNothing, WorkerCrashed
+from processing.ffmpeg.pipeline import Pipeline
+from processing.mediatype import MediaType
+from processing.run_command import job_usage
+from utils.tempfiles import reserve_tempfile, TempFile, TempBudgetExceeded
+from utils.web import get_session, CHUNK_SIZE
+
+remote_workers: list[str] = config.remote_workers if hasattr(config, "remote_workers") else []
+token: str | None = config.remote_worker_token if hasattr(config, "remote_worker_token") else None
+
+PICKLE = "application/x-python-pickle"
+
+# returned by run() when the job should run locally instead
+FALLBACK = object()
+
+# jobs currently running in this process
+local_running = 0
+
+
+class RemoteJobError(Exception):
+    """raised when a worker fails a job with an error that isn't one of ERRORS"""
+    pass
+
+
+# errors that keep their type when a worker sends them back, since they're shown to users differently. errors are
+# sent as json, the bot never unpickles anything a worker sends.
+ERRORS = {cls.__name__: cls for cls in [NonBugError, ReturnedNothing, WorkerCrashed, TempBudgetExceeded]}
+
+
+@dataclasses.dataclass
+class RemoteWorker:
+    url: str
+    slots: int = 0
+    running: int = 0
+    healthy: bool = False
+    _session: aiohttp.ClientSession | None = None
+
+    def __str__(self):
+        return self.url
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if not self.url.startswith("unix:"):
+            return get_session()
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(connector=aiohttp.UnixConnector(path=self.url[len("unix:"):]))
+        return self._session
+
+    def endpoint(self, path: str) -> str:
+        if self.url.startswith("unix:"):
+            # the host doesn't matter over a unix socket
+            return f"http://worker{path}"
+        return self.url.rstrip("/") + path
+
+    @property
+    def free(self) -> int:
+        return self.slots - self.running if self.healthy else 0
+
+
+workers = [RemoteWorker(url) for url in remote_workers]
+
+
+def headers() -> dict:
+    return {"Authorization": f"Bearer {token}"} if token else {}
+
+
+@dataclasses.dataclass
+class WireInput:
+    """
+    everything about an input except its contents, which are sent alongside
+    """
+    ext: str
+    mt: MediaType | None
+    glc: int | None
+    lock_codec: bool
+    # None if the input isn't a Pipeline
+    vfilters: list[str] | None = None
+    afilters: list[str] | None = None
+    predicted: dict | None = None
+
+
+def encode(job: core.jobs.Job) -> tuple[bytes, list[TempFile]]:
+    """
+    :return: the pickled job without its files, and the files to send with it
+    """
+    inputs = []
+    sources = []
+    for file in job.files:
+        source = file.source if isinstance(file, Pipeline) else file
+        wire = WireInput(os.path.splitext(source)[1][1:], source.mt, source.glc, source.lock_codec)
+        if isinstance(file, Pipeline):
+            wire.vfilters, wire.afilters, wire.predicted = file.vfilters, file.afilters, file.predicted
+        inputs.append(wire)
+        sources.append(source)
+    spec = dataclasses.replace(job, files=inputs)
+    return pickle.dumps(spec), sources
+
+
+def decode(spec: core.jobs.Job, files: list[TempFile]) -> core.jobs.Job:
+    """
+    opposite of encode(), on the worker
+    :param spec: the unpickled job
+    :param files: the received files, in order
+    """
+    inputs = []
+    for wire, file in zip(spec.files, files):
+        file.mt, file.glc, file.lock_codec = wire.mt, wire.glc, wire.lock_codec
+        if wire.vfilters is not None:
+            pipeline = Pipeline(file)
+            pipeline.vfilters, pipeline.afilters, pipeline.predicted = wire.vfilters, wire.afilters, wire.predicted
+            inputs.append(pipeline)
+        else:
+            inputs.append(file)
+    return dataclasses.replace(spec, files=inputs)
+
+
+def dump_exception(e: Exception) -> dict:
+    return {"error": type(e).__name__, "message": str(e)}
+
+
+def load_exception(error: dict) -> Exception:
+    if (cls := ERRORS.get(error.get("error"))) is not None:
+        return cls(error.get("message", ""))
+    return RemoteJobError(f"{error.get('error')}: {error.get('message')}")
+
+
+def pick() -> RemoteWorker | None:
+    """
+    :return: the worker with the most free slots, or None if running locally has at least as much room
+    """
+    best = max(workers, key=lambda w: w.free, default=None)
+    if best is None or best.free <= 0 or best.free <= queue.workers - local_running:
+        return None
+    return best
+
+
+async def refresh():
+    """
+    asks every worker how much room it has, and resizes the queue to fit the total
+    """
+
+    async def refresh_one(worker: RemoteWorker):
+        try:
+            async with worker.session.get(worker.endpoint("/status"), headers=headers(),
+                                          timeout=aiohttp.ClientTimeout(total=10)) as resp:
+                resp.raise_for_status()
+                status = await resp.json()
+            if not worker.healthy:
+                logger.info(f"Remote worker {worker} is up with {status['slots']} slots")
+            worker.slots = status["slots"]
+            worker.healthy = True
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError) as e:
+            if worker.healthy:
+                logger.warning(f"Remote worker {worker} is unreachable: {e}")
+            worker.healthy = False
+
+    await asyncio.gather(*[refresh_one(w) for w in workers])
+    queue.scheduler.resize(queue.workers + sum(w.slots for w in workers if w.healthy))
+
+
+async def close():
+    for worker in workers:
+        if worker._session is not None:
+            await worker._session.close()
+
+
+async def run(worker: RemoteWorker, job: core.jobs.Job):
+    """
+    runs a job on a worker
+    :return: the result, or FALLBACK if it should be run locally instead
+    """
+    try:
+        spec, sources = encode(job)
+    except (pickle.PicklingError, AttributeError, TypeError) as e:
+        logger.debug(f"{job.func} can't be sent to a worker, running locally: {e}")
+        return FALLBACK
+    worker.running += 1
+    try:
+        with contextlib.ExitStack() as stack:
+            data = aiohttp.FormData()
+            # the job has to come first, the worker needs it to know what the files are
+            data.add_field("job", spec, content_type=PICKLE)
+            for i, source in enumerate(sources):
+                data.add_field(f"input{i}", stack.enter_context(open(source, "rb")),
+                               filename=os.path.basename(source))
+            logger.info(f"Sending job to remote worker {worker}")
+            async with worker.session.post(worker.endpoint("/job"), data=data, headers=headers(),
+                                           timeout=aiohttp.ClientTimeout(total=None)) as resp:
+                if resp.status == 503:
+                    # it filled up since we last asked
+                    logger.debug(f"Remote worker {worker} is full, running locally")
+                    return FALLBACK
+                if resp.status == 500 and resp.content_type == "application/json":
+                    raise load_exception(await resp.json())
+                resp.raise_for_status()
+                if (usage := job_usage.get()) is not None:
+                    usage.add(float(resp.headers.get("X-Cpu-Seconds", 0)), int(resp.headers.get("X-Peak-Memory", 0)))
+                if resp.headers.get("X-Result") == "file":
+                    result = reserve_tempfile(resp.headers["X-Ext"])
+                    async with aiofiles.open(result, "wb") as f:
+                        async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                            await f.write(chunk)
+                    result.mt = MediaType(resp.headers["X-Media-Type"]) if "X-Media-Type" in resp.headers else None
+                    result.glc = int(resp.headers["X-Gif-Loop-Count"]) if "X-Gif-Loop-Count" in resp.headers else None
+                    result.lock_codec = resp.headers.get("X-Lock-Codec") == "1"
+                    return result
+                return (await resp.json())["result"]
+    except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+        logger.warning(f"Lost connection to remote worker {worker}, running locally: {e}")
+        worker.healthy = False
+        return FALLBACK
+    finally:
+        worker.running -= 1
+
+
+async def execute(job: core.jobs.Job):
+    """
+    runs a job wherever there's the most room
+    """
+    global local_running
+    if (worker := pick()) is not None:
+        with tracing.span("remote", worker=str(worker)):
+            result = await run(worker, job)
+        if result is not FALLBACK:
+            return result
+    local_running += 1
+    try:
+        return await core.jobs.execute(job)
+    finally:
+        local_running -= 1
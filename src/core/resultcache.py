@@ -0,0 +1,144 @@
+"""
+content-addressed cache of command results.
+the same viral media gets captioned/reversed/reposted over and over, so identical commands on identical inputs are
+served straight from disk instead of being processed again.
+"""
+import asyncio
+import glob
+import hashlib
+import json
+import os
+import shutil
+
+import config
+from core.clogs import logger
+from utils.tempfiles import reserve_tempfile
+
+cache_dir = config.result_cache_dir if hasattr(config, "result_cache_dir") else None
+cache_size = config.result_cache_size if hasattr(config, "result_cache_size") else 0
+cache_enabled = bool(cache_dir) and cache_size > 0
+
+hits = 0
+misses = 0
+
+# config values that change what a command outputs
+CONFIG_LIMITS = ["min_size", "max_size", "max_frames", "max_fps", "file_upload_limit", "temp_vcodec", "temp_vpixfmt",
+                 "temp_acodec", "temp_vipscodec"]
+
+
+def init():
+    if cache_enabled:
+        os.makedirs(cache_dir, exist_ok=True)
+        evict()
+
+
+def normalize(arg):
+    """
+    turns an argument into something that's the same across runs of the bot, so it can be hashed
+    """
+    if callable(arg):
+        return f"{getattr(arg, '__module__', '')}.{getattr(arg, '__qualname__', repr(arg))}"
+    if isinstance(arg, (list, tuple)):
+        return [normalize(a) for a in arg]
+    if isinstance(arg, dict):
+        return {str(k): normalize(v) for k, v in sorted(arg.items())}
+    if isinstance(arg, (str, int, float, bool)) or arg is None:
+        return arg
+    return repr(arg)
+
+
+def hash_file(file) -> str:
+    with open(file, "rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+async def cache_key(files: list, func: callable, args: tuple, kwargs: dict, resize: bool,
+                    duration_exempt: bool = False) -> str | None:
+    """
+    :param duration_exempt: if the inputs skip max_frames/max_fps, like the bot owner's do in ensuresize.normalize
+    :return: key for this job, or None if it shouldn't be cached
+    """
+    if not cache_enabled or getattr(func, "uncacheable", False):
+        return None
+    file_hashes = await asyncio.gather(*[asyncio.to_thread(hash_file, f) for f in files])
+    keydata = {
+        "inputs": file_hashes,
+        "func": normalize(func),
+        "args": normalize(args),
+        "kwargs": normalize(kwargs),
+        "resize": resize,
+        "duration_exempt": duration_exempt,
+        "config": {k: getattr(config, k, None) for k in CONFIG_LIMITS}
+    }
+    return hashlib.sha256(json.dumps(keydata, sort_keys=True, default=repr).encode()).hexdigest()
+
+
+def _lookup(key: str) -> str | None:
+    found = glob.glob(os.path.join(cache_dir, f"{key}.*"))
+    if not found:
+        return None
+    # mark as recently used
+    os.utime(found[0])
+    return found[0]
+
+
+async def get(key: str):
+    """
+    :return: a tempfile copy of the cached result, or None on a miss
+    """
+    global hits, misses
+    cached = await asyncio.to_thread(_lookup, key)
+    if cached is None:
+        misses += 1
+        return None
+    hits += 1
+    logger.info(f"Result cache hit for {key}")
+    out = reserve_tempfile(os.path.splitext(cached)[1][1:])
+    # copy so eviction can't delete it out from under the upload
+    await asyncio.to_thread(shutil.copyfile, cached, out)
+    return out
+
+
+def _store(key: str, file: str):
+    ext = os.path.splitext(file)[1][1:] or "bin"
+    dest = os.path.join(cache_dir, f"{key}.{ext}")
+    # write under a different name then rename so a half-written file is never served
+    partial = dest + ".partial"
+    shutil.copyfile(file, partial)
+    os.replace(partial, dest)
+    evict()
+
+
+async def put(key: str, file: str):
+    try:
+        await asyncio.to_thread(_store, key, file)
+    except OSError as e:
+        logger.warning(f"Failed to cache result {file}: {e}")
+
+
+def entries() -> list[os.DirEntry]:
+    with os.scandir(cache_dir) as it:
+        return [e for e in it if e.is_file() and not e.name.endswith(".partial")]
+
+
+def total_size() -> int:
+    if not cache_enabled:
+        return 0
+    return sum(e.stat().st_size for e in entries())
+
+
+def evict():
+    """
+    removes least recently used results until the cache is within config.result_cache_size
+    """
+    files = sorted(entries(), key=lambda e: e.stat().st_mtime)
+    size = sum(e.stat().st_size for e in files)
+    for entry in files:
+        if size <= cache_size:
+            break
+        size -= entry.stat().st_size
+        try:
+            os.remove(entry.path)
+            logger.debug(f"Evicted {entry.name} from result cache")
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,205 @@
+"""
+lightweight tracing of where a command's time goes.
+core.process starts a trace for every command and wraps each stage in a span, every run_command is a child span of
+whatever stage ran it. finished traces of the last `trace_history` commands are kept for the "trace" owner command,
+and can be written as OTLP JSON (the format the OpenTelemetry collector's file receiver and most tracing backends
+import) to `trace_export_dir`.
+"""
+import collections
+import contextlib
+import contextvars
+import dataclasses
+import json
+import os
+import secrets
+import time
+
+import config
+from core.clogs import logger
+
+trace_history = config.trace_history if hasattr(config, "trace_history") else 100
+export_dir = config.trace_export_dir if hasattr(config, "trace_export_dir") else None
+
+# per trace. commands that run a subprocess per frame would otherwise keep thousands of spans
+MAX_SPANS = 1000
+# width of the bars in waterfall()
+WATERFALL_WIDTH = 40
+
+
+@dataclasses.dataclass
+class Span:
+    name: str
+    parent_id: str | None = None
+    span_id: str = dataclasses.field(default_factory=lambda: secrets.token_hex(8))
+    # unix nanoseconds
+    start: int = dataclasses.field(default_factory=time.time_ns)
+    end: int | None = None
+    attributes: dict = dataclasses.field(default_factory=dict)
+    error: str | None = None
+
+    @property
+    def duration(self) -> float:
+        """in seconds, so far if it hasn't ended"""
+        return ((self.end or time.time_ns()) - self.start) / 1e9
+
+
+@dataclasses.dataclass
+class Trace:
+    # id of the message that ran the command, same as processing.run_command.job_id
+    job: str
+    trace_id: str = dataclasses.field(default_factory=lambda: secrets.token_hex(16))
+    spans: list[Span] = dataclasses.field(default_factory=list)
+    dropped: int = 0
+
+    @property
+    def root(self) -> Span:
+        return self.spans[0]
+
+    def add(self, span: Span):
+        if len(self.spans) < MAX_SPANS:
+            self.spans.append(span)
+        else:
+            self.dropped += 1
+
+
+# job -> trace, oldest first
+traces: collections.OrderedDict[str, Trace] = collections.OrderedDict()
+current_trace: contextvars.ContextVar[Trace | None] = contextvars.ContextVar("current_trace", default=None)
+current_span: contextvars.ContextVar[Span | None] = contextvars.ContextVar("current_span", default=None)
+
+
+def start_trace(job: str, name: str, **attributes) -> tuple:
+    """
+    starts tracing everything the current task does. pass the return value to finish_trace().
+    """
+    trace = Trace(job)
+    root = Span(name, attributes=attributes)
+    trace.add(root)
+    return current_trace.set(trace), current_span.set(root)
+
+
+def finish_trace(tokens: tuple, error: BaseException | None = None):
+    trace = current_trace.get()
+    trace_token, span_token = tokens
+    current_span.reset(span_token)
+    current_trace.reset(trace_token)
+    if trace is None:
+        return
+    trace.root.end = time.time_ns()
+    if error is not None:
+        trace.root.error = f"{type(error).__name__}: {error}"
+    traces[trace.job] = trace
+    while len(traces) > trace_history:
+        traces.popitem(last=False)
+    if export_dir:
+        try:
+            os.makedirs(export_dir, exist_ok=True)
+            with open(os.path.join(export_dir, f"{trace.job}.json"), "w") as f:
+                json.dump(otlp(trace), f)
+        except OSError as e:
+            logger.warning(f"Failed to export trace {trace.job}: {e}")
+
+
+@contextlib.contextmanager
+def span(name: str, **attributes):
+    """
+    times the code inside as a child of the current span. does nothing outside a trace.
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield None
+        return
+    parent = current_span.get()
+    s = Span(name, parent.span_id if parent else None, attributes=attributes)
+    trace.add(s)
+    token = current_span.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        s.end = time.time_ns()
+        current_span.reset(token)
+
+
+def add_span(name: str, start: int, end: int, **attributes):
+    """
+    records something that already happened as a child of the current span, ie time spent waiting in the queue
+    :param start: unix nanoseconds
+    :param end: unix nanoseconds
+    """
+    trace = current_trace.get()
+    if trace is None:
+        return
+    parent = current_span.get()
+    trace.add(Span(name, parent.span_id if parent else None, start=start, end=end, attributes=attributes))
+
+
+def waterfall(trace: Trace) -> str:
+    """
+    :return: the trace as text, one span per line under its parent, with a bar showing when it ran
+    """
+    children = collections.defaultdict(list)
+    for s in trace.spans:
+        children[s.parent_id].append(s)
+    root = trace.root
+    total = max(root.duration, 1e-9)
+    lines = []
+
+    def walk(s: Span, depth: int):
+        offset = (s.start - root.start) / 1e9
+        begin = min(WATERFALL_WIDTH - 1, int(offset / total * WATERFALL_WIDTH))
+        length = max(1, min(WATERFALL_WIDTH - begin, round(s.duration / total * WATERFALL_WIDTH)))
+        bar = " " * begin + "#" * length + " " * (WATERFALL_WIDTH - begin - length)
+        label = ("  " * depth + s.name)[:40]
+        lines.append(f"{label:<40} {offset * 1000:>8.0f}ms {s.duration * 1000:>8.0f}ms |{bar}|"
+                     f"{' ERROR' if s.error else ''}")
+        for child in sorted(children[s.span_id], key=lambda c: c.start):
+            walk(child, depth + 1)
+
+    walk(root, 0)
+    if trace.dropped:
+        lines.append(f"({trace.dropped} more spans not recorded)")
+    return "\n".join(lines)
+
+
+def otlp_value(value) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        # int64s are strings in OTLP JSON
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def otlp(trace: Trace) -> dict:
+    """
+    :return: the trace as an OTLP JSON ExportTraceServiceRequest
+    """
+    spans = []
+    for s in trace.spans:
+        attributes = {"mediaforge.job": trace.job} | s.attributes
+        out = {
+            "traceId": trace.trace_id,
+            "spanId": s.span_id,
+            "name": s.name,
+            # internal
+            "kind": 1,
+            "startTimeUnixNano": str(s.start),
+            "endTimeUnixNano": str(s.end or time.time_ns()),
+            "attributes": [{"key": k, "value": otlp_value(v)} for k, v in attributes.items()],
+            # 1 is ok, 2 is error
+            "status": {"code": 2, "message": s.error} if s.error else {"code": 1},
+        }
+        if s.parent_id:
+            out["parentSpanId"] = s.parent_id
+        spans.append(out)
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": "mediaforge"}}]},
+            "scopeSpans": [{"scope": {"name": "mediaforge"}, "spans": spans}]
+        }]
+    }
@@ -39,6 +39,11 @@ except ModuleNotFoundError as e:
 
 # project files
 import core.database
+import core.remote
+import core.resultcache
+import processing.common
+import processing.cost
+import utils.web
 from utils.common import *
 from core.clogs import logger
 import config
@@ -51,6 +56,9 @@ from cog.errorhandler import ErrorHandlerCog
 from cog.status import StatusCog
 from cog.bgpot import BgPot
 from cog.heartbeat import Heartbeat
+from cog.metrics import Metrics, metrics_port
+from cog.remoteworkers import RemoteWorkers
+from cog.tempsweeper import TempSweeper
 
 from commands.caption import Caption
 from commands.conversion import Conversion
@@ -132,6 +140,13 @@ def initdbsync():
         cur = syncdb.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='bans'")
         if not cur.fetchall():
             syncdb.execute("create table bans ( user int not null constraint bans_pk primary key, banreason text );  ")
+        cur = syncdb.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='op_costs'")
+        if not cur.fetchall():
+            syncdb.execute(
+                "create table op_costs ( op text not null constraint op_costs_pk primary key, runs int not null, "
+                "cpu_n real, cpu_sx real, cpu_sy real, cpu_sxx real, cpu_sxy real, "
+                "mem_n real, mem_sx real, mem_sy real, mem_sxx real, mem_sxy real );"
+            )
     syncdb.close()
 
 
@@ -139,17 +154,30 @@ def init():
     initdbsync()
     downloadttsvoices()
     tempfiles.init()
+    core.resultcache.init()
 
 
 class MyBot(commands.AutoShardedBot):
+    async def close(self):
+        await super().close()
+        await core.remote.close()
+        await utils.web.close_session()
+        processing.common.shutdown_pool()
+
     async def setup_hook(self):
         logger.debug(f"initializing cogs")
         await core.database.init_database()
+        await processing.cost.load()
         if config.bot_list_data:
             logger.info("bot list data found. botblock will start when bot is ready.")
             await bot.add_cog(DiscordListsPost(bot))
         else:
             logger.debug("no bot list data found")
+        if core.remote.workers:
+            logger.info(f"{len(core.remote.workers)} remote workers configured.")
+            await bot.add_cog(RemoteWorkers(bot))
+        if metrics_port is not None:
+            await bot.add_cog(Metrics(bot))
         await asyncio.gather(
             bot.add_cog(Caption(bot)),
             bot.add_cog(Media(bot)),
@@ -162,7 +190,8 @@ class MyBot(commands.AutoShardedBot):
             bot.add_cog(CommandChecksCog(bot)),
             bot.add_cog(BotEventsCog(bot)),
             bot.add_cog(BgPot(bot)),
-            bot.add_cog(Heartbeat(bot))
+            bot.add_cog(Heartbeat(bot)),
+            bot.add_cog(TempSweeper(bot))
         )
 
 
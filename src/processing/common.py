@@ -1,9 +1,17 @@
 import asyncio
 import concurrent.futures
+import concurrent.futures.process
 import functools
+import glob
+import multiprocessing
+import os
+import time
 import typing
 
+import config
 import utils.tempfiles
+from core.clogs import logger
+from processing.run_command import job_usage
 from utils.tempfiles import handle_tfs_parallel
 
 
@@ -18,19 +26,146 @@ class ReturnedNothing(Exception):
     pass
 
 
+class WorkerCrashed(Exception):
+    """raised by run_parallel() when the worker process died, usually from a segfault"""
+    pass
+
+
+def uncacheable(func):
+    """
+    marks a function whose output isn't determined by its inputs (ie it uses randomness), so process() never caches
+    its results
+    """
+    func.uncacheable = True
+    return func
+
+
+def frame_function(image_func: typing.Callable):
+    """
+    registers an in-memory version of a per-frame function used with processing.ffmpeg.handleanimated.
+    image_func takes a pyvips.Image (and the same args as the decorated function) and returns a pyvips.Image. it can
+    be sync or async. when it exists, animated media is streamed through it frame by frame instead of every frame
+    being written to disk. sync ones run in threads of this process, so they have to release the GIL (pyvips does) to
+    use more than one core.
+    """
+
+    def decorator(func):
+        func.image_func = image_func
+        return func
+
+    return decorator
+
+
+def deterministic(func):
+    """
+    marks a per-frame function whose output depends only on the frame and its args, so
+    processing.ffmpeg.handleanimated only runs its frame_function once per unique frame and reuses the output for
+    repeats. only streamed frames are deduplicated, so it does nothing without a frame_function.
+    """
+    func.deterministic = True
+    return func
+
+
+def _init_worker(temp_dir: str, spill_dir: str | None):
+    """
+    runs once in every worker process when it starts, so the first job each worker gets doesn't pay for it
+    """
+    # the parent's temp dirs may not be the default, ie in worker.py
+    utils.tempfiles.temp_dir = temp_dir
+    utils.tempfiles.spill_dir = spill_dir
+    # make it so exceptions in the worker are sent back with their traceback
+    from tblib import pickling_support
+    pickling_support.install()
+    import pyvips
+    # fontconfig scans fonts the first time text is rendered with each one
+    for font in glob.glob("rendering/fonts/*"):
+        try:
+            pyvips.Image.text(".", fontfile=font).avg()
+        except pyvips.Error:
+            pass
+    # decoded once per worker and kept in memory, template() hands these out instead of loading the file again
+    for image in glob.glob("rendering/images/**/*.*", recursive=True):
+        try:
+            _templates[os.path.normpath(image)] = pyvips.Image.new_from_file(image).copy_memory()
+        except pyvips.Error:
+            pass
+
+
+# path -> decoded template image, preloaded in each worker
+_templates = {}
+
+
+def template(path: str):
+    """
+    :param path: an image under rendering/images
+    :return: it as a pyvips.Image, already decoded if this worker preloaded it
+    """
+    if (im := _templates.get(os.path.normpath(path))) is not None:
+        return im
+    import pyvips
+    return pyvips.Image.new_from_file(path)
+
+
+_pool: concurrent.futures.ProcessPoolExecutor | None = None
+
+
+def new_pool(size: int | None = None) -> concurrent.futures.ProcessPoolExecutor:
+    # spawn, not fork. forking a process that has the event loop and discord's threads running isnt safe
+    return concurrent.futures.ProcessPoolExecutor(size, mp_context=multiprocessing.get_context("spawn"),
+                                                  initializer=_init_worker,
+                                                  initargs=(utils.tempfiles.temp_dir, utils.tempfiles.spill_dir))
+
+
+def get_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = new_pool(config.render_workers if hasattr(config, "render_workers") and config.render_workers else None)
+    return _pool
+
+
+def shutdown_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=False, cancel_futures=True)
+    _pool = None
+
+
 async def run_parallel(syncfunc: typing.Callable, *args, **kwargs):
     """
-    uses concurrent.futures.ProcessPoolExecutor to run CPU-bound functions in their own process
+    runs CPU-bound functions (pyvips, PIL, etc) in a long lived pool of worker processes. if a worker crashes (ie a
+    libvips segfault), every job in the pool fails with it, so the pool is replaced and each of those jobs is retried
+    once in a process of its own. only the one that crashes again raises WorkerCrashed, instead of the whole bot dying.
+    syncfunc and its args must be picklable.
 
     :param syncfunc: the blocking function
     :return: the result of the blocking function
     """
-    # this is only used for essentially async code that just isnt asyncio, ie pyvips and ffmpeg, so a threadpool
-    # executor is fine
-    with concurrent.futures.ThreadPoolExecutor(1) as pool:
-        success, res, files = await asyncio.get_running_loop().run_in_executor(
-            pool, functools.partial(handle_tfs_parallel, syncfunc, *args, **kwargs)
-        )
+    pool = get_pool()
+    loop = asyncio.get_running_loop()
+    call = functools.partial(handle_tfs_parallel, syncfunc, *args, **kwargs)
+    started = time.perf_counter()
+    try:
+        try:
+            success, res, files = await loop.run_in_executor(pool, call)
+        except concurrent.futures.process.BrokenProcessPool:
+            # a broken pool can't be used again, the next call makes a new one
+            if _pool is pool:
+                logger.error(f"Worker process crashed running {syncfunc}, restarting pool.")
+                shutdown_pool()
+            # there's no telling which job crashed it. alone, the one that did can't take any others down again
+            logger.info(f"Retrying {syncfunc} in its own process.")
+            isolated = new_pool(1)
+            try:
+                success, res, files = await loop.run_in_executor(isolated, call)
+            except concurrent.futures.process.BrokenProcessPool as e:
+                raise WorkerCrashed(f"The worker process running `{getattr(syncfunc, '__name__', syncfunc)}` "
+                                    f"crashed.") from e
+            finally:
+                isolated.shutdown(wait=False)
+    finally:
+        # the worker is busy the whole time, so this is close to its cpu time
+        if (usage := job_usage.get()) is not None:
+            usage.add(time.perf_counter() - started)
     if files:
         tfs = utils.tempfiles.session.get()
         tfs += files
@@ -39,6 +174,3 @@ async def run_parallel(syncfunc: typing.Callable, *args, **kwargs):
         return res
     else:
         raise res
-
-
-
@@ -0,0 +1,188 @@
+"""
+predicts how much cpu time and memory a job will take before it runs.
+every op (the command's function) has its own linear model of cpu seconds against megapixel-frames processed and of
+peak memory against megapixels per frame. the models are fit from real runs, measured through
+processing.run_command.job_usage, and saved in the database so they survive restarts.
+"""
+import dataclasses
+import math
+
+import aiosqlite
+
+import config
+from core import database
+from core.clogs import logger
+from processing.ffmpeg.ffprobe import get_resolution, get_duration, get_frame_rate
+from processing.mediatype import VIDEO, GIF, IMAGE
+from processing.run_command import Usage
+
+# older runs count for less, so the models follow changes to hardware/code
+DECAY = 0.98
+# runs an op needs before its own model is trusted over the default one
+MIN_SAMPLES = 3
+# used until there's data. cpu seconds = 1 + 0.02 per megapixel-frame, memory = 100MB + 50MB per megapixel
+DEFAULT_CPU = (1., 0.02)
+DEFAULT_MEMORY = (100_000_000., 50_000_000.)
+
+# jobs estimated to take more cpu seconds than this are refused. None for no limit.
+max_job_cost = config.max_job_cost if hasattr(config, "max_job_cost") else None
+
+
+@dataclasses.dataclass
+class Features:
+    """
+    what's known about a job's inputs from probing them
+    """
+    # sum of width * height * frames of every input, in megapixels
+    megapixel_frames: float = 0
+    # biggest width * height of any input, in megapixels
+    megapixels: float = 0
+
+
+@dataclasses.dataclass
+class Estimate:
+    cpu_seconds: float
+    peak_memory: int
+    # True if this came from the op's own runs
+    learned: bool
+
+
+@dataclasses.dataclass
+class LinearFit:
+    """
+    exponentially weighted least squares fit of y = a + b * x
+    """
+    n: float = 0
+    sx: float = 0
+    sy: float = 0
+    sxx: float = 0
+    sxy: float = 0
+
+    def add(self, x: float, y: float):
+        self.n = self.n * DECAY + 1
+        self.sx = self.sx * DECAY + x
+        self.sy = self.sy * DECAY + y
+        self.sxx = self.sxx * DECAY + x * x
+        self.sxy = self.sxy * DECAY + x * y
+
+    def coefficients(self, default: tuple[float, float]) -> tuple[float, float]:
+        if self.n <= 0:
+            return default
+        denom = self.n * self.sxx - self.sx * self.sx
+        # every run had (nearly) the same input size, so only the average is known
+        if math.isclose(denom, 0, abs_tol=1e-9):
+            return self.sy / self.n, 0
+        b = (self.n * self.sxy - self.sx * self.sy) / denom
+        # more work never takes less time
+        b = max(b, 0)
+        a = (self.sy - b * self.sx) / self.n
+        return max(a, 0), b
+
+    def predict(self, x: float, default: tuple[float, float]) -> float:
+        a, b = self.coefficients(default)
+        return a + b * x
+
+
+@dataclasses.dataclass
+class OpModel:
+    cpu: LinearFit = dataclasses.field(default_factory=LinearFit)
+    memory: LinearFit = dataclasses.field(default_factory=LinearFit)
+    runs: int = 0
+
+
+models: dict[str, OpModel] = {}
+
+
+def op_name(func: callable, args: tuple = ()) -> str:
+    """
+    :return: name of the op a command runs. generic runners (ie animatedmultiplexer) are named with the function they
+        run, since that's what decides the cost.
+    """
+    name = f"{func.__module__}.{func.__qualname__}"
+    for arg in args:
+        if callable(arg):
+            name += f"/{arg.__module__}.{arg.__qualname__}"
+            break
+    return name
+
+
+async def features(files: list) -> Features:
+    """
+    :param files: the job's inputs. for lazy Pipelines (ie after ensuresize.normalize) it's what they'll be once their
+        filters run, as far as that's known without running them.
+    """
+    feats = Features()
+    for file in files:
+        mt = await file.mediatype()
+        if mt not in [VIDEO, GIF, IMAGE]:
+            continue
+        # never materialize here, this runs before the job is queued. anything unknown is taken from the source.
+        planned = getattr(file, "predicted", {})
+        source = getattr(file, "source", file)
+        # an estimate must never fail a job that would otherwise run, so what can't be probed is left at the defaults
+        try:
+            w, h = planned.get("resolution") or await get_resolution(source)
+        except Exception as e:
+            logger.debug(f"can't get the resolution of {file} for its cost: {e}")
+            continue
+        megapixels = w * h / 1_000_000
+        frames = 1
+        if mt != IMAGE:
+            try:
+                duration = planned.get("duration") or await get_duration(source)
+                fps = planned.get("fps") or await get_frame_rate(source)
+                frames = max(1., duration * fps)
+            except Exception as e:
+                # same as ensuresize.normalize, ie media with no duration that isn't an apng either
+                logger.debug(f"can't get the length of {file} for its cost: {e}")
+        feats.megapixel_frames += megapixels * frames
+        feats.megapixels = max(feats.megapixels, megapixels)
+    return feats
+
+
+def estimate(op: str, feats: Features) -> Estimate:
+    model = models.get(op)
+    learned = model is not None and model.runs >= MIN_SAMPLES
+    if not learned:
+        model = OpModel()
+    return Estimate(model.cpu.predict(feats.megapixel_frames, DEFAULT_CPU),
+                    round(model.memory.predict(feats.megapixels, DEFAULT_MEMORY)),
+                    learned)
+
+
+async def estimate_job(func: callable, args: tuple, files: list) -> Estimate:
+    return estimate(op_name(func, args), await features(files))
+
+
+async def record(op: str, feats: Features, usage: Usage):
+    """
+    update op's model with a finished run
+    """
+    if not usage.commands:
+        # ran entirely in python in the bot process, nothing was measured
+        return
+    model = models.setdefault(op, OpModel())
+    model.cpu.add(feats.megapixel_frames, usage.cpu_seconds)
+    if usage.peak_memory:
+        model.memory.add(feats.megapixels, usage.peak_memory)
+    model.runs += 1
+    logger.debug(f"{op} took {usage.cpu_seconds:.2f} cpu seconds for {feats.megapixel_frames:.1f} megapixel-frames")
+    try:
+        await database.db.execute(
+            "REPLACE INTO op_costs(op, runs, cpu_n, cpu_sx, cpu_sy, cpu_sxx, cpu_sxy, mem_n, mem_sx, mem_sy, mem_sxx, "
+            "mem_sxy) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)",
+            (op, model.runs, *dataclasses.astuple(model.cpu), *dataclasses.astuple(model.memory)))
+        await database.db.commit()
+    except aiosqlite.Error as e:
+        logger.warning(f"Failed to save cost model for {op}: {e}")
+
+
+async def load():
+    """
+    load learned models from the database
+    """
+    async with database.db.execute("SELECT op, runs, cpu_n, cpu_sx, cpu_sy, cpu_sxx, cpu_sxy, mem_n, mem_sx, mem_sy, "
+                                   "mem_sxx, mem_sxy FROM op_costs") as cur:
+        async for row in cur:
+            models[row[0]] = OpModel(LinearFit(*row[2:7]), LinearFit(*row[7:12]), row[1])
+    logger.debug(f"Loaded cost models for {len(models)} ops")
@@ -1,13 +1,37 @@
+import math
+import os
+
+import humanize
+import pyvips
+
+import config
+import processing.common
+import processing.vips.gif
 from config import temp_vipscodec
-from processing.ffmpeg.ffprobe import va_codecs, get_acodec, get_vcodec, get_frame_rate
+from core.clogs import logger
+from processing.common import NonBugError
+from processing.ffmpeg.ffprobe import va_codecs, get_acodec, get_vcodec, get_frame_rate, get_resolution, \
+    get_duration
 from processing.mediatype import VIDEO, AUDIO, IMAGE, GIF
 from processing.run_command import run_command
-from utils.tempfiles import reserve_tempfile
+from utils.tempfiles import reserve_tempfile, output_limit, TempBudgetExceeded
+
+# what encodes gifs, "ffmpeg" or "vips". see processing.vips.gif
+gif_engine = config.gif_engine if hasattr(config, "gif_engine") else "ffmpeg"
+# gifs hardly ever take less than this many bytes per pixel of every frame, so with a target size there's no point
+# decoding more pixels than would fit at this rate
+GIF_MIN_BYTES_PER_PIXEL = 0.02
 
 
-async def videotogif(video):
+async def videotogif(video, target_size: int | None = None):
+    """
+    :param target_size: with the vips engine, make the gif fit in this many bytes. the ffmpeg engine ignores it, it's
+        up to ensuresize.intelligentdownsize to retry smaller.
+    """
     if (await get_vcodec(video))["codec_name"] == "gif":
         return video
+    if use_vips_gif():
+        return await vips_videotogif(video, target_size)
     outname = reserve_tempfile("gif")
     fps = await get_frame_rate(video)
     lc = await video.gif_loop_count()
@@ -41,15 +65,61 @@ async def videotogif(video):
     return outname
 
 
-async def video_reencode(
-        video):  # reencodes mp4 as libx264 since the png format used cant be played by like literally anything
+def use_vips_gif() -> bool:
+    global gif_engine
+    if gif_engine == "vips" and not processing.vips.gif.available():
+        logger.warning(f"gif_engine is vips but libvips {pyvips.version(0)}.{pyvips.version(1)} can't do everything "
+                       f"it needs (8.15+ built with cgif), using ffmpeg.")
+        gif_engine = "ffmpeg"
+    return gif_engine == "vips"
+
+
+async def vips_videotogif(video, target_size: int | None = None):
+    """
+    videotogif() with processing.vips.gif. ffmpeg just decodes the frames.
+    """
+    fps = min(await get_frame_rate(video), 50)
+    lc = await video.gif_loop_count()
+    w, h = await get_resolution(video)
+    n_frames = max(1, math.ceil(fps * (await get_duration(video) or 1)))
+    if target_size is not None:
+        # decoding at full size only to shrink it in memory wastes both
+        scale = min(1., math.sqrt(target_size / GIF_MIN_BYTES_PER_PIXEL / (w * h * n_frames)))
+        w, h = max(1, round(w * scale)), max(1, round(h * scale))
+    # every frame is dumped uncompressed, which is a lot, so don't start if it can't fit
+    raw_size = w * h * 4 * n_frames
+    if (limit := output_limit()) is not None and raw_size > limit:
+        raise TempBudgetExceeded(f"Converting this to a gif needs about {humanize.naturalsize(raw_size)} of temporary "
+                                 f"storage space. Try shorter or smaller media.")
+    frames = reserve_tempfile("rgba", size_hint=raw_size)
+    # constant frame rate, gif frames all get the same delay. the scale makes sure frames are the size vips is told
+    await run_command("ffmpeg", "-hide_banner", "-i", video, "-vf", f"fps=fps={fps},scale={w}:{h}", "-f", "rawvideo",
+                      "-pix_fmt", "rgba", frames)
+    outname = reserve_tempfile("gif")
+    # ffmpeg's loop count is how many times it repeats, -1 being never. vips' is how many times it plays.
+    size = await processing.common.run_parallel(processing.vips.gif.encode, frames, w, h, fps,
+                                                0 if lc == 0 else max(1, lc + 1), outname, target_size)
+    if target_size is not None and size > target_size:
+        raise NonBugError(f"Unable to fit {video} within {humanize.naturalsize(target_size)}")
+    return outname
+
+
+async def video_reencode(video, bitrate: int | None = None):
+    """
+    reencodes mp4 as libx264 since the png format used cant be played by like literally anything
+    :param bitrate: cap the video to this many bits per second, instead of the default quality
+    """
     assert (mt := await video.mediatype()) in [VIDEO, GIF], f"file {video} with type {mt} passed to reencode()"
     # only reencode if need to ;)
     vcodec, acodec = await va_codecs(video)
-    vcode = ["copy"] if vcodec == "h264" else ["libx264", "-pix_fmt", "yuv420p", "-vf",
-                                               "scale=ceil(iw/2)*2:ceil(ih/2)*2,"
-                                               # turns transparency into blackness
-                                               "premultiply=inplace=1"]
+    vcode = ["copy"] if vcodec == "h264" and bitrate is None else \
+        ["libx264", "-pix_fmt", "yuv420p", "-vf",
+         "scale=ceil(iw/2)*2:ceil(ih/2)*2,"
+         # turns transparency into blackness
+         "premultiply=inplace=1"]
+    if bitrate is not None:
+        # one pass, so the rate control can't be as exact as twopasscapvideo's, but it's close
+        vcode += ["-b:v", str(bitrate), "-maxrate", str(bitrate), "-bufsize", str(bitrate * 2)]
     acode = ["copy"] if acodec == "aac" else ["aac", "-q:a", "2"]
     outname = reserve_tempfile("mp4")
     await run_command("ffmpeg", "-hide_banner", "-i", video, "-c:v", *vcode, "-c:a", *acode,
@@ -66,9 +136,33 @@ async def audio_reencode(audio):
     return outname
 
 
+# media type -> extension -> (video codec, audio codec) that discord shows inline. None means no stream
+UPLOADABLE = {
+    IMAGE: {"png": {("png", None)}, "jpg": {("mjpeg", None)}, "jpeg": {("mjpeg", None)}},
+    VIDEO: {"mp4": {("h264", "aac"), ("h264", None)}},
+    GIF: {"gif": {("gif", None)}},
+    AUDIO: {"m4a": {(None, "aac")}, "mp3": {(None, "mp3")}},
+}
+
+
+async def uploadable(file) -> bool:
+    """
+    if the file can be uploaded as-is, so allreencode() would only spend time making an equivalent copy of it.
+    only needs the probe, nothing is run.
+    """
+    mt = await file.mediatype()
+    ext = os.path.splitext(file)[1][1:].lower()
+    if (allowed := UPLOADABLE.get(mt, {}).get(ext)) is None:
+        return False
+    return await va_codecs(file) in allowed
+
+
 async def allreencode(file):
     if file.lock_codec:
         return file
+    if await uploadable(file):
+        logger.debug(f"{file} is already uploadable, passing it through")
+        return file
     mt = await file.mediatype()
     if mt == IMAGE:
         return await mediatopng(file)
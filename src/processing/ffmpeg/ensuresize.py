@@ -13,12 +13,15 @@ import config
 import utils
 from core.clogs import logger
 from processing.common import NonBugError, ReturnedNothing
-from processing.ffmpeg.conversion import allreencode
-from processing.ffmpeg.ffprobe import get_frame_rate, get_duration, get_resolution, is_apng
+from processing.ffmpeg.conversion import allreencode, toapng, use_vips_gif, vips_videotogif, uploadable, \
+    video_reencode
+from processing.ffmpeg.ffprobe import get_duration, get_resolution, is_apng, get_vcodec, get_mediainfo, \
+    hasaudio, count_frames
 from processing.ffmpeg.ffutils import changefps, trim, resize
+from processing.ffmpeg.pipeline import Pipeline
 from processing.mediatype import VIDEO, IMAGE, GIF
 from processing.run_command import run_command
-from utils.tempfiles import reserve_tempfile
+from utils.tempfiles import reserve_tempfile, TempFile
 
 
 async def edit_msg_with_webhookmessage_polyfill(msg: typing.Union[discord.Message, discord.WebhookMessage],
@@ -38,58 +41,67 @@ async def edit_msg_with_webhookmessage_polyfill(msg: typing.Union[discord.Messag
         await msg.edit(**kwargs, delete_after=delete_after)
 
 
-async def ensureduration(media, ctx: commands.Context):
+TOLERANCES = [.98, .95, .90, .75, .5, .25, .1]
+
+
+# the audio never gets more than this fraction of the size, or less than MIN_AUDIO_BITRATE
+MAX_AUDIO_SHARE = 0.25
+MIN_AUDIO_BITRATE = 32000
+# bitrates tried by twopasscapvideo before giving up
+MAX_ATTEMPTS = 6
+# a fitting video this close to the limit is good enough, the rest isn't worth another encode
+GOOD_ENOUGH = 0.9
+# at most this many second passes run at once, and only if there's roughly this many idle cores for each
+MAX_CANDIDATES = 3
+CORES_PER_ENCODE = 4
+
+
+def idle_encode_slots() -> int:
     """
-    ensures that media is under or equal to the config minimum frame count and fps
-    :param media: media to trim
-    :param ctx: discord context
-    :return: processed media or original media, within config.max_frames
+    :return: how many encodes there's idle cpu for right now, at least 1
     """
-    if await ctx.bot.is_owner(ctx.author):
-        logger.debug(f"bot owner is exempt from duration checks.")
-        return media
-    if await media.mediatype() not in [VIDEO, GIF]:
-        return media
-    max_fps = config.max_fps if hasattr(config, "max_fps") else None
-    fps = await get_frame_rate(media)
-    if fps > max_fps:
-        logger.debug(f"Capping FPS of {media} from {fps} to {max_fps}")
-        media = await changefps(media, max_fps)
-    # the function that splits frames actually has a vsync thing so this is more accurate to what's generated
-    max_frames = config.max_frames if hasattr(config, "max_frames") else None
-    fps = await get_frame_rate(media)
     try:
-        dur = await get_duration(media)
-    except Exception as e:
-        dur = 0
-        logger.debug(e)
-    frames = int(fps * dur)
-    if max_frames is None or frames <= max_frames:
-        return media
-    else:
-        newdur = max_frames / fps
-        tmsg = f"{config.emojis['warning']} input file is too long (~{frames} frames)! " \
-               f"Trimming to {round(newdur, 1)}s (~{max_frames} frames)..."
-        logger.debug(tmsg)
-        msg = await ctx.reply(tmsg)
-        media = await trim(media, newdur)
-        try:
-            await edit_msg_with_webhookmessage_polyfill(msg, delete_after=5, content=tmsg + " Done!")
-        except discord.NotFound as e:
-            logger.debug(e)
-        return media
+        idle = (os.cpu_count() or 1) - os.getloadavg()[0]
+    except (AttributeError, OSError):
+        # no load average on windows
+        return 1
+    return max(1, min(MAX_CANDIDATES, int(idle // CORES_PER_ENCODE)))
 
 
-TOLERANCES = [.98, .95, .90, .75, .5, .25, .1]
+def next_bitrate(tried: dict[int, int], maxsize: int) -> int | None:
+    """
+    picks the next bitrate to try, from the sizes of the ones already tried
+    :param tried: bitrate -> resulting size
+    :return: the bitrate, or None if there's nothing left between what fits and what doesn't
+    """
+    aim = maxsize * (1 + GOOD_ENOUGH) / 2
+    fits = [(b, s) for b, s in tried.items() if s < maxsize]
+    over = [(b, s) for b, s in tried.items() if s >= maxsize]
+    lo = max(fits) if fits else None
+    hi = min(over) if over else None
+    if lo and hi:
+        # size is close to linear in bitrate between two close tries
+        bitrate = lo[0] + (aim - lo[1]) * (hi[0] - lo[0]) / (hi[1] - lo[1])
+        bitrate = min(max(bitrate, lo[0]), hi[0])
+    else:
+        # only one side known, scale it. size isn't proportional to bitrate at the extremes so aim lower when too big
+        b, size = lo or hi
+        bitrate = b * aim / size * (1 if lo else GOOD_ENOUGH)
+    bitrate = int(bitrate)
+    if bitrate in tried or bitrate <= 0 or (lo and hi and hi[0] - lo[0] <= 1000):
+        return None
+    return bitrate
 
 
 async def twopasscapvideo(video, maxsize: int, audio_bitrate=128000):
     """
-    attempts to intelligently cap video filesize with two pass encoding
+    attempts to intelligently cap video filesize with two pass encoding.
+    the first pass is run once, and the second pass searches for the bitrate that gets closest under maxsize, using
+    the sizes of earlier tries.
 
     :param video: video file (str path)
     :param maxsize: max size (in bytes) of output file
-    :param audio_bitrate: optionally specify an audio bitrate in bits per second
+    :param audio_bitrate: optionally specify an audio bitrate in bits per second. it's lowered for small targets
     :return: new video file below maxsize
     """
     if (size := os.path.getsize(video)) < maxsize:
@@ -98,59 +110,204 @@ async def twopasscapvideo(video, maxsize: int, audio_bitrate=128000):
     duration = await get_duration(video)
     # bytes to bits
     target_total_bitrate = (maxsize * 8) / duration
-    for tolerance in TOLERANCES:
-        target_video_bitrate = (target_total_bitrate - audio_bitrate) * tolerance
-        if target_video_bitrate <= 0:
-            raise NonBugError("Cannot fit video into Discord.")
-        logger.info(f"trying to force {video} ({humanize.naturalsize(size)}) "
-                    f"under {humanize.naturalsize(maxsize)} with tolerance {tolerance}. "
-                    f"trying {humanize.naturalsize(target_video_bitrate / 8)}/s")
-        pass1log = utils.tempfiles.temp_file_name()
-        outfile = reserve_tempfile("mp4")
-        await run_command('ffmpeg', '-y', '-i', video, '-c:v', 'h264', "-pix_fmt", "yuv420p", '-b:v', str(target_video_bitrate), '-pass', '1',
-                          '-f', 'mp4', '-passlogfile', pass1log,
+    if await hasaudio(video):
+        # a short target is better with worse audio than not at all
+        audio_bitrate = int(max(MIN_AUDIO_BITRATE, min(audio_bitrate, target_total_bitrate * MAX_AUDIO_SHARE)))
+    else:
+        audio_bitrate = 0
+    # everything left for video. the tolerances are applied to this once, by the candidates below
+    video_budget = target_total_bitrate - audio_bitrate
+    # with idle cores, the first round also tries lower bitrates in case the first one is too big
+    bitrates = [int(video_budget * t) for t in TOLERANCES[:idle_encode_slots()]]
+    if bitrates[0] <= 0:
+        raise NonBugError("Cannot fit video into Discord.")
+    logger.info(f"trying to force {video} ({humanize.naturalsize(size)}) under {humanize.naturalsize(maxsize)}, "
+                f"starting at {humanize.naturalsize(bitrates[0] / 8)}/s "
+                f"with {humanize.naturalsize(audio_bitrate / 8)}/s audio")
+    pass1log = utils.tempfiles.temp_file_name()
+    try:
+        # the first pass only analyses the video, its stats are good for any target bitrate
+        await run_command('ffmpeg', '-y', '-i', video, '-c:v', 'h264', "-pix_fmt", "yuv420p",
+                          '-b:v', str(bitrates[0]), '-pass', '1', '-an', '-f', 'mp4', '-passlogfile', pass1log,
                           'NUL' if sys.platform == "win32" else "/dev/null")
-        await run_command('ffmpeg', '-i', video, '-c:v', 'h264', "-pix_fmt", "yuv420p", '-b:v', str(target_video_bitrate), '-pass', '2',
-                          '-passlogfile', pass1log, '-c:a', 'aac', '-b:a', str(audio_bitrate), "-f", "mp4", "-movflags",
-                          "+faststart", outfile)
+
+        async def second_pass(bitrate: int) -> tuple[int, TempFile]:
+            outfile = reserve_tempfile("mp4")
+            await run_command('ffmpeg', '-i', video, '-c:v', 'h264', "-pix_fmt", "yuv420p", '-b:v', str(bitrate),
+                              '-pass', '2', '-passlogfile', pass1log,
+                              *(['-c:a', 'aac', '-b:a', str(audio_bitrate)] if audio_bitrate else ['-an']),
+                              "-f", "mp4", "-movflags", "+faststart", outfile)
+            size = os.path.getsize(outfile)
+            logger.info(f"{humanize.naturalsize(bitrate / 8)}/s is {humanize.naturalsize(size)}")
+            return size, outfile
+
+        # bitrate -> (size, file)
+        tried: dict[int, tuple[int, TempFile]] = {}
+        while bitrates and len(tried) < MAX_ATTEMPTS:
+            for bitrate, result in zip(bitrates, await asyncio.gather(*[second_pass(b) for b in bitrates])):
+                tried[bitrate] = result
+            fits = [b for b, (s, _) in tried.items() if s < maxsize]
+            if fits and tried[max(fits)][0] >= maxsize * GOOD_ENOUGH:
+                break
+            bitrate = next_bitrate({b: s for b, (s, _) in tried.items()}, maxsize)
+            bitrates = [] if bitrate is None else [bitrate]
+    finally:
         # log files are pass1log-N.log and pass1log-N.log.mbtree where N is an int, easiest to just glob them all
         for f in glob.glob(pass1log + "*"):
             reserve_tempfile(f)
-        if (size := os.path.getsize(outfile)) < maxsize:
-            logger.info(f"successfully created {humanize.naturalsize(size)} video!")
-            return outfile
-        else:
-            logger.info(f"tolerance {tolerance} failed. output is {humanize.naturalsize(size)}")
-    raise NonBugError(f"Unable to fit {video} within {humanize.naturalsize(maxsize)}")
+    fits = [b for b, (s, _) in tried.items() if s < maxsize]
+    if not fits:
+        raise NonBugError(f"Unable to fit {video} within {humanize.naturalsize(maxsize)}")
+    size, outfile = tried[max(fits)]
+    logger.info(f"successfully created {humanize.naturalsize(size)} video!")
+    return outfile
+
+
+# animated media is sampled as this many runs of consecutive frames, spread evenly. single frames far apart would
+# lose what the encoder saves between similar neighbouring frames, and predict too big.
+SAMPLE_RUNS = 4
+SAMPLE_RUN_FRAMES = 4
+# stills with more pixels than this are sampled as SAMPLE_TILES x SAMPLE_TILES tiles, each a quarter of its cell
+SAMPLE_MIN_PIXELS = 1_000_000
+SAMPLE_TILES = 2
+# scales the sample is encoded at, relative to the first guess
+SAMPLE_SCALES = [1.25, 1, 0.75]
+# aim this far under the limit
+SAMPLE_MARGIN = 0.92
+# if the full encode comes out smaller than this much of the target, it's worth trying again bigger
+SAMPLE_UNDERSHOOT = 0.7
+
+
+async def tile_sample(image) -> tuple[TempFile, float]:
+    """
+    crops tiles from across a still and puts them together into one smaller image
+    :return: the sample and the fraction of pixels in it
+    """
+    w, h = await get_resolution(image)
+    w, h = int(w), int(h)
+    if w * h <= SAMPLE_MIN_PIXELS:
+        return image, 1
+    n = SAMPLE_TILES
+    tw, th = max(1, w // (n * 2)), max(1, h // (n * 2))
+    crops = []
+    layout = []
+    for row in range(n):
+        for col in range(n):
+            # centered in its cell
+            x = col * w // n + (w // n - tw) // 2
+            y = row * h // n + (h // n - th) // 2
+            crops.append(f"[t{len(crops)}]crop={tw}:{th}:{x}:{y}[c{len(crops)}]")
+            layout.append(f"{'+'.join(['w0'] * col) or 0}_{'+'.join(['h0'] * row) or 0}")
+    graph = (f"[0:v]split={n * n}{''.join(f'[t{i}]' for i in range(n * n))};" + ";".join(crops) + ";"
+             + "".join(f"[c{i}]" for i in range(n * n)) + f"xstack=inputs={n * n}:layout={'|'.join(layout)}")
+    sample = reserve_tempfile("png")
+    await run_command("ffmpeg", "-hide_banner", "-i", image, "-filter_complex", graph, "-frames:v", "1", sample)
+    return sample, (n * tw) * (n * th) / (w * h)
+
+
+async def frame_sample(media) -> tuple[TempFile, float]:
+    """
+    takes runs of consecutive frames from across animated media, or tiles from across a big still, to encode instead
+    of all of it
+    :return: the sample and the fraction of the media in it
+    """
+    if await media.mediatype() == IMAGE:
+        return await tile_sample(media)
+    frames = await count_frames(media)
+    run = SAMPLE_RUN_FRAMES
+    if frames <= SAMPLE_RUNS * run * 2:
+        return media, 1
+    every = frames // SAMPLE_RUNS
+    sample = reserve_tempfile("mkv")
+    await run_command("ffmpeg", "-hide_banner", "-i", media, "-vf", f"select='lt(mod(n,{every}),{run})'", "-an",
+                      "-c:v", config.temp_vcodec, "-pix_fmt", config.temp_vpixfmt, "-fps_mode", "vfr", sample)
+    return sample, sum(min(run, frames - start) for start in range(0, frames, every)) / frames
+
+
+def fit_scale(sizes: dict[float, float], target: float) -> float:
+    """
+    fits size = c * scale^k (bytes per pixel changes with scale, so k isn't just 2) and solves it for target
+    :param sizes: scale -> predicted full size at that scale
+    :return: the largest scale predicted to fit within target, at most 1
+    """
+    points = [(math.log(scale), math.log(size)) for scale, size in sizes.items() if size > 0]
+    n = len(points)
+    mx = sum(x for x, _ in points) / n
+    my = sum(y for _, y in points) / n
+    sxx = sum((x - mx) ** 2 for x, _ in points)
+    # more pixels never means a smaller file, so the slope is kept positive. with one scale, assume size ~ pixels
+    k = max(sum((x - mx) * (y - my) for x, y in points) / sxx, 0.5) if sxx else 2
+    return min(1., math.exp(mx + (math.log(target) - my) / k))
 
 
 async def intelligentdownsize(media, original, maxsize: int):
     """
-    tries to intelligently downsize media to fit within maxsize
+    tries to intelligently downsize media to fit within maxsize.
+    a sample of it is encoded at a few scales to fit how size changes with scale, then the whole thing is encoded once
+    at the largest scale predicted to fit, with at most one correction, down if it didn't fit or up if it came out well
+    under.
 
     :param media: media path str
+    :param original: what to actually downsize, ie before it was encoded
     :param maxsize: max size in bytes
     :return: new media file below maxsize
     """
-    apng = await is_apng(media)
     size = os.path.getsize(media)
-    w, h = await get_resolution(media)
-    for tolerance in TOLERANCES:
-        reduction_ratio = (maxsize / size) * tolerance
-        # redoing this
-        scale_factor = math.sqrt(reduction_ratio)
-        new_w = int(w * scale_factor)
-        new_h = int(h * scale_factor)
-
-        logger.info(f"trying to resize from {w}x{h} to {new_w}x{new_h} "
-                    f"(tolerance {tolerance}: ~{reduction_ratio} reduction)")
-        resized = await resize(original, new_w, new_h, re_encode=True, input_is_apng=apng)
-        if (newsize := os.path.getsize(resized)) < maxsize:
-            logger.info(f"successfully created {humanize.naturalsize(newsize)} media!")
-            return resized
+    if size < maxsize:
+        return media
+    apng = await is_apng(media) or await is_apng(original)
+    mt = await original.mediatype()
+    if not apng and mt == GIF and use_vips_gif():
+        # it hits the size itself, without decoding the original again for every try
+        return await vips_videotogif(original, maxsize)
+    w, h = await get_resolution(original)
+
+    async def encode(source, scale: float):
+        # the sample of a still is smaller than it
+        sw, sh = (w, h) if source is original else await get_resolution(source)
+        resized = await resize(source, max(1, int(sw * scale)), max(1, int(sh * scale)))
+        if apng:
+            return await toapng(resized)
+        resized.mt = mt
+        return await allreencode(resized)
+
+    target = maxsize * SAMPLE_MARGIN
+    guess = min(1., math.sqrt(target / size))
+    sample, fraction = await frame_sample(original)
+    scales = [min(1., guess * s) for s in SAMPLE_SCALES]
+    outputs = await asyncio.gather(*[encode(sample, scale) for scale in scales])
+    sizes = {scale: os.path.getsize(out) / fraction for scale, out in zip(scales, outputs)}
+    if fraction == 1:
+        # the sample was all of it, so these are real encodes and one may already fit
+        fits = [scale for scale, out in zip(scales, outputs) if os.path.getsize(out) < maxsize]
+        if fits:
+            out = outputs[scales.index(max(fits))]
+            logger.info(f"successfully created {humanize.naturalsize(os.path.getsize(out))} media!")
+            return out
+    scale = fit_scale(sizes, target)
+    fitting = None
+    for _ in range(2):
+        logger.info(f"resizing from {w}x{h} to {int(w * scale)}x{int(h * scale)} to fit in "
+                    f"{humanize.naturalsize(maxsize)}")
+        out = await encode(original, scale)
+        newsize = os.path.getsize(out)
+        if newsize < maxsize:
+            fitting = out
+            if newsize >= target * SAMPLE_UNDERSHOOT or scale >= 1:
+                break
+            logger.info(f"prediction was off, output is only {humanize.naturalsize(newsize)}")
+            scale = min(1., scale * math.sqrt(target / newsize))
+        elif fitting is not None:
+            # going bigger overshot, the smaller one still fits
+            break
         else:
-            logger.info(f"tolerance {tolerance} failed. output is {humanize.naturalsize(newsize)}")
-    raise NonBugError(f"Unable to fit {media} within {humanize.naturalsize(maxsize)}")
+            logger.info(f"prediction was off, output is {humanize.naturalsize(newsize)}")
+            # correct from the real size
+            scale *= math.sqrt(target / newsize)
+    if fitting is None:
+        raise NonBugError(f"Unable to fit {media} within {humanize.naturalsize(maxsize)}")
+    logger.info(f"successfully created {humanize.naturalsize(os.path.getsize(fitting))} media!")
+    return fitting
 
 
 async def assurefilesize(media, original=None):
@@ -183,45 +340,207 @@ async def assurefilesize(media, original=None):
         raise NonBugError(f"File is too big to upload.")
 
 
-async def ensuresize(ctx, file, minsize, maxsize):
+# output bytes per input byte of allreencode() for each (media type, input video codec), learned from every final
+# encode. input size is the stand in for content complexity, noisy media is bigger losslessly and encoded.
+size_ratios: dict[tuple, float] = {}
+# until there's data. temp files are lossless so the final encode is a lot smaller, except for single png frames
+DEFAULT_SIZE_RATIOS = {VIDEO: 0.05, GIF: 0.3, IMAGE: 0.6}
+# weight of older encodes
+RATIO_DECAY = 0.8
+# aim this far under the limit, so a slightly bad prediction doesn't need a corrective pass
+PREDICTION_MARGIN = 0.85
+# same as twopasscapvideo's
+AUDIO_BITRATE = 128000
+
+
+async def audio_bytes(media) -> float:
     """
-    Ensures valid media is between minsize and maxsize in resolution
-    :param ctx: discord context
-    :param file: media
-    :param minsize: minimum width/height in pixels
-    :param maxsize: maximum height in pixels
-    :return: original or resized media
+    :return: roughly how much of the file is audio, from the audio stream's bitrate
+    """
+    info = await get_mediainfo(media)
+    if not info.has_audio:
+        return 0
+    return int(info.audio_stream.get("bit_rate") or 0) * (await get_duration(media) or 0) / 8
+
+
+async def predict_size(media) -> tuple[float, tuple]:
+    """
+    predicts the size of allreencode(media) without running it
+    :return: predicted bytes, and the key of the ratio used so the real size can be learned with learn_size()
+    """
+    mt = await media.mediatype()
+    vcodec = (await get_vcodec(media) or {}).get("codec_name")
+    key = (mt, vcodec)
+    ratio = size_ratios.get(key, DEFAULT_SIZE_RATIOS.get(mt, 1))
+    size = os.path.getsize(media)
+    if mt == VIDEO:
+        # audio is encoded to a known bitrate, only the video depends on the content
+        duration = await get_duration(media) or 0
+        return (size - await audio_bytes(media)) * ratio + duration * AUDIO_BITRATE / 8, key
+    return size * ratio, key
+
+
+def learn_size(key: tuple, in_bytes: float, out_bytes: float):
+    if in_bytes <= 0:
+        return
+    ratio = out_bytes / in_bytes
+    old = size_ratios.get(key)
+    size_ratios[key] = ratio if old is None else old * RATIO_DECAY + ratio * (1 - RATIO_DECAY)
+    logger.debug(f"final encode size ratio of {key} is now {size_ratios[key]:.3f}")
+
+
+async def finalize(media):
+    """
+    the final encode of a command's output, sized to fit within config.file_upload_limit.
+    the output size is predicted before encoding, and the bitrate or resolution is picked so it fits in one encode.
+    only if the prediction was wrong does assurefilesize() do a corrective pass.
+    :param media: the command's output
+    :return: uploadable media within the upload limit
+    """
+    limit = config.file_upload_limit
+    mt = await media.mediatype()
+    if media.lock_codec or mt not in [VIDEO, GIF, IMAGE] or await uploadable(media) or await is_apng(media):
+        return await assurefilesize(await allreencode(media), media)
+    predicted, key = await predict_size(media)
+    target = limit * PREDICTION_MARGIN
+    logger.info(f"predicted final size of {media} is {humanize.naturalsize(predicted)}")
+    if predicted <= target:
+        out = await allreencode(media)
+        in_bytes = os.path.getsize(media)
+        out_bytes = os.path.getsize(out)
+        if mt == VIDEO:
+            in_bytes -= await audio_bytes(media)
+            out_bytes -= (await get_duration(media) or 0) * AUDIO_BITRATE / 8
+        learn_size(key, in_bytes, out_bytes)
+    elif mt == VIDEO:
+        duration = await get_duration(media)
+        bitrate = int((target * 8 / duration - AUDIO_BITRATE) if duration else 0)
+        if bitrate <= 0:
+            raise NonBugError("Cannot fit video into Discord.")
+        logger.info(f"capping {media} to {humanize.naturalsize(bitrate / 8)}/s to fit")
+        out = await video_reencode(media, bitrate)
+    elif mt == GIF and use_vips_gif():
+        return await vips_videotogif(media, limit)
+    else:
+        # pixels, so size, scale with the square of the resolution
+        scale = math.sqrt(target / predicted)
+        w, h = await get_resolution(media)
+        new_w, new_h = max(1, int(w * scale)), max(1, int(h * scale))
+        logger.info(f"resizing {media} from {w}x{h} to {new_w}x{new_h} to fit")
+        resized = await resize(media, new_w, new_h)
+        resized.mt = mt
+        out = await allreencode(resized)
+        learn_size(key, os.path.getsize(media) * scale ** 2, os.path.getsize(out))
+    # corrective pass if the prediction missed
+    return await assurefilesize(out, media)
+
+
+def scale_to(w, h, new_w=None, new_h=None, cap=None):
+    """
+    works out the other dimension when scaling while keeping aspect ratio, like -1 does in ffmpeg's scale filter
+    :param w: current width
+    :param h: current height
+    :param new_w: new width, or None to calculate it
+    :param new_h: new height, or None to calculate it
+    :param cap: optional maximum for the calculated dimension
+    :return: [width, height]
+    """
+    if new_h is None:
+        new_h = max(1, round(h * new_w / w))
+        if cap is not None:
+            new_h = min(new_h, cap)
+    else:
+        new_w = max(1, round(w * new_h / h))
+        if cap is not None:
+            new_w = min(new_w, cap)
+    return [new_w, new_h]
+
+
+def plan_size(w, h, minsize, maxsize) -> tuple[int, int] | None:
+    """
+    works out what resolution media should be resized to so it's between minsize and maxsize
+    :return: [width, height], or None if it's fine as is
     """
     resized = False
-    if await file.mediatype() not in [IMAGE, VIDEO, GIF]:
-        return file
-    w, h = await get_resolution(file)
-    owidth = w
-    oheight = h
     if w < minsize:
-        # the min(-1,maxsize) thing is to prevent a case where someone puts in like a 1x1000 image and it gets resized
+        # the cap is to prevent a case where someone puts in like a 1x1000 image and it gets resized
         # to 200x200000 which is very large so even though it wont preserve aspect ratio it's an edge case anyways
-
-        file = await resize(file, minsize, f"min(-1, {maxsize * 2})")
-        w, h = await get_resolution(file)
+        w, h = scale_to(w, h, new_w=minsize, cap=maxsize * 2)
         resized = True
     if h < minsize:
-        file = await resize(file, f"min(-1, {maxsize * 2})", minsize)
-        w, h = await get_resolution(file)
+        w, h = scale_to(w, h, new_h=minsize, cap=maxsize * 2)
         resized = True
-    # if await ctx.bot.is_owner(ctx.author):
-    #     logger.debug(f"bot owner is exempt from downsize checks")
-    #     return file
     if w > maxsize:
-        file = await resize(file, maxsize, "-1")
-        w, h = await get_resolution(file)
+        w, h = scale_to(w, h, new_w=maxsize)
         resized = True
     if h > maxsize:
-        file = await resize(file, "-1", maxsize)
-        w, h = await get_resolution(file)
+        w, h = scale_to(w, h, new_h=maxsize)
         resized = True
-    if resized:
-        logger.info(f"Resized from {owidth}x{oheight} to {w}x{h}")
-        await ctx.reply(f"Resized input media from {int(owidth)}x{int(oheight)} to {int(w)}x{int(h)}.", delete_after=5,
-                        mention_author=False)
-    return file
+    return (w, h) if resized else None
+
+
+def plan_duration(fps, duration, max_fps=None, max_frames=None) -> tuple[float | None, float | None, int]:
+    """
+    works out how to keep media within max_fps and max_frames
+    :return: fps to cap to or None, duration to trim to or None, and the number of frames before trimming
+    """
+    new_fps = None
+    if max_fps is not None and fps > max_fps:
+        new_fps = fps = max_fps
+    frames = int(fps * (duration or 0))
+    if max_frames is None or frames <= max_frames:
+        return new_fps, None, frames
+    return new_fps, max_frames / fps, frames
+
+
+async def normalize(ctx: commands.Context, media, minsize: int | None, maxsize: int | None):
+    """
+    ensures media is between minsize and maxsize in resolution and within config.max_fps and config.max_frames.
+    everything is worked out up front from one probe and added to one lazy pipeline, so it's at most one ffmpeg pass
+    (or none, if the command's own filters fuse onto it).
+    :param ctx: discord context
+    :param media: media, a file or a Pipeline
+    :param minsize: minimum width/height in pixels, or None to not resize
+    :param maxsize: maximum width/height in pixels, or None to not resize
+    :return: Pipeline of the original or normalized media
+    """
+    if not isinstance(media, Pipeline):
+        media = Pipeline(media)
+    mt = await media.mediatype()
+    if mt not in [IMAGE, VIDEO, GIF]:
+        return media
+    # dimensions are worked out here instead of in ffmpeg so that the whole thing stays one lazy pipeline
+    if minsize is not None and maxsize is not None:
+        w, h = await media.resolution()
+        if (size := plan_size(w, h, minsize, maxsize)) is not None:
+            media = await resize(media, *size)
+            logger.info(f"Resized from {w}x{h} to {size[0]}x{size[1]}")
+            await ctx.reply(f"Resized input media from {int(w)}x{int(h)} to {int(size[0])}x{int(size[1])}.",
+                            delete_after=5, mention_author=False)
+    if mt == IMAGE:
+        return media
+    if await ctx.bot.is_owner(ctx.author):
+        logger.debug(f"bot owner is exempt from duration checks.")
+        return media
+    try:
+        dur = await media.duration()
+    except Exception as e:
+        dur = 0
+        logger.debug(e)
+    max_frames = config.max_frames if hasattr(config, "max_frames") else None
+    new_fps, newdur, frames = plan_duration(await media.frame_rate(), dur,
+                                            config.max_fps if hasattr(config, "max_fps") else None, max_frames)
+    if new_fps is not None:
+        logger.debug(f"Capping FPS of {media} to {new_fps}")
+        media = await changefps(media, new_fps)
+    if newdur is not None:
+        tmsg = f"{config.emojis['warning']} input file is too long (~{frames} frames)! " \
+               f"Trimming to {round(newdur, 1)}s (~{max_frames} frames)..."
+        logger.debug(tmsg)
+        msg = await ctx.reply(tmsg)
+        media = await trim(media, newdur)
+        try:
+            await edit_msg_with_webhookmessage_polyfill(msg, delete_after=5, content=tmsg + " Done!")
+        except discord.NotFound as e:
+            logger.debug(e)
+    return media
@@ -1,24 +1,28 @@
-import json
 import sys
 
-import apng
-
 import config
+from processing.ffmpeg.mediainfo import MediaInfo, probe
 from processing.run_command import run_command
 from utils import trymagic
-from utils.tempfiles import reserve_tempfile
+from utils.tempfiles import reserve_tempfile, TempFile
 from processing.common import *
 from core.clogs import logger
 
 
-async def is_apng(filename):
-    out = await run_command("ffprobe", filename, "-v", "panic", "-select_streams", "v:0", "-print_format", "json",
-                            "-show_entries", "stream=codec_name")
-    data = json.loads(out)
-    if len(data["streams"]):  # 0 if audio file because it selects v:0, audio cannot be apng
-        return data["streams"][0]["codec_name"] == "apng"
+async def get_mediainfo(filename) -> MediaInfo:
+    """
+    gets the MediaInfo of a file, reusing the one cached on the TempFile if possible
+    :param filename: filename
+    :return: MediaInfo
+    """
+    if isinstance(filename, TempFile):
+        return await filename.mediainfo()
     else:
-        return False
+        return await probe(filename)
+
+
+async def is_apng(filename):
+    return (await get_mediainfo(filename)).is_apng
 
 
 # https://askubuntu.com/questions/110264/how-to-find-frames-per-second-of-any-video-file
@@ -29,25 +33,7 @@ async def get_frame_rate(filename):
     :return: FPS
     """
     logger.info("Getting FPS...")
-    out = await run_command("ffprobe", filename, "-v", "panic", "-select_streams", "v:0", "-print_format", "json",
-                            "-show_entries", "stream=r_frame_rate,codec_name")
-    data = json.loads(out)
-    if data["streams"][0]["codec_name"] == "apng":  # ffmpeg no likey apng
-        parsedapng = apng.APNG.open(filename)
-        apnglen = 0
-        # https://wiki.mozilla.org/APNG_Specification#.60fcTL.60:_The_Frame_Control_Chunk
-        for png, control in parsedapng.frames:
-            if control.delay_den == 0:
-                control.delay_den = 100
-            apnglen += control.delay / control.delay_den
-        return len(parsedapng.frames) / apnglen
-    else:
-        rate = data["streams"][0]["r_frame_rate"].split("/")
-        if len(rate) == 1:
-            return float(rate[0])
-        if len(rate) == 2:
-            return float(rate[0]) / float(rate[1])
-        return -1
+    return (await get_mediainfo(filename)).frame_rate
 
 
 # https://superuser.com/questions/650291/how-to-get-video-duration-in-seconds
@@ -58,20 +44,7 @@ async def get_duration(filename):
     :return: duration
     """
     logger.info("Getting duration...")
-    out = await run_command("ffprobe", "-v", "panic", "-show_entries", "format=duration", "-of",
-                            "default=noprint_wrappers=1:nokey=1", filename)
-    if out == "N/A":  # happens with APNGs
-        # no garuntee that its an APNG here but i dont have any other plans so i want it to raise an exception
-        parsedapng = apng.APNG.open(filename)
-        apnglen = 0
-        # https://wiki.mozilla.org/APNG_Specification#.60fcTL.60:_The_Frame_Control_Chunk
-        for png, control in parsedapng.frames:
-            if control.delay_den == 0:
-                control.delay_den = 100
-            apnglen += control.delay / control.delay_den
-        return apnglen
-    else:
-        return float(out)
+    return (await get_mediainfo(filename)).duration
 
 
 async def get_resolution(filename):
@@ -80,19 +53,7 @@ async def get_resolution(filename):
     :param filename: filename
     :return: [width, height]
     """
-    out = await run_command("ffprobe", "-v", "panic", "-select_streams", "v:0", "-show_entries",
-                            "stream=width,height:stream_tags=rotate",
-                            "-print_format", "json", filename)
-    out = json.loads(out)
-    w = out["streams"][0]["width"]
-    h = out["streams"][0]["height"]
-    # if rotated in metadata, swap width and height
-    if "tags" in out["streams"][0]:
-        if "rotate" in out["streams"][0]["tags"]:
-            rot = float(out["streams"][0]["tags"]["rotate"])
-            if rot % 90 == 0 and not rot % 180 == 0:
-                w, h = h, w
-    return [w, h]
+    return (await get_mediainfo(filename)).resolution
 
 
 async def get_vcodec(filename):
@@ -101,15 +62,8 @@ async def get_vcodec(filename):
     :param filename: filename
     :return: dict containing "codec_name" and "codec_long_name"
     """
-    out = await run_command("ffprobe", "-v", "panic", "-select_streams", "v:0", "-show_entries",
-                            "stream=codec_name,codec_long_name",
-                            "-print_format", "json", filename)
-    out = json.loads(out)
-    if out["streams"]:
-        return out["streams"][0]
-    else:
-        # only checks for video codec, audio files return Nothinng
-        return None
+    # only checks for video codec, audio files return Nothinng
+    return (await get_mediainfo(filename)).vcodec
 
 
 async def get_acodec(filename):
@@ -118,42 +72,41 @@ async def get_acodec(filename):
     :param filename: filename
     :return: dict containing "codec_name" and "codec_long_name"
     """
-    out = await run_command("ffprobe", "-v", "panic", "-select_streams", "a:0", "-show_entries",
-                            "stream=codec_name,codec_long_name",
-                            "-print_format", "json", filename)
-    out = json.loads(out)
-    if out["streams"]:
-        return out["streams"][0]
-    else:
-        return None
+    return (await get_mediainfo(filename)).acodec
 
 
 async def va_codecs(filename):
-    out = await run_command('ffprobe', '-v', 'panic', '-show_entries', 'stream=codec_name,codec_type', '-print_format',
-                            'json', filename)
-    out = json.loads(out)
-    acodec = None
-    vcodec = None
-    if out["streams"]:
-        for stream in out["streams"]:
-            if stream["codec_type"] == "video" and vcodec is None:
-                vcodec = stream["codec_name"]
-            elif stream["codec_type"] == "audio" and acodec is None:
-                acodec = stream["codec_name"]
+    info = await get_mediainfo(filename)
+    if info.streams:
+        vcodec = info.vcodec["codec_name"] if info.vcodec else None
+        acodec = info.acodec["codec_name"] if info.acodec else None
         return vcodec, acodec
     else:
         return None
 
 
+async def get_sample_rate(filename):
+    """
+    gets the sample rate of the first audio stream
+    :param filename: filename
+    :return: sample rate in Hz, or None if there is no audio
+    """
+    return (await get_mediainfo(filename)).sample_rate
+
+
 async def ffprobe(file):
     return [await run_command("ffprobe", "-hide_banner", file), trymagic.from_file(file, mime=False),
             trymagic.from_file(file, mime=True)]
 
 
 async def count_frames(video):
-    # https://stackoverflow.com/a/28376817/9044183
-    return int(await run_command("ffprobe", "-v", "error", "-select_streams", "v:0", "-count_packets", "-show_entries",
-                                 "stream=nb_read_packets", "-of", "csv=p=0", video))
+    info = await get_mediainfo(video)
+    if info.packet_count is None:
+        # https://stackoverflow.com/a/28376817/9044183
+        info.packet_count = int(await run_command("ffprobe", "-v", "error", "-select_streams", "v:0",
+                                                  "-count_packets", "-show_entries", "stream=nb_read_packets",
+                                                  "-of", "csv=p=0", video))
+    return info.packet_count
 
 
 async def frame_n(video, n: int):
@@ -170,5 +123,4 @@ async def frame_n(video, n: int):
 
 
 async def hasaudio(video):
-    return bool(
-        await run_command("ffprobe", "-i", video, "-show_streams", "-select_streams", "a", "-loglevel", "panic"))
+    return (await get_mediainfo(video)).has_audio
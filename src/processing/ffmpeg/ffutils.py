@@ -1,4 +1,5 @@
 import asyncio
+import functools
 import glob
 import math
 
@@ -10,29 +11,39 @@ import processing.mediatype
 import processing.vips as vips
 from core.clogs import logger
 from processing.common import NonBugError
-from processing.ffmpeg.conversion import videotogif, mediatotempimage, toapng, allreencode
-from processing.ffmpeg.ffprobe import get_duration, hasaudio, get_resolution, is_apng
+from processing.ffmpeg.conversion import mediatotempimage
+from processing.ffmpeg.ffprobe import get_duration, hasaudio, get_resolution
+from processing.ffmpeg.pipeline import Pipeline, fusable
 from processing.mediatype import VIDEO, IMAGE, GIF
-from processing.run_command import run_command
+from processing.run_command import run_command, PipeSource
 from utils.tempfiles import reserve_tempfile, TempFile
 
 
-async def forceaudio(video):
+async def forceaudio_source(video):
     """
-    gives videos with no audio a silent audio stream
+    gives videos with no audio a silent audio stream, without running anything yet
     :param video: file
-    :return: video filename
+    :return: the video, or a PipeSource to pass to run_command() in its place
     """
     if await hasaudio(video):
         return video
     else:
-        outname = reserve_tempfile("mkv")
-        await run_command("ffmpeg", "-hide_banner", "-i", video, "-f", "lavfi", "-i", "anullsrc", "-c:v",
-                          config.temp_vcodec, "-pix_fmt", config.temp_vpixfmt,
-                          "-c:a", config.temp_acodec, "-map", "0:v", "-map", "1:a", "-shortest",
-                          "-fps_mode", "vfr", outname)
+        return PipeSource("ffmpeg", "-hide_banner", "-i", video, "-f", "lavfi", "-i", "anullsrc",
+                          "-map", "0:v", "-map", "1:a", "-shortest", "-fps_mode", "vfr")
 
-        return outname
+
+async def forceaudio(video):
+    """
+    gives videos with no audio a silent audio stream
+    :param video: file
+    :return: video filename
+    """
+    source = await forceaudio_source(video)
+    if not isinstance(source, PipeSource):
+        return source
+    outname = reserve_tempfile("mkv")
+    await run_command(*source.args, *source.output_args(), outname)
+    return outname
 
 
 def gif_output(f):
@@ -40,6 +51,7 @@ def gif_output(f):
     if the input is a gif, make the output a gif
     """
 
+    @functools.wraps(f)
     async def wrapper(media: TempFile, *args, **kwargs):
         mt = await media.mediatype()
         out = await f(media, *args, **kwargs)
@@ -56,6 +68,7 @@ def dual_gif_output(f):
     if there are two gifs, make the output a gif if its a good idea
     """
 
+    @functools.wraps(f)
     async def wrapper(media1, media2, *args, **kwargs):
         mt1 = await media1.mediatype()
         mt2 = await media2.mediatype()
@@ -84,7 +97,6 @@ async def naive_vstack(file0, file1):
                           "[1]format=pix_fmts=rgba[1f];"
                           "[0f][1f]vstack=inputs=2", "-c:v", config.temp_vcodec, "-pix_fmt",
                           config.temp_vpixfmt,
-                          # "-fs", config.max_temp_file_size,
                           "-fps_mode", "vfr", out)
 
         if VIDEO not in mts:  # gif and image only
@@ -113,31 +125,23 @@ def expanded_atempo(arg: float):
         return ",".join([atempo for _ in range(numofatempos)])
 
 
-@gif_output
-async def crop(file, w, h, x, y):
-    outname = reserve_tempfile("mkv")
-    await run_command('ffmpeg', '-i', file, '-filter:v', f'crop={w}:{h}:{x}:{y}', "-c:v",
-                      config.temp_vcodec, "-pix_fmt", config.temp_vpixfmt, outname)
-    return outname
+@fusable
+async def crop(file: Pipeline, w, h, x, y):
+    return file.video(f'crop={w}:{h}:{x}:{y}', resolution=None)
 
 
-@gif_output
-async def trim_top(file, trim_size):
-    outname = reserve_tempfile("mkv")
-    await run_command('ffmpeg', '-i', file, '-filter:v', f'crop=out_h=ih-{trim_size}:y={trim_size}', "-c:v",
-                      config.temp_vcodec, "-pix_fmt", config.temp_vpixfmt,
-                      "-fps_mode", "vfr",
-                      outname)
-    return outname
+@fusable
+async def trim_top(file: Pipeline, trim_size):
+    return file.video(f'crop=out_h=ih-{trim_size}:y={trim_size}', resolution=None)
 
 
 @dual_gif_output
 async def naive_overlay(im1, im2):
     mts = [await im1.mediatype(), await im2.mediatype()]
     outname = reserve_tempfile("mkv")
+    # run_command limits the output size
     await run_command("ffmpeg", "-i", im1, "-i", im2, "-filter_complex", "overlay=format=auto", "-c:v",
-                      config.temp_vcodec, "-pix_fmt", config.temp_vpixfmt, "-fs",
-                      config.max_temp_file_size, "-fps_mode", "vfr", outname)
+                      config.temp_vcodec, "-pix_fmt", config.temp_vpixfmt, "-fps_mode", "vfr", outname)
     if mts[0] == IMAGE and mts[1] == IMAGE:
         outname = await mediatotempimage(outname)
     return outname
@@ -190,23 +194,19 @@ async def scale2ref(video, reference):
     return await resize(video, w, h)
 
 
-@gif_output
-async def changefps(file, fps):
+@fusable
+async def changefps(file: Pipeline, fps):
     """
     changes FPS of media
     :param file: media
     :param fps: FPS
     :return: processed media
     """
-    outname = reserve_tempfile("mkv")
-    await run_command("ffmpeg", "-hide_banner", "-i", file, "-r", str(fps), "-c:a", "copy", "-c:v",
-                      config.temp_vcodec, "-pix_fmt", config.temp_vpixfmt,
-                      outname)
-    return outname
+    return file.video(f"fps=fps={fps}", fps=fps)
 
 
-@gif_output
-async def trim(file, length, start=0):
+@fusable
+async def trim(file: Pipeline, length, start=0):
     """
     trims media to length seconds
     :param file: media
@@ -214,41 +214,34 @@ async def trim(file, length, start=0):
     :param start: time in seconds to begin the trimmed video
     :return: processed media
     """
-    out = reserve_tempfile("mkv")
-    dur = await get_duration(file)
+    dur = await file.duration()
     if start > dur:
         raise NonBugError(f"Trim start ({start}s) is outside the range of the file ({dur}s)")
-    await run_command("ffmpeg", "-hide_banner", "-i", file, "-t", str(length), "-ss", str(start), "-c:v",
-                      config.temp_vcodec, "-pix_fmt", config.temp_vpixfmt,
-                      "-c:a", config.temp_acodec, "-fps_mode", "vfr", out)
-    return out
+    newdur = min(length, dur - start)
+    # trim also takes audio files
+    if await file.has_video():
+        file.video(f"trim=start={start}:duration={length},setpts=PTS-STARTPTS", duration=newdur)
+    file.audio(f"atrim=start={start}:duration={length},asetpts=PTS-STARTPTS", duration=newdur)
+    return file
 
 
-@gif_output
-async def resize(image, width, height, re_encode=False, input_is_apng=False):
+@fusable
+async def resize(image: Pipeline, width, height):
     """
     resizes image
 
     :param image: file
     :param width: new width, thrown directly into ffmpeg so it can be things like -1 or iw/2
     :param height: new height, same as width
-    :param re_encode: if False, use ffv1 codec. if True, use typical re-encoding
     :return: processed media
     """
-    out = reserve_tempfile("mkv")
-    await run_command("ffmpeg", "-i", image, "-max_muxing_queue_size", "9999", "-sws_flags",
-                      "spline+accurate_rnd+full_chroma_int+full_chroma_inp+bitexact",
-                      "-vf", f"scale='{width}:{height}',setsar=1:1", "-c:v", config.temp_vcodec,
-                      "-pix_fmt", config.temp_vpixfmt,
-                      "-c:a", "copy", "-fps_mode", "vfr", out)
-    if re_encode:
-        if await is_apng(image) or input_is_apng:
-            return await toapng(out)
-        else:
-            out.mt = await image.mediatype()
-            return await allreencode(out)
+    # only predictable if we were given exact dimensions
+    if all(isinstance(d, int) and d > 0 for d in (width, height)):
+        resolution = [width, height]
     else:
-        return out
+        resolution = None
+    return image.video(f"scale='{width}:{height}':flags=spline+accurate_rnd+full_chroma_int+full_chroma_inp+bitexact,"
+                       f"setsar=1:1", resolution=resolution)
 
 
 async def splitaudio(video):
@@ -257,8 +250,7 @@ async def splitaudio(video):
     :param video: file
     :return: filename of audio (aac) if file has audio, False if it doesn't
     """
-    ifaudio = await run_command("ffprobe", "-i", video, "-show_streams", "-select_streams", "a", "-loglevel", "panic")
-    if ifaudio:
+    if await hasaudio(video):
         logger.info("Splitting audio...")
         name = reserve_tempfile("mkv")
         await run_command("ffmpeg", "-hide_banner", "-i", video, "-vn", "-acodec", config.temp_acodec,
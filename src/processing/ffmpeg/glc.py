@@ -1,17 +1,15 @@
-import json
 import re
 
 from core.clogs import logger
+from processing.ffmpeg.mediainfo import MediaInfo, probe
 from processing.run_command import run_command
 
 
-async def get_gif_loop_count(gif):
-    # i cannot import get_vcodec cause circular shit UGH
-    out = await run_command("ffprobe", "-v", "panic", "-select_streams", "v:0", "-show_entries",
-                            "stream=codec_name", "-print_format", "json", gif)
-    out = json.loads(out)
+async def get_gif_loop_count(gif, info: MediaInfo | None = None):
+    if info is None:
+        info = await probe(gif)
     # if its not actually a gif codec but its treated as a gif, default to always loop
-    if out["streams"] and out["streams"][0]["codec_name"] != "gif":
+    if info.vcodec and info.vcodec["codec_name"] != "gif":
         return 0
     # 'NUL' if sys.platform == "win32" else "/dev/null"
     # evil hack https://superuser.com/a/1663570/1001487
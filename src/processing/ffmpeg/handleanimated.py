@@ -1,19 +1,196 @@
+import asyncio
+import collections
+import hashlib
 import inspect
+import math
+
+import pyvips
 
 import config
+from core.clogs import logger
+from core.queue import core_budget
 from processing.common import run_parallel
 from processing.ffmpeg.conversion import mediatotempimage
-from processing.ffmpeg.ffprobe import get_frame_rate
+from processing.ffmpeg.ffprobe import get_frame_rate, get_resolution
 from processing.ffmpeg.ffutils import splitaudio, concat_demuxer, ffmpegsplit
 from processing.mediatype import VIDEO, GIF
-from processing.run_command import run_command
+from processing.run_command import run_command, CMDError, StreamingCommand, limit_output, check_output_limit
+from processing.vips.vipsutils import resize
 from utils.tempfiles import reserve_tempfile, TempFile
 
+# how many frames per core can be decoded/processing/waiting to be encoded at once when streaming. bounds memory use.
+FRAME_WINDOW = 8
+# frames are split into about this many chunks per core, so one slow chunk doesn't leave the other cores idle at the end
+CHUNKS_PER_CORE = 4
+
 
 def run_sync_per_frame(syncfunc: callable, inoutfiles, *args, **kwargs):
     return [syncfunc(file, *args, **kwargs) for file in inoutfiles]
 
 
+def frame_hash(frame: bytes) -> bytes:
+    return hashlib.blake2b(frame, digest_size=16).digest()
+
+
+def log_reuse(name: str, frames: int, unique: int):
+    if frames:
+        logger.info(f"{name}: {frames - unique}/{frames} frames were duplicates and reused "
+                    f"({round((frames - unique) / frames * 100)}%)")
+
+
+async def run_per_frame(function: callable, files: list, *args, **kwargs) -> list:
+    """
+    runs function on every frame, spread over as many cores as the job is allowed (see core.queue.core_budget())
+    :param function: function to apply to each frame
+    :param files: frames
+    :return: processed frames, in the same order
+    """
+    budget = core_budget()
+    sem = asyncio.Semaphore(budget)
+    if inspect.iscoroutinefunction(function):
+        # async functions are usually just waiting on a subprocess
+        async def run_frame(file):
+            async with sem:
+                return await function(file, *args, **kwargs)
+
+        return list(await asyncio.gather(*[run_frame(file) for file in files]))
+
+    # chunks go to the render process pool, so functions that hold the GIL (ie PIL) still use every core they're given
+    chunksize = max(1, math.ceil(len(files) / (budget * CHUNKS_PER_CORE)))
+    chunks = [files[i:i + chunksize] for i in range(0, len(files), chunksize)]
+    logger.info(f"Processing {len(files)} frames in {len(chunks)} chunks on {budget} cores...")
+
+    async def run_chunk(chunk):
+        async with sem:
+            return await run_parallel(run_sync_per_frame, function, chunk, *args, **kwargs)
+
+    results = await asyncio.gather(*[run_chunk(chunk) for chunk in chunks])
+    return [out for chunk in results for out in chunk]
+
+
+async def apply_image_func(sem: asyncio.Semaphore, image_func: callable, frame: bytes, width: int, height: int, *args,
+                           **kwargs):
+    async with sem:
+        im = pyvips.Image.new_from_memory(frame, width, height, 4, "uchar")
+        if inspect.iscoroutinefunction(image_func):
+            return await image_func(im, *args, **kwargs)
+        else:
+            # pyvips releases the GIL so a thread is fine
+            return await asyncio.to_thread(image_func, im, *args, **kwargs)
+
+
+def to_rgba(im: pyvips.Image, size: tuple[int, int] | None) -> bytes:
+    if im.bands < 3:
+        im = im.colourspace("srgb")
+    if im.bands == 3:
+        im = im.bandjoin(255)
+    # every frame going into the encoder has to be the same size
+    if size is not None and (im.width, im.height) != size:
+        im = resize(im, *size)
+    return im.cast("uchar").write_to_memory()
+
+
+async def streamanimated(media: TempFile, image_func: callable, *args, reuse_frames: bool = False, **kwargs):
+    """
+    handles animated media without writing any frames to disk.
+    ffmpeg decodes raw RGBA frames into a pipe, each frame is processed in memory by image_func, and the results are
+    piped straight into an encoding ffmpeg. frames are processed in parallel on up to core.queue.core_budget() cores,
+    and at most FRAME_WINDOW frames per core are held in memory at once.
+    :param media: media
+    :param image_func: function to apply to each frame, takes and returns a pyvips.Image
+    :param reuse_frames: if image_func is deterministic, reuse its output for recently seen identical frames
+    :return: processed media
+    """
+    width, height = await get_resolution(media)
+    fps = await get_frame_rate(media)
+    audio = await splitaudio(media)
+    framesize = width * height * 4
+    budget = core_budget()
+    sem = asyncio.Semaphore(budget)
+    window = FRAME_WINDOW * budget
+    outfile = reserve_tempfile("mkv")
+
+    decoder = StreamingCommand("ffmpeg", "-hide_banner", "-v", "error", "-i", media, "-map", "0:v:0",
+                               "-fps_mode", "cfr", "-f", "rawvideo", "-pix_fmt", "rgba", "pipe:1")
+    await decoder.start(stdout=True)
+    encoder = None
+    limit = None
+    outsize = None
+    pending = collections.deque()
+    # hash -> processed frame task, for the last `window` unique frames
+    recent: collections.OrderedDict[bytes, asyncio.Task] = collections.OrderedDict()
+    frames = 0
+    unique = 0
+    logger.info(f"Streaming frames of {media} through {image_func.__name__}...")
+
+    async def start_encoder(w, h):
+        nonlocal encoder, limit
+        # held to the job's temp storage like everything run_command() runs
+        command, limit = limit_output(("ffmpeg", "-hide_banner", "-v", "error", "-f", "rawvideo", "-pix_fmt", "rgba",
+                                       "-s", f"{w}x{h}", "-r", str(fps), "-i", "pipe:0",
+                                       *(["-i", audio, "-c:a", "copy"] if audio else []),
+                                       "-c:v", config.temp_vcodec, "-pix_fmt", config.temp_vpixfmt, outfile))
+        encoder = await StreamingCommand(*command).start(stdin=True)
+
+    async def encode_oldest():
+        nonlocal outsize
+        im = await pending.popleft()
+        if outsize is None:
+            # the output size is whatever the function made the first frame
+            outsize = (im.width, im.height)
+            await start_encoder(*outsize)
+        encoder.stdin.write(await asyncio.to_thread(to_rgba, im, outsize))
+        await encoder.stdin.drain()
+
+    try:
+        while True:
+            try:
+                frame = await decoder.stdout.readexactly(framesize)
+            except asyncio.IncompleteReadError:
+                break
+            frames += 1
+            task = None
+            if reuse_frames:
+                h = frame_hash(frame)
+                if (task := recent.get(h)) is not None:
+                    recent.move_to_end(h)
+            if task is None:
+                unique += 1
+                task = asyncio.create_task(apply_image_func(sem, image_func, frame, width, height, *args, **kwargs))
+                if reuse_frames:
+                    recent[h] = task
+                    if len(recent) > window:
+                        recent.popitem(last=False)
+            pending.append(task)
+            if len(pending) >= window:
+                await encode_oldest()
+        while pending:
+            await encode_oldest()
+        returncode, errors = await decoder.wait()
+        if returncode != 0:
+            raise CMDError(f"Decoding {media} failed with exit code {returncode}.") \
+                from CMDError(errors.decode("ascii", "ignore").strip())
+        if encoder is None:
+            raise CMDError(f"{media} has no frames.")
+        returncode, errors = await encoder.wait()
+        if returncode != 0:
+            raise CMDError(f"Encoding {outfile} failed with exit code {returncode}.") \
+                from CMDError(errors.decode("ascii", "ignore").strip())
+        check_output_limit(outfile, limit)
+    finally:
+        for task in pending:
+            task.cancel()
+        for process in (decoder, encoder):
+            if process is not None:
+                await process.kill()
+    logger.info(f"Streamed {frames} frames.")
+    if reuse_frames:
+        log_reuse(image_func.__name__, frames, unique)
+    if await media.mediatype() == GIF:
+        outfile.mt = GIF
+    return outfile
+
+
 async def handleanimated(media: TempFile, function: callable, *args, **kwargs):
     """
     handles animated media
@@ -21,14 +198,14 @@ async def handleanimated(media: TempFile, function: callable, *args, **kwargs):
     :param function: function to apply to each frame
     :return: processed media
     """
+    # functions with an in-memory version don't need every frame on disk
+    if (image_func := getattr(function, "image_func", None)) is not None:
+        return await streamanimated(media, image_func, *args,
+                                    reuse_frames=getattr(function, "deterministic", False), **kwargs)
     files = await ffmpegsplit(media)
     fps = await get_frame_rate(media)
     audio = await splitaudio(media)
-    outnames: list[str]
-    if inspect.iscoroutinefunction(function):
-        outnames = [(await function(file, *args, **kwargs)) for file in files]
-    else:
-        outnames = await run_parallel(run_sync_per_frame, function, files, *args, **kwargs)
+    outnames = await run_per_frame(function, files, *args, **kwargs)
 
     outdemuxer = await concat_demuxer(outnames)
 
@@ -1,9 +1,11 @@
 import asyncio
+import os
 from enum import Enum
 
 import config
 import processing.mediatype
 import processing.vips.creation
+from core.clogs import logger
 from processing.common import run_parallel
 from processing.ffmpeg.ffprobe import hasaudio
 from processing.mediatype import VIDEO, IMAGE, GIF
@@ -11,6 +13,16 @@ from processing.run_command import run_command
 from utils.tempfiles import TempFile, reserve_tempfile
 
 
+ASSETS = "rendering/heartlocket"
+# the maps are the same every time, so they're made once from the assets above and kept here
+MAPS = os.path.join(ASSETS, "cache")
+FPS = 10.13
+FIXEDRES = 384
+VIRTUALRES = FIXEDRES * 4
+
+_maps_lock = asyncio.Lock()
+
+
 class ArgType(Enum):
     MEDIA_MEDIA = 0
     TEXT_MEDIA = 1
@@ -38,7 +50,7 @@ async def heart_locket(arg1, arg2, type: ArgType):
                 run_parallel(processing.vips.creation.heartlockettext, arg2)
             )
 
-    fps = 10.13
+    fps = FPS
     # force codec to be video codec so stream_loop works
     # also force fps otherwise ffmpeg gets confused
     ffv1m1 = reserve_tempfile("mkv")
@@ -66,38 +78,29 @@ async def heart_locket(arg1, arg2, type: ArgType):
         case (False, False):
             mixer = ""
 
-    fixedres = 384
-    virtualres = fixedres * 4
-    # you would not FUCKING believe how painful these equations were to derive.
-    # hours of trying random things and chatgpt
-    red = "floor(r(X,Y)/255)"
-    green = "floor(g(X,Y)/255)"
-    blue = "floor(b(X,Y)/255)"
-    xmap = f"({red} + 256*mod({blue},16)) * ({virtualres} / 4096)"
-    ymap = f"({green} + 256*floor({blue}/16)) * ({virtualres} / 4096)"
+    fixedres = FIXEDRES
+    virtualres = VIRTUALRES
     # 39 frames
     length = 39 / fps
+    maps = await heart_locket_maps()
 
     await run_command(
         "ffmpeg",
         "-r", str(fps), "-stream_loop", "-1", "-i", media1,
         "-r", str(fps), "-stream_loop", "-1", "-i", media2,
-        "-r", str(fps), "-i", "rendering/heartlocket/mapper.mkv",  # The color "every pixel" map
-        "-r", str(fps), "-i", "rendering/heartlocket/mapper2.mkv",  # maps each half of the locket
-        "-r", str(fps), "-i", "rendering/heartlocket/neutral.mkv",  # the background
-        "-r", str(fps), "-i", "rendering/heartlocket/light.mkv",  # shading
-        "-r", str(fps), "-i", "rendering/heartlocket/dark.mkv",  # highlighting
+        "-r", str(fps), "-i", maps["xmap"],  # x of the input to use for every pixel
+        "-r", str(fps), "-i", maps["ymap"],  # y of the input to use for every pixel
+        "-r", str(fps), "-i", os.path.join(ASSETS, "neutral.mkv"),  # the background
+        "-r", str(fps), "-i", maps["shading"],  # shading
+        "-r", str(fps), "-i", maps["highlight"],  # highlighting
+        "-r", str(fps), "-i", maps["mask1"],  # each half of the locket
+        "-r", str(fps), "-i", maps["mask2"],
         "-max_muxing_queue_size", "9999", "-sws_flags",
         "spline+accurate_rnd+full_chroma_int+full_chroma_inp+bitexact",
         "-filter_complex",
         (
-            # pre-process
-            "[2:v]format=rgba64,split=2[colormapx][colormapy];"
-            # i probably could precompute these but i dont want to
-            # convert from weird proprietary color thing to x map
-            f"[colormapx]geq=r='{xmap}':g='{xmap}':b='{xmap}',format=gray16le,split=2[xmap1][xmap2];"
-            # convert from weird proprietary color thing to y map
-            f"[colormapy]geq=r='{ymap}':g='{ymap}':b='{ymap}',format=gray16le,split=2[ymap1][ymap2];"
+            "[2:v]split=2[xmap1][xmap2];"
+            "[3:v]split=2[ymap1][ymap2];"
             # resize input to right size for aliasing, then make bigger to avoid weird distortion
             # also fix fps
             f"[0:v]scale={fixedres}:{fixedres},scale={virtualres}:{virtualres},setsar=1:1[media0];"
@@ -114,18 +117,15 @@ async def heart_locket(arg1, arg2, type: ArgType):
             # TODO: the shading doesn't perfectly replicate the original.
             #  the original does some indecipherable pixel math
             #  the main difference is that the blending between the edges is smooth, but this will do
-            "[5:v]geq=r='0':g='0':b='0':a='255-r(X,Y)',format=rgba,split=2[shading1][shading2];"
-            "[6:v]geq=r='255':g='255':b='255':a='r(X,Y)',format=rgba,split=2[highlight1][highlight2];"
+            "[5:v]split=2[shading1][shading2];"
+            "[6:v]split=2[highlight1][highlight2];"
             "[mapped1][shading1]overlay[shaded1];"
             "[shaded1][highlight1]overlay[highlighted1];"
             "[mapped2][shading2]overlay[shaded2];"
             "[shaded2][highlight2]overlay[highlighted2];"
             # trim the image to each half of the locket
-            "[3:v]split=2[2v1][2v2];"
-            "[2v1]geq=r='0':g='0':b='0':a='if(eq(r(X, Y), 1), 255, 0)',format=rgba,alphaextract[mask1];"
-            "[2v2]geq=r='0':g='0':b='0':a='if(eq(r(X, Y), 2), 255, 0)',format=rgba,alphaextract[mask2];"
-            "[highlighted1][mask1]alphamerge[trimmed1];"
-            "[highlighted2][mask2]alphamerge[trimmed2];"
+            "[highlighted1][7:v]alphamerge[trimmed1];"
+            "[highlighted2][8:v]alphamerge[trimmed2];"
             # combine everything
             "[4:v][trimmed1]overlay[combined1];"
             "[combined1][trimmed2]overlay;"
@@ -138,3 +138,56 @@ async def heart_locket(arg1, arg2, type: ArgType):
         out.mt = GIF
     # await run_command("ffplay", out)
     return out
+
+
+def heart_locket_map_filters() -> dict[str, tuple[str, str]]:
+    """
+    :return: name -> (asset it's made from, filter that makes it)
+    """
+    # you would not FUCKING believe how painful these equations were to derive.
+    # hours of trying random things and chatgpt
+    red = "floor(r(X,Y)/255)"
+    green = "floor(g(X,Y)/255)"
+    blue = "floor(b(X,Y)/255)"
+    xmap = f"({red} + 256*mod({blue},16)) * ({VIRTUALRES} / 4096)"
+    ymap = f"({green} + 256*floor({blue}/16)) * ({VIRTUALRES} / 4096)"
+    return {
+        # convert from weird proprietary color thing to x/y maps for remap
+        "xmap": ("mapper.mkv", f"format=rgba64,geq=r='{xmap}':g='{xmap}':b='{xmap}',format=gray16le"),
+        "ymap": ("mapper.mkv", f"format=rgba64,geq=r='{ymap}':g='{ymap}':b='{ymap}',format=gray16le"),
+        "shading": ("light.mkv", "geq=r='0':g='0':b='0':a='255-r(X,Y)',format=rgba"),
+        "highlight": ("dark.mkv", "geq=r='255':g='255':b='255':a='r(X,Y)',format=rgba"),
+        # alpha masks of each half of the locket
+        "mask1": ("mapper2.mkv", "geq=r='0':g='0':b='0':a='if(eq(r(X, Y), 1), 255, 0)',format=rgba,alphaextract"),
+        "mask2": ("mapper2.mkv", "geq=r='0':g='0':b='0':a='if(eq(r(X, Y), 2), 255, 0)',format=rgba,alphaextract"),
+    }
+
+
+async def heart_locket_maps() -> dict[str, str]:
+    """
+    makes the maps heart_locket() uses, if they don't exist yet or their assets changed
+    :return: name -> path of each map
+    """
+    paths = {}
+    async with _maps_lock:
+        os.makedirs(MAPS, exist_ok=True)
+        for name, (asset, filters) in heart_locket_map_filters().items():
+            source = os.path.join(ASSETS, asset)
+            path = os.path.join(MAPS, f"{name}.mkv")
+            # the assets aren't needed once the maps are made
+            missing = not os.path.isfile(path)
+            if missing or (os.path.isfile(source) and os.path.getmtime(path) < os.path.getmtime(source)):
+                logger.info(f"Generating heart locket map {path}")
+                # written elsewhere first so other processes never see half of it
+                partial = os.path.join(MAPS, f"{name}.{os.getpid()}.partial.mkv")
+                try:
+                    # ffv1 stores gray16 and alpha losslessly, unlike temp_vcodec
+                    await run_command("ffmpeg", "-y", "-hide_banner", "-i", source, "-vf", filters, "-c:v", "ffv1",
+                                      "-an", partial)
+                    os.replace(partial, path)
+                finally:
+                    # only still there if generating it failed
+                    if os.path.exists(partial):
+                        os.remove(partial)
+            paths[name] = path
+    return paths
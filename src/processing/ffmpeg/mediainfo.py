@@ -0,0 +1,141 @@
+import dataclasses
+import json
+
+import apng
+
+from core.clogs import logger
+from processing.run_command import run_command
+
+
+def apng_duration(filename) -> float:
+    """
+    ffprobe can't get the length of an apng, so parse it ourselves
+    :param filename: apng file
+    :return: duration in seconds
+    """
+    parsedapng = apng.APNG.open(filename)
+    apnglen = 0
+    # https://wiki.mozilla.org/APNG_Specification#.60fcTL.60:_The_Frame_Control_Chunk
+    for png, control in parsedapng.frames:
+        if control.delay_den == 0:
+            control.delay_den = 100
+        apnglen += control.delay / control.delay_den
+    return apnglen
+
+
+def apng_frame_rate(filename) -> float:
+    parsedapng = apng.APNG.open(filename)
+    return len(parsedapng.frames) / apng_duration(filename)
+
+
+@dataclasses.dataclass
+class MediaInfo:
+    """
+    everything ffprobe knows about a file, gathered with a single ffprobe call.
+    (almost) every helper in processing.ffmpeg.ffprobe reads from this instead of spawning ffprobe again.
+    """
+    filename: str
+    streams: list[dict]
+    format: dict
+    # only filled in if something actually needed to count packets, it's slow
+    packet_count: int | None = None
+
+    def for_file(self, filename):
+        """
+        copy this info to a file that is provably identical in stream properties (ie a codec copy)
+        """
+        return dataclasses.replace(self, filename=filename)
+
+    @property
+    def video_stream(self) -> dict | None:
+        for stream in self.streams:
+            if stream.get("codec_type") == "video":
+                return stream
+        return None
+
+    @property
+    def audio_stream(self) -> dict | None:
+        for stream in self.streams:
+            if stream.get("codec_type") == "audio":
+                return stream
+        return None
+
+    @property
+    def has_audio(self) -> bool:
+        return self.audio_stream is not None
+
+    @property
+    def is_apng(self) -> bool:
+        # audio files have no video stream, and audio cannot be apng
+        return self.video_stream is not None and self.video_stream["codec_name"] == "apng"
+
+    @property
+    def vcodec(self) -> dict | None:
+        """
+        :return: dict containing "codec_name" and "codec_long_name", or None if there is no video
+        """
+        if (stream := self.video_stream) is None:
+            return None
+        return {"codec_name": stream.get("codec_name"), "codec_long_name": stream.get("codec_long_name")}
+
+    @property
+    def acodec(self) -> dict | None:
+        """
+        :return: dict containing "codec_name" and "codec_long_name", or None if there is no audio
+        """
+        if (stream := self.audio_stream) is None:
+            return None
+        return {"codec_name": stream.get("codec_name"), "codec_long_name": stream.get("codec_long_name")}
+
+    @property
+    def resolution(self) -> list[int]:
+        """
+        :return: [width, height], corrected for rotation metadata
+        """
+        stream = self.video_stream
+        w = stream["width"]
+        h = stream["height"]
+        # if rotated in metadata, swap width and height
+        if "tags" in stream and "rotate" in stream["tags"]:
+            rot = float(stream["tags"]["rotate"])
+            if rot % 90 == 0 and not rot % 180 == 0:
+                w, h = h, w
+        return [w, h]
+
+    @property
+    def frame_rate(self) -> float:
+        stream = self.video_stream
+        if stream["codec_name"] == "apng":  # ffmpeg no likey apng
+            return apng_frame_rate(self.filename)
+        rate = stream["r_frame_rate"].split("/")
+        if len(rate) == 1:
+            return float(rate[0])
+        if len(rate) == 2:
+            return float(rate[0]) / float(rate[1])
+        return -1
+
+    @property
+    def duration(self) -> float:
+        if "duration" not in self.format:  # happens with APNGs
+            # no garuntee that its an APNG here but i dont have any other plans so i want it to raise an exception
+            return apng_duration(self.filename)
+        return float(self.format["duration"])
+
+    @property
+    def sample_rate(self) -> int | None:
+        if (stream := self.audio_stream) is None:
+            return None
+        return int(stream["sample_rate"])
+
+
+async def probe(filename) -> MediaInfo:
+    """
+    runs ffprobe once, getting streams, format, and tags
+    :param filename: file to probe
+    :return: MediaInfo
+    """
+    out = await run_command("ffprobe", "-v", "panic", "-show_streams", "-show_format", "-print_format", "json",
+                            filename)
+    out = json.loads(out)
+    logger.debug(f"Probed {filename}")
+    return MediaInfo(filename, out.get("streams", []), out.get("format", {}))
@@ -10,14 +10,16 @@ import processing.common
 import processing.mediatype
 import processing.vips as vips
 from core.clogs import logger
-from processing.common import NonBugError
+from processing.common import NonBugError, uncacheable
 from processing.ffmpeg.conversion import mediatotempimage
-from processing.ffmpeg.ffprobe import get_duration, get_frame_rate, count_frames, get_resolution, hasaudio, get_vcodec
+from processing.ffmpeg.ffprobe import get_duration, get_frame_rate, count_frames, get_resolution, hasaudio, get_vcodec, \
+    get_sample_rate
 from processing.ffmpeg.ffutils import gif_output, expanded_atempo, forceaudio, dual_gif_output, scale2ref, changefps, \
-    resize, concat_demuxer
+    resize, concat_demuxer, forceaudio_source
 from processing.ffmpeg.handleanimated import animatedmultiplexer
+from processing.ffmpeg.pipeline import Pipeline, fusable
 from processing.mediatype import AUDIO, IMAGE, GIF
-from processing.run_command import run_command
+from processing.run_command import run_command, PipeSource
 from utils.tempfiles import reserve_tempfile, TempFile
 
 
@@ -46,7 +48,7 @@ async def speed(file, sp):
                 "Aborting speed because output file will have less than 2 frames. Try reducing the speed.")
         fps = await get_frame_rate(file)
         # duration = await get_duration(file)
-        await run_command("ffmpeg", "-hide_banner", "-i", await forceaudio(file), "-filter_complex",
+        await run_command("ffmpeg", "-hide_banner", "-i", await forceaudio_source(file), "-filter_complex",
                           f"[0:v]setpts=PTS/{sp},fps={fps}[v];[0:a]{expanded_atempo(sp)}[a]",
                           "-map", "[v]", "-map", "[a]",
                           # "-t", str(duration / float(sp)),
@@ -66,26 +68,23 @@ async def reverse(file):
     :return: procesed media
     """
     outname = reserve_tempfile("mkv")
-    await run_command("ffmpeg", "-hide_banner", "-i", await forceaudio(file), "-vf", "reverse", "-af", "areverse",
+    await run_command("ffmpeg", "-hide_banner", "-i", await forceaudio_source(file), "-vf", "reverse", "-af",
+                      "areverse",
                       "-c:v", config.temp_vcodec, "-pix_fmt", config.temp_vpixfmt,
                       "-fps_mode", "vfr", outname)
     return outname
 
 
-@gif_output
-async def random(file, frames: int):
+@fusable
+@uncacheable
+async def random(file: Pipeline, frames: int):
     """
     shuffle frames
     :param file: media
     :param frames: number of frames in internal cache
     :return: procesed media
     """
-    outname = reserve_tempfile("mkv")
-    #
-    await run_command("ffmpeg", "-hide_banner", "-i", file, "-filter:v", f"random=frames={frames}",
-                      "-c:v", config.temp_vcodec, "-pix_fmt", config.temp_vpixfmt,
-                      "-fps_mode", "vfr", outname)
-    return outname
+    return file.video(f"random=frames={frames}")
 
 
 @gif_output
@@ -98,41 +97,32 @@ async def quality(file, crf, qa):
     :return: processed media
     """
     outname = reserve_tempfile("mkv")
-    await run_command("ffmpeg", "-hide_banner", "-i", await forceaudio(file), "-crf", str(crf), "-c:a", "aac", "-b:a",
-                      f"{qa}k", "-fps_mode", "vfr", outname)
+    await run_command("ffmpeg", "-hide_banner", "-i", await forceaudio_source(file), "-crf", str(crf), "-c:a", "aac",
+                      "-b:a", f"{qa}k", "-fps_mode", "vfr", outname)
 
     # png cannot be supported here because crf and qa are libx264 params lmao
     return outname
 
 
-@gif_output
-async def invert(file):
+@fusable
+async def invert(file: Pipeline):
     """
     inverts colors
     :param file: media
     :return: processed media
     """
-    outname = reserve_tempfile("mkv")
-    await run_command("ffmpeg", "-hide_banner", "-i", file, "-vf", f"negate", "-c:v", config.temp_vcodec,
-                      "-pix_fmt", config.temp_vpixfmt, "-fps_mode", "vfr",
-                      outname)
-    return outname
+    return file.video("negate")
 
 
-@gif_output
-async def pad(file):
+@fusable
+async def pad(file: Pipeline):
     """
     pads media into a square shape
     :param file: media
     :return: processed media
     """
-    mt = await file.mediatype()
-    outname = reserve_tempfile("mkv")
-    await run_command("ffmpeg", "-hide_banner", "-i", file, "-vf",
-                      "pad=width='max(iw,ih)':height='max(iw,ih)':x='(ih-iw)/2':y='(iw-ih)/2':color=white", "-c:v",
-                      config.temp_vcodec, "-pix_fmt", config.temp_vpixfmt, "-fps_mode",
-                      "vfr", outname)
-    return outname
+    return file.video("pad=width='max(iw,ih)':height='max(iw,ih)':x='(ih-iw)/2':y='(iw-ih)/2':color=white",
+                      resolution=None)
 
 
 async def gifloop(file, loop):
@@ -147,6 +137,8 @@ async def gifloop(file, loop):
         out = reserve_tempfile("gif")
         await run_command("ffmpeg", "-hide_banner", "-i", file, "-loop", str(loop), "-vcodec", "copy", out)
         out.lock_codec = True
+        # stream copy, only the loop count changed
+        out.mi = (await file.mediainfo()).for_file(out)
     else:
         out = file
     out.mt = GIF
@@ -236,17 +228,15 @@ async def concatv(file0, file1):
     :param files: [video, video]
     :return: combined video
     """
-    video0 = await forceaudio(file0)
-    video1 = await forceaudio(file1)
-    w, h = await get_resolution(video0)
-    paddedvideo1 = reserve_tempfile("mkv")
+    video0 = await forceaudio_source(file0)
+    video1 = await forceaudio_source(file1)
+    w, h = await get_resolution(file0)
     # https://superuser.com/a/1136305/1001487
     # resize and pad 2nd video to match resolution of first, concat filter does no resizing so we have to
-    await run_command("ffmpeg", "-hide_banner", "-i", video1, "-sws_flags",
-                      "spline+accurate_rnd+full_chroma_int+full_chroma_inp", "-vf",
-                      f"scale={w}:{h}:force_original_aspect_ratio=decrease,setsar=1:1,pad={w}:{h}:-2:-2:color=black",
-                      "-c:v", config.temp_vcodec, "-pix_fmt", config.temp_vpixfmt,
-                      "-c:a", config.temp_acodec, "-fps_mode", "vfr", paddedvideo1)
+    paddedvideo1 = PipeSource("ffmpeg", "-hide_banner", "-i", video1, "-sws_flags",
+                              "spline+accurate_rnd+full_chroma_int+full_chroma_inp", "-vf",
+                              f"scale={w}:{h}:force_original_aspect_ratio=decrease,setsar=1:1,"
+                              f"pad={w}:{h}:-2:-2:color=black", "-fps_mode", "vfr")
     outname = reserve_tempfile("mkv")
     await run_command("ffmpeg", "-hide_banner",
                       "-i", video0, "-i", paddedvideo1,
@@ -274,14 +264,15 @@ async def stack(file0, file1, style):
     w0, h0 = await get_resolution(file0)
     w1, h1 = await get_resolution(file1)
     aspect1 = w1 / h1
+    mixaudio = all(await asyncio.gather(hasaudio(file0), hasaudio(file1)))
+    # resized as it's stacked, instead of to a file first
     if style == 'hstack':
         # scaling_logic = "scale2ref=oh*mdar:ih"
-        file1 = await resize(file1, h0 * aspect1, h0)
+        file1 = await resize(Pipeline(file1), h0 * aspect1, h0)
     else:
         # scaling_logic = "scale2ref=iw:ow/mdar"
-        file1 = await resize(file1, w0, w0 / aspect1)
+        file1 = await resize(Pipeline(file1), w0, w0 / aspect1)
 
-    mixaudio = all(await asyncio.gather(hasaudio(file0), hasaudio(file1)))
     outname = reserve_tempfile("mkv")
     await run_command("ffmpeg", "-hide_banner", "-i", file0, "-i", file1,
                       "-filter_complex",
@@ -342,8 +333,8 @@ async def overlay(file0, file1, alpha: float, mode: str = 'overlay'):
     return outname
 
 
-@gif_output
-async def rotate(file, rottype):
+@fusable
+async def rotate(file: Pipeline, rottype):
     types = {  # command input to ffmpeg vf
         "90": "transpose=1",
         "90ccw": "transpose=2",
@@ -351,11 +342,7 @@ async def rotate(file, rottype):
         "vflip": "vflip",
         "hflip": "hflip"
     }
-    out = reserve_tempfile("mkv")
-    await run_command("ffmpeg", "-i", file, "-vf", types[rottype] + ",format=rgba", "-c:v",
-                      config.temp_vcodec, "-pix_fmt", config.temp_vpixfmt, "-fps_mode",
-                      "vfr", out)
-    return out
+    return file.video(types[rottype] + ",format=rgba", resolution=None)
 
 
 async def volume(file, vol):
@@ -387,9 +374,7 @@ async def vibrato(file, frequency=5, depth=0.5):  # https://ffmpeg.org/ffmpeg-fi
 async def pitch(file, p=12):
     out = reserve_tempfile("mkv")
     # https://stackoverflow.com/a/71898956/9044183
-    samplerate = await run_command("ffprobe", "-v", "error", "-select_streams", "a", "-of",
-                                   "default=noprint_wrappers=1:nokey=1", "-show_entries", "stream=sample_rate", file)
-    samplerate = int(samplerate)
+    samplerate = await get_sample_rate(file)
     # http://www.geekybob.com/post/Adjusting-Pitch-for-MP3-Files-with-FFmpeg
     asetrate = max(int(samplerate * 2 ** (p / 12)), 1)
     atempo = 2 ** (-p / 12)
@@ -401,67 +386,42 @@ async def pitch(file, p=12):
     return out
 
 
-@gif_output
-async def hue(file, h: float):
-    out = reserve_tempfile("mkv")
-    await run_command("ffmpeg", "-i", file, "-vf", f"hue=h={h},format=rgba", "-c:v", config.temp_vcodec,
-                      "-pix_fmt", config.temp_vpixfmt, "-fps_mode", "vfr",
-                      out)
-    return out
+@fusable
+async def hue(file: Pipeline, h: float):
+    return file.video(f"hue=h={h},format=rgba")
 
 
-@gif_output
-async def tint(file, col: discord.Color):
-    out = reserve_tempfile("mkv")
+@fusable
+async def tint(file: Pipeline, col: discord.Color):
     # https://stackoverflow.com/a/3380739/9044183
     r, g, b = map(lambda x: x / 255, col.to_rgb())
-    await run_command("ffmpeg", "-i", file, "-vf",
-                      f"hue=s=0,"  # make grayscale
-                      f"lutrgb=r=val*{r}:g=val*{g}:b=val*{b}:a=val,"  # basically set white to our color 
-                      f"format=rgba", "-c:v", config.temp_vcodec, "-pix_fmt",
-                      config.temp_vpixfmt, "-fps_mode", "vfr", out)
-    return out
+    return file.video(f"hue=s=0,"  # make grayscale
+                      f"lutrgb=r=val*{r}:g=val*{g}:b=val*{b}:a=val,"  # basically set white to our color
+                      f"format=rgba")
 
 
-@gif_output
-async def circle(media):
+@fusable
+async def circle(media: Pipeline):
     # gh copilot spat this out based on https://stackoverflow.com/a/62400465/9044183
-    outfile = reserve_tempfile("mkv")
-    await run_command("ffmpeg", "-i", media, "-filter_complex",
-                      f"geq=lum='p(X,Y)':a='if(lte(hypot(W/2-X,H/2-Y),H/2),255,0)'",
-                      "-c:v", config.temp_vcodec, "-pix_fmt", config.temp_vpixfmt,
-                      "-c:a", "copy", "-fps_mode", "vfr", outfile)
-    return outfile
+    return media.video(f"geq=lum='p(X,Y)':a='if(lte(hypot(W/2-X,H/2-Y),H/2),255,0)'")
 
 
-@gif_output
-async def round_corners(media, border_radius=10):
-    outfile = reserve_tempfile("mkv")
+@fusable
+async def round_corners(media: Pipeline, border_radius=10):
     # https://stackoverflow.com/a/62400465/9044183
-    await run_command("ffmpeg", "-i", media, "-filter_complex",
-                      # f"format=rgba,"
-                      f"geq=lum='p(X,Y)':a='"
-                      f"if(gt(abs(W/2-X),W/2-{border_radius})*gt(abs(H/2-Y),"
-                      f"H/2-{border_radius}),"
-                      f"if(lte(hypot({border_radius}-(W/2-abs(W/2-X)),"
-                      f"{border_radius}-(H/2-abs(H/2-Y))),"
-                      f"{border_radius}),255,0),255)'",
-                      "-c:v", config.temp_vcodec, "-pix_fmt", config.temp_vpixfmt,
-                      "-c:a", "copy", "-fps_mode", "vfr",
-                      outfile)
-    return outfile
+    return media.video(f"geq=lum='p(X,Y)':a='"
+                       f"if(gt(abs(W/2-X),W/2-{border_radius})*gt(abs(H/2-Y),"
+                       f"H/2-{border_radius}),"
+                       f"if(lte(hypot({border_radius}-(W/2-abs(W/2-X)),"
+                       f"{border_radius}-(H/2-abs(H/2-Y))),"
+                       f"{border_radius}),255,0),255)'")
 
 
-@gif_output
-async def deepfry(media, brightness, contrast, sharpness, saturation, noise):
-    outfile = reserve_tempfile("mkv")
-
-    await run_command("ffmpeg", "-i", media, "-vf",
-                      f"eq=contrast={contrast}:brightness={brightness}:saturation={saturation},"
-                      f"unsharp=luma_msize_x=7:luma_msize_y=7:luma_amount={sharpness},"
-                      f"noise=alls={noise}", "-fps_mode", "vfr", "-c:v", config.temp_vcodec, "-pix_fmt",
-                      config.temp_vpixfmt, outfile)
-    return outfile
+@fusable
+async def deepfry(media: Pipeline, brightness, contrast, sharpness, saturation, noise):
+    return media.video(f"eq=contrast={contrast}:brightness={brightness}:saturation={saturation},"
+                       f"unsharp=luma_msize_x=7:luma_msize_y=7:luma_amount={sharpness},"
+                       f"noise=alls={noise}")
 
 
 @gif_output
@@ -470,7 +430,8 @@ async def speech_bubble(media, position: typing.Literal["top", "bottom"] = "top"
     mt = await media.mediatype()
     outfile = reserve_tempfile("mkv")
 
-    bubble = await scale2ref(TempFile("rendering/images/speechbubble.png"), media)
+    # scaled as it's applied, instead of to a file first
+    bubble = await scale2ref(Pipeline(TempFile("rendering/images/speechbubble.png")), media)
 
     if color == "transparent":
         await run_command("ffmpeg", "-i", media, "-i", bubble,
@@ -505,6 +466,7 @@ def stretch_tuple(strength: int) -> tuple[int, int]:
     return rand.randint(-strength, strength), rand.randint(-strength, strength)
 
 
+@uncacheable
 async def handle_jpeg(media: TempFile, strength: int, stretch: int, quality: int):
     """provides consistent stretch randomness over all jpeg frames"""
     # resize to anywhere between (original image width ± stretch, original image height ± stretch)
@@ -515,7 +477,7 @@ async def handle_jpeg(media: TempFile, strength: int, stretch: int, quality: int
 
 @gif_output
 async def boomerang(file):
-    audfile = await forceaudio(file)
+    audfile = await forceaudio_source(file)
     outfile = reserve_tempfile("mkv")
     await run_command("ffmpeg", "-i", audfile,
                       "-filter_complex", "[0:v]split=outputs=2[v1][v2];"
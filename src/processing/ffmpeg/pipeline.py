@@ -0,0 +1,173 @@
+import functools
+import typing
+
+from core.clogs import logger
+from processing.common import NonBugError
+from processing.ffmpeg.ffprobe import get_mediainfo, get_resolution, get_frame_rate, get_duration
+from processing.mediatype import GIF
+from processing.run_command import run_command, PipeSource
+from utils.tempfiles import reserve_tempfile, TempFile
+
+# sentinel for "this filter doesn't change this property"
+KEEP = object()
+
+
+class Pipeline:
+    """
+    a lazy chain of filters applied to one input.
+    ops add filters to it instead of running ffmpeg at once, and the whole chain is compiled into one
+    -filter_complex invocation when materialize() is called.
+    this saves writing a full lossless intermediate file for every step.
+    """
+
+    def __init__(self, source: TempFile):
+        self.source = source
+        self.vfilters: list[str] = []
+        self.afilters: list[str] = []
+        # what we know the output will be without running anything. missing key means same as source, None means
+        # unknown (it has to be materialized to find out)
+        self.predicted: dict[str, typing.Any] = {}
+
+    def __repr__(self):
+        return f"Pipeline({self.source!r}, vf={self.vfilters}, af={self.afilters})"
+
+    def video(self, filters: str, resolution=KEEP, fps=KEEP, duration=KEEP):
+        """
+        add video filters to the chain. if the input has no video, materializing raises NonBugError, so ops that also
+        work on audio should check has_video() first.
+        :param filters: filters, in the same syntax as -vf
+        :param resolution: the resulting [width, height] if known, None if unknown, or KEEP if unchanged
+        :param fps: the resulting fps, same semantics as resolution
+        :param duration: the resulting duration, same semantics as resolution
+        :return: self
+        """
+        self.vfilters.append(filters)
+        self._predict(resolution=resolution, fps=fps, duration=duration)
+        return self
+
+    def audio(self, filters: str, duration=KEEP):
+        """
+        add audio filters to the chain. ignored if the input has no audio.
+        :param filters: filters, in the same syntax as -af
+        :param duration: the resulting duration if known, None if unknown, or KEEP if unchanged
+        :return: self
+        """
+        self.afilters.append(filters)
+        self._predict(duration=duration)
+        return self
+
+    def _predict(self, **props):
+        for key, value in props.items():
+            if value is not KEEP:
+                self.predicted[key] = value
+
+    async def _predicted(self, key, getter):
+        if key in self.predicted:
+            if self.predicted[key] is not None:
+                return self.predicted[key]
+            # can't know without actually running it
+            logger.debug(f"{key} of {self} is unknown, materializing")
+            await self.materialize()
+        return await getter(self.source)
+
+    async def resolution(self):
+        return await self._predicted("resolution", get_resolution)
+
+    async def frame_rate(self):
+        return await self._predicted("fps", get_frame_rate)
+
+    async def duration(self):
+        return await self._predicted("duration", get_duration)
+
+    async def mediatype(self):
+        return await self.source.mediatype()
+
+    async def has_video(self) -> bool:
+        return (await get_mediainfo(self.source)).video_stream is not None
+
+    async def gif_loop_count(self):
+        return await self.source.gif_loop_count()
+
+    async def _command(self) -> tuple:
+        """
+        :return: ffmpeg args that apply the whole chain, without any output options
+        """
+        info = await get_mediainfo(self.source)
+        if self.vfilters and info.video_stream is None:
+            # there's nothing to apply them to, and leaving them out would quietly return the input unchanged
+            raise NonBugError("This command needs media with video, but the input only has audio.")
+        graph = []
+        maps = []
+        if info.video_stream is not None:
+            graph.append(f"[0:v]{','.join(self.vfilters) or 'null'}[v]")
+            maps += ["-map", "[v]"]
+        if info.has_audio:
+            if self.afilters:
+                graph.append(f"[0:a]{','.join(self.afilters)}[a]")
+                maps += ["-map", "[a]"]
+            else:
+                maps += ["-map", "0:a"]
+        return ("ffmpeg", "-hide_banner", "-i", self.source, "-max_muxing_queue_size", "9999",
+                *(["-filter_complex", ";".join(graph)] if graph else []), *maps, "-fps_mode", "vfr")
+
+    async def pipe_source(self) -> TempFile | PipeSource:
+        """
+        lets run_command() take the pipeline as an input, so the chain runs piped into that command instead of being
+        written to a file first. the pipeline itself is left as-is.
+        """
+        if not self.vfilters and not self.afilters:
+            return self.source
+        return PipeSource(*await self._command())
+
+    async def materialize(self) -> TempFile:
+        """
+        runs the whole chain in one ffmpeg invocation
+        :return: the processed file. if nothing was added to the chain, the source file untouched.
+        """
+        if not self.vfilters and not self.afilters:
+            return self.source
+        out = reserve_tempfile("mkv")
+        source = PipeSource(*await self._command())
+        await run_command(*source.args, *source.output_args(), out)
+        # same as gif_output
+        if await self.source.mediatype() == GIF:
+            out.mt = GIF
+            out.glc = await self.source.gif_loop_count()
+        # the chain is now empty and continues from the output
+        self.source = out
+        self.vfilters = []
+        self.afilters = []
+        self.predicted = {}
+        return out
+
+
+def fusable(f):
+    """
+    marks an op that only adds filters to a Pipeline.
+    called on a Pipeline, it returns the Pipeline with the filters added and nothing runs until materialize().
+    called on a plain file, it runs right away and returns the processed file.
+    """
+
+    @functools.wraps(f)
+    async def wrapper(media, *args, **kwargs):
+        if isinstance(media, Pipeline):
+            return await f(media, *args, **kwargs)
+        else:
+            return await (await f(Pipeline(media), *args, **kwargs)).materialize()
+
+    wrapper.fusable = True
+    return wrapper
+
+
+def is_fusable(func) -> bool:
+    return getattr(func, "fusable", False)
+
+
+async def materialize(media):
+    """
+    materializes media if it's a Pipeline, otherwise returns it as-is
+    """
+    if isinstance(media, Pipeline):
+        return await media.materialize()
+    else:
+        return media
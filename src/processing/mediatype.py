@@ -1,12 +1,13 @@
 import enum
 import json
+import os
+import struct
 import sys
 
-
-
 from PIL import Image, UnidentifiedImageError
 
 from core.clogs import logger
+from processing.ffmpeg.mediainfo import probe
 from processing.run_command import run_command
 from utils import trymagic
 
@@ -28,12 +29,155 @@ IMAGE = MediaType.IMAGE
 GIF = MediaType.GIF
 
 
+# containers that are only ever audio/video, so there's no point asking PIL about them
+AV_SIGNATURES = [
+    (0, b"\x1a\x45\xdf\xa3"),  # matroska/webm
+    (0, b"OggS"),
+    (0, b"fLaC"),
+    (0, b"ID3"),  # mp3 with tags
+    (0, b"FLV"),
+    (0, b"\x30\x26\xb2\x75"),  # asf/wmv
+    (8, b"AVI "),
+    (8, b"WAVE"),
+]
+# ftyp brands that are images, everything else with an ftyp box is mp4/mov/m4a/3gp
+IMAGE_FTYP_BRANDS = [b"avif", b"avis", b"heic", b"heix", b"heim", b"heis", b"hevc", b"mif1", b"msf1"]
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def sniff(filename) -> str | None:
+    """
+    looks at the first bytes of a file to guess what kind of container it is without parsing it
+    :return: "png", "av" for audio/video containers, or None if unsure
+    """
+    with open(filename, "rb") as f:
+        head = f.read(16)
+    if head.startswith(PNG_SIGNATURE):
+        return "png"
+    if head[4:8] == b"ftyp":
+        return None if head[8:12] in IMAGE_FTYP_BRANDS else "av"
+    for offset, sig in AV_SIGNATURES:
+        if head[offset:offset + len(sig)] == sig:
+            return "av"
+    return None
+
+
+def png_frames(filename) -> int | None:
+    """
+    reads the chunk headers of a png up to the image data to find out if it's an apng
+    :return: number of frames, or None if the png is broken
+    """
+    try:
+        with open(filename, "rb") as f:
+            f.seek(len(PNG_SIGNATURE))
+            while len(header := f.read(8)) == 8:
+                length, chunk = struct.unpack(">I4s", header)
+                # animation control, first field is the number of frames
+                if chunk == b"acTL":
+                    return struct.unpack(">I", f.read(4))[0]
+                # acTL must come before the image data, so this isn't an apng
+                if chunk == b"IDAT":
+                    return 1
+                f.seek(length + 4, os.SEEK_CUR)  # skip data and crc
+    except (OSError, struct.error):
+        pass
+    return None
+
+
+async def count_packets(filename, stream_index: int, limit: int = 2) -> int:
+    """
+    count the packets of a stream, reading at most `limit` of them
+    """
+    out = await run_command("ffprobe", "-v", "panic", "-select_streams", str(stream_index), "-read_intervals",
+                            f"%+#{limit}", "-count_packets", "-show_entries", "stream=nb_read_packets",
+                            "-print_format", "json", filename)
+    streams = json.loads(out).get("streams", [])
+    return int(streams[0].get("nb_read_packets", 0)) if streams else 0
+
+
+async def video_stream_frames(filename, stream: dict) -> int:
+    """
+    :return: 1 if the stream is one frame, or 0 or 2 (more than one, or none) otherwise. same meaning as counting
+        packets, without reading more than two of them
+    """
+    if stream.get("disposition", {}).get("attached_pic"):
+        # album art
+        return 1
+    if "nb_frames" in stream and int(stream["nb_frames"]) > 0:
+        # the container already knows
+        return min(int(stream["nb_frames"]), 2)
+    return await count_packets(filename, stream["index"])
+
+
+def pil_type(image, mime) -> MediaType | None:
+    try:
+        with Image.open(image) as im:
+            anim = getattr(im, "is_animated", False)
+        if anim:
+            logger.debug(f"identified type {mime} with animated frames as GIF")
+            return MediaType.GIF  # gifs dont have to be animated but if they aren't its easier to treat them like pngs
+        else:
+            logger.debug(f"identified type {mime} with no animated frames as IMAGE")
+            return MediaType.IMAGE
+    except UnidentifiedImageError:
+        logger.debug(f"UnidentifiedImageError on {image}")
+        return None
+
+
 async def mediatype(image) -> MediaType:
     """
     Gets basic type of media
     :param image: filename of media
     :return: can be VIDEO, AUDIO, GIF, IMAGE or None (invalid or other).
     """
+    container = sniff(image)
+    if container == "png" and (frames := png_frames(image)) is not None:
+        return MediaType.GIF if frames > 1 else MediaType.IMAGE
+    mime = trymagic.from_file(image, mime=True)
+    # ffmpeg doesn't work well with detecting images so let PIL do that
+    if container != "av" and (mt := pil_type(image, mime)) is not None:
+        return mt
+    # PIL isn't sure so let ffmpeg take control
+    # the probe only reads headers, and TempFiles keep it for later
+    info = await image.mediainfo() if hasattr(image, "mediainfo") else await probe(image)
+    props = {
+        "video": False,
+        "audio": False,
+        "gif": False,
+        "image": False
+    }
+    for stream in info.streams:
+        if stream["codec_type"] == "audio":  # only can be pure audio
+            props["audio"] = True
+        elif stream["codec_type"] == "video":  # could be video or image or gif sadly
+            if await video_stream_frames(image, stream) != 1:  # if there are multiple frames
+                if stream["codec_name"] in ["gif", "apng"]:  # if gif
+                    props["gif"] = True  # gif
+                else:  # multiple frames, not gif
+                    props["video"] = True  # video!!
+            else:  # if there is only one frame
+                props["image"] = True  # it's an image
+                # yes, this will mark 1 frame/non-animated gifs as images.
+                # this is intentional behavior as most commands treat gifs as videos
+    # ok so a container can have multiple formats, we need to return based on expected priority
+    if props["video"]:
+        return VIDEO
+    if props["gif"]:
+        return GIF
+    if props["audio"]:
+        return AUDIO
+    if props["image"]:
+        return IMAGE
+    raise InvalidMediaType(f"Unknown media type for {image} due to unclassified type {mime}")
+
+
+async def mediatype_legacy(image) -> MediaType:
+    """
+    the original classifier, which counts every packet of non-images. kept to check mediatype() against, see
+    benchmarks/mediatype.py
+    :param image: filename of media
+    :return: can be VIDEO, AUDIO, GIF, IMAGE or None (invalid or other).
+    """
     # ffmpeg doesn't work well with detecting images so let PIL do that
     mime = trymagic.from_file(image, mime=True)
     try:
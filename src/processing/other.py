@@ -2,12 +2,15 @@ import glob
 import re
 import traceback
 
+import pyvips
 import yt_dlp as youtube_dl
 
 import utils.tempfiles
 from config import temp_vipscodec
 from processing.ffmpeg.ffprobe import *
-from processing.run_command import run_command
+from processing.common import frame_function, deterministic
+from processing.run_command import run_command, pipe_command
+from processing.vips.vipsutils import normalize
 from utils.tempfiles import reserve_tempfile
 
 
@@ -69,6 +72,15 @@ def ytdownload(vid, form):
         raise youtube_dl.DownloadError(cleaned_error) from Exception(traceback.format_exception(e))
 
 
+async def magickone_image(im: pyvips.Image, strength):
+    im = normalize(im).cast("uchar")
+    out = await pipe_command("magick", "-size", f"{im.width}x{im.height}", "-depth", "8", "rgba:-",
+                             "-liquid-rescale", f"{strength}%x{strength}%", "tif:-", stdin=im.write_to_memory())
+    return pyvips.Image.new_from_buffer(out, "")
+
+
+@deterministic
+@frame_function(magickone_image)
 async def magickone(media, strength):
     tosave = reserve_tempfile(temp_vipscodec)
     # media = await mediatopng(media)
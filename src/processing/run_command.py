@@ -1,41 +1,475 @@
 import asyncio
+import collections
+import contextvars
+import dataclasses
 import os
 import re
 import subprocess
 import sys
+import threading
+import time
 
+import humanize
+import psutil
+
+import config
+from core import tracing
 from core.clogs import logger
 
+# how often to sample a running command's cpu time and memory, in seconds
+SAMPLE_INTERVAL = 0.1
+# ru_maxrss is in kilobytes everywhere but macOS
+RSS_UNIT = 1 if sys.platform == "darwin" else 1024
 
-async def run_command(*args: str):
+# how many finished commands to keep in history
+history_size = config.command_history_size if hasattr(config, "command_history_size") else 1000
+# commands that take longer than this many seconds are logged. None to disable.
+slow_threshold = config.slow_command_threshold if hasattr(config, "slow_command_threshold") else 30
+
+
+@dataclasses.dataclass
+class Usage:
     """
-    run a cli command
+    resources used by everything a job ran. processing.cost learns from these.
+    """
+    cpu_seconds: float = 0
+    # biggest single command, not the sum of everything running at once
+    peak_memory: int = 0
+    commands: int = 0
 
-    :param args: the args of the command, what would normally be seperated by a space
-    :return: the result of the command
+    def add(self, cpu_seconds: float, peak_memory: int = 0):
+        self.cpu_seconds += cpu_seconds
+        self.peak_memory = max(self.peak_memory, peak_memory)
+        self.commands += 1
+
+
+@dataclasses.dataclass
+class CommandRecord:
+    """
+    resources used by one finished command
+    """
+    binary: str
+    # module.function that ran it
+    caller: str
+    job: str | None
+    pid: int
+    returncode: int
+    wall: float
+    user: float
+    sys: float
+    # bytes
+    max_rss: int
+
+
+@dataclasses.dataclass
+class CommandStats:
+    """
+    totals of every command one caller ran with one binary
+    """
+    count: int = 0
+    failures: int = 0
+    wall: float = 0
+    user: float = 0
+    sys: float = 0
+    max_rss: int = 0
+
+    @property
+    def cpu(self) -> float:
+        return self.user + self.sys
+
+    def add(self, record: CommandRecord):
+        self.count += 1
+        self.failures += record.returncode != 0
+        self.wall += record.wall
+        self.user += record.user
+        self.sys += record.sys
+        self.max_rss = max(self.max_rss, record.max_rss)
+
+
+# the usage of the current job, if anything is recording it
+job_usage: contextvars.ContextVar[Usage | None] = contextvars.ContextVar("job_usage", default=None)
+# id of the current job, commands are tagged with it
+job_id: contextvars.ContextVar[str | None] = contextvars.ContextVar("job_id", default=None)
+
+# most recent commands, oldest first
+history: collections.deque[CommandRecord] = collections.deque(maxlen=history_size)
+# (binary, caller) -> totals
+command_stats: dict[tuple[str, str], CommandStats] = collections.defaultdict(CommandStats)
+
+
+def caller() -> str:
+    """
+    :return: module.function of the first frame outside this module
     """
+    frame = sys._getframe(1)
+    while frame is not None and frame.f_globals.get("__name__") == __name__:
+        frame = frame.f_back
+    if frame is None:
+        return "unknown"
+    return f"{frame.f_globals.get('__name__')}.{frame.f_code.co_qualname}"
+
+
+def account(record: CommandRecord, start: int):
+    """
+    adds a finished command to the history, the per-(binary, caller) totals and the current trace
+    :param start: when it started, in unix nanoseconds
+    """
+    history.append(record)
+    command_stats[(record.binary, record.caller)].add(record)
+    tracing.add_span(record.binary, start, time.time_ns(), caller=record.caller, pid=record.pid,
+                     returncode=record.returncode, user=record.user, sys=record.sys, max_rss=record.max_rss)
+    if slow_threshold is not None and record.wall > slow_threshold:
+        logger.warning(f"Slow command: '{record.binary}' from {record.caller} (job {record.job}) took "
+                       f"{record.wall:.1f}s, {record.user:.1f}s user + {record.sys:.1f}s sys, "
+                       f"{record.max_rss / 1_000_000:.0f}MB peak")
+
+
+async def _sample_usage(pid: int, started: float):
+    """
+    samples a process until it's cancelled, then records its usage to the current job
+    """
+    cpu = None
+    peak = 0
+    try:
+        proc = psutil.Process(pid)
+        while True:
+            with proc.oneshot():
+                times = proc.cpu_times()
+                cpu = times.user + times.system
+                peak = max(peak, proc.memory_info().rss)
+            await asyncio.sleep(SAMPLE_INTERVAL)
+    except psutil.Error:
+        pass
+    finally:
+        if (usage := job_usage.get()) is not None:
+            # finished before the first sample, wall time is the best we have
+            usage.add(cpu if cpu is not None else time.perf_counter() - started, peak)
+
 
+def track_usage(pid: int) -> asyncio.Task | None:
+    """
+    starts recording a process's usage to the current job. cancel the returned task once the process exits.
+    """
+    if job_usage.get() is None:
+        return None
+    return asyncio.create_task(_sample_usage(pid, time.perf_counter()))
+
+
+def stop_tracking(task: asyncio.Task | None):
+    if task is not None:
+        task.cancel()
+
+
+def nice_kwargs() -> dict:
+    """
+    :return: kwargs for asyncio.create_subprocess_exec() that run the process at low priority
+    """
     # https://stackoverflow.com/a/56884806/9044183
     # set proccess priority low
     if sys.platform == "win32":
         startupinfo = subprocess.STARTUPINFO()
         startupinfo.dwFlags |= subprocess.BELOW_NORMAL_PRIORITY_CLASS
-        nicekwargs = {"startupinfo": startupinfo}
+        return {"startupinfo": startupinfo}
     else:
-        nicekwargs = {"preexec_fn": lambda: os.nice(10)}
+        return {"preexec_fn": lambda: os.nice(10)}
+
 
-    # Create subprocess
-    process = await asyncio.create_subprocess_exec(
-        *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
-        **nicekwargs
-    )
+async def _read_pipe(pipe) -> bytes:
+    """
+    reads a pipe to EOF on the event loop, then closes it
+    """
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), pipe)
+    try:
+        return await reader.read()
+    finally:
+        transport.close()
+
+
+async def _write_pipe(pipe, data: bytes | None):
+    """
+    writes all of data to a pipe on the event loop, then closes it
+    """
+    if pipe is None:
+        return
+    loop = asyncio.get_running_loop()
+    transport, protocol = await loop.connect_write_pipe(
+        lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader()), pipe)
+    writer = asyncio.StreamWriter(transport, protocol, None, loop)
+    try:
+        writer.write(data)
+        await writer.drain()
+    except (BrokenPipeError, ConnectionResetError):
+        # it exited without reading everything, the return code will say why
+        pass
+    finally:
+        transport.close()
 
-    # Status
-    logger.info(f"'{args[0]}' started with PID {process.pid}")
+
+async def _wait4(pid: int) -> tuple:
+    """
+    waits for a child to exit without blocking the event loop or taking a thread from the default executor, then
+    reaps it with wait4() to get its rusage
+    :return: wait status and rusage
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        pidfd = os.pidfd_open(pid)
+    except (AttributeError, OSError):
+        # no pidfds (not linux, or older than 5.3), so give it a thread of its own. every running command needs one
+        # until it exits, so they can't come from a pool that could run out while a pipe producer waits on its consumer
+        done = loop.create_future()
+
+        def reap():
+            result = os.wait4(pid, 0)
+            loop.call_soon_threadsafe(lambda: done.done() or done.set_result(result))
+
+        threading.Thread(target=reap, daemon=True, name=f"reap-{pid}").start()
+        _, status, rusage = await done
+        return status, rusage
+    exited = loop.create_future()
+    # a pidfd becomes readable once the process exits
+    loop.add_reader(pidfd, lambda: exited.done() or exited.set_result(None))
+    try:
+        await exited
+    finally:
+        loop.remove_reader(pidfd)
+        os.close(pidfd)
+    # it's exited, so this doesn't block
+    _, status, rusage = os.wait4(pid, 0)
+    return status, rusage
+
+
+async def _communicate_and_reap(process: subprocess.Popen, stdin: bytes | None):
+    """
+    like Popen.communicate() then Popen.wait(), but on the event loop, and reaps the process with wait4() to get its
+    rusage
+    """
+    try:
+        stdout, stderr, _ = await asyncio.gather(_read_pipe(process.stdout), _read_pipe(process.stderr),
+                                                 _write_pipe(process.stdin, stdin))
+    except Exception:
+        process.kill()
+        await _wait4(process.pid)
+        process.returncode = -9
+        raise
+    status, rusage = await _wait4(process.pid)
+    # so Popen doesn't try to reap it again
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return stdout, stderr, rusage
+
+
+async def _run(args: tuple[str, ...], stdin: bytes | None = None, pass_fds: tuple[int, ...] = (),
+               who: str | None = None) -> tuple[int, int, bytes, bytes]:
+    """
+    runs a command and accounts for its resources
+    :param pass_fds: file descriptors the command inherits. they're closed in this process once it starts.
+    :param who: what ran it, if not the caller
+    :return: pid, return code, stdout, stderr
+    """
+    record = CommandRecord(os.path.basename(args[0]), who or caller(), job_id.get(), 0, 0, 0, 0, 0, 0)
+    started = time.perf_counter()
+    start_ns = time.time_ns()
+    if sys.platform == "win32":
+        # no wait4(), so only wall time is recorded and the job's usage is sampled instead
+        process = await asyncio.create_subprocess_exec(
+            *args, stdin=asyncio.subprocess.PIPE if stdin is not None else None,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE, **nice_kwargs()
+        )
+        record.pid = process.pid
+        if stdin is None:
+            logger.info(f"'{args[0]}' started with PID {process.pid}")
+        logger.debug(f"PID {process.pid}: {args}")
+        tracker = track_usage(process.pid)
+        try:
+            stdout, stderr = await process.communicate(stdin)
+        finally:
+            stop_tracking(tracker)
+        _finish(record, started, start_ns, process.returncode)
+        return process.pid, process.returncode, stdout, stderr
+
+    try:
+        process = subprocess.Popen(args, stdin=subprocess.PIPE if stdin is not None else None,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE, pass_fds=pass_fds, **nice_kwargs())
+    finally:
+        # the other end only sees EOF/EPIPE once every copy is closed, including this one
+        for fd in pass_fds:
+            os.close(fd)
+    record.pid = process.pid
+    if stdin is None:
+        # pipe_command runs once per frame, that's too much for info
+        logger.info(f"'{args[0]}' started with PID {process.pid}")
     logger.debug(f"PID {process.pid}: {args}")
+    waiter = asyncio.ensure_future(_communicate_and_reap(process, stdin))
+    try:
+        stdout, stderr, rusage = await asyncio.shield(waiter)
+    except asyncio.CancelledError:
+        process.kill()
+        # let it be reaped so it doesn't linger as a zombie
+        await asyncio.wait([waiter])
+        raise
+    _finish(record, started, start_ns, process.returncode, rusage)
+    return process.pid, process.returncode, stdout, stderr
+
+
+def _finish(record: CommandRecord, started: float, start_ns: int, returncode: int, rusage=None):
+    """
+    fills in a finished command's record and accounts for it
+    :param started: when it started, from time.perf_counter()
+    :param start_ns: when it started, in unix nanoseconds
+    :param rusage: from wait4(), None if it isn't available, ie on windows where track_usage() samples it instead
+    """
+    record.returncode = returncode
+    record.wall = time.perf_counter() - started
+    if rusage is not None:
+        record.user = rusage.ru_utime
+        record.sys = rusage.ru_stime
+        record.max_rss = rusage.ru_maxrss * RSS_UNIT
+    account(record, start_ns)
+    if rusage is not None and (usage := job_usage.get()) is not None:
+        usage.add(record.user + record.sys, record.max_rss)
+
+
+class StreamingCommand:
+    """
+    a command whose stdin and/or stdout the caller streams to and from as it runs, instead of passing it all at once
+    (ie raw frames in and out of ffmpeg). it's reaped and accounted for the same as anything run_command() runs.
+    usage: start() it, use stdin/stdout, then wait() for it. kill() it if anything goes wrong.
+    """
+
+    def __init__(self, *args: str, who: str | None = None):
+        self.args = args
+        self.record = CommandRecord(os.path.basename(args[0]), who or caller(), job_id.get(), 0, 0, 0, 0, 0, 0)
+        self.stdin: asyncio.StreamWriter | None = None
+        self.stdout: asyncio.StreamReader | None = None
+        self.returncode: int | None = None
+        self._process: subprocess.Popen | asyncio.subprocess.Process | None = None
+        self._stderr: asyncio.Future | None = None
+        self._tracker: asyncio.Task | None = None
+        self._transports = []
+        self._started = 0.
+        self._start_ns = 0
+
+    @property
+    def pid(self) -> int:
+        return self._process.pid
+
+    async def start(self, stdin: bool = False, stdout: bool = False) -> "StreamingCommand":
+        """
+        :param stdin: open self.stdin to write to it
+        :param stdout: open self.stdout to read from it
+        """
+        self._started = time.perf_counter()
+        self._start_ns = time.time_ns()
+        stdin_pipe = subprocess.PIPE if stdin else subprocess.DEVNULL
+        stdout_pipe = subprocess.PIPE if stdout else subprocess.DEVNULL
+        if sys.platform == "win32":
+            # no wait4(), same as _run()
+            self._process = await asyncio.create_subprocess_exec(*self.args, stdin=stdin_pipe, stdout=stdout_pipe,
+                                                                 stderr=subprocess.PIPE, **nice_kwargs())
+            self.stdin, self.stdout = self._process.stdin, self._process.stdout
+            self._stderr = asyncio.ensure_future(self._process.stderr.read())
+            self._tracker = track_usage(self._process.pid)
+        else:
+            self._process = subprocess.Popen(self.args, stdin=stdin_pipe, stdout=stdout_pipe, stderr=subprocess.PIPE,
+                                             **nice_kwargs())
+            loop = asyncio.get_running_loop()
+            if stdin:
+                transport, protocol = await loop.connect_write_pipe(
+                    lambda: asyncio.StreamReaderProtocol(asyncio.StreamReader()), self._process.stdin)
+                self._transports.append(transport)
+                self.stdin = asyncio.StreamWriter(transport, protocol, None, loop)
+            if stdout:
+                self.stdout = asyncio.StreamReader()
+                transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(self.stdout),
+                                                            self._process.stdout)
+                self._transports.append(transport)
+            self._stderr = asyncio.ensure_future(_read_pipe(self._process.stderr))
+        self.record.pid = self._process.pid
+        logger.info(f"'{self.args[0]}' started with PID {self._process.pid}")
+        logger.debug(f"PID {self._process.pid}: {self.args}")
+        return self
+
+    async def wait(self) -> tuple[int, bytes]:
+        """
+        closes stdin if it's open, then waits for the command to exit
+        :return: return code and stderr
+        """
+        if self.stdin is not None and not self.stdin.is_closing():
+            self.stdin.close()
+        stderr = await self._stderr
+        if self.returncode is not None:
+            return self.returncode, stderr
+        if sys.platform == "win32":
+            try:
+                await self._process.wait()
+            finally:
+                stop_tracking(self._tracker)
+            rusage = None
+            self.returncode = self._process.returncode
+        else:
+            status, rusage = await _wait4(self._process.pid)
+            self.returncode = self._process.returncode = os.waitstatus_to_exitcode(status)
+            for transport in self._transports:
+                transport.close()
+        _finish(self.record, self._started, self._start_ns, self.returncode, rusage)
+        return self.returncode, stderr
 
-    # Wait for the subprocess to finish
-    stdout, stderr = await process.communicate()
+    async def kill(self):
+        """
+        kills the command if it's still running, and reaps it
+        """
+        if self._process is None or self.returncode is not None:
+            return
+        try:
+            self._process.kill()
+        except ProcessLookupError:
+            pass
+        await self.wait()
+
+
+def limit_output(args: tuple) -> tuple[tuple, int | None]:
+    """
+    keeps what an ffmpeg command writes to a temp file within the temp storage the job has left, with -fs
+    :return: the args, and the limit to pass to check_output_limit() once it's done, if there is one
+    """
+    # imported here since utils.tempfiles imports this module
+    from utils import tempfiles
+    if os.path.basename(args[0]) != "ffmpeg" or not isinstance(args[-1], tempfiles.TempFile):
+        return args, None
+    limit = tempfiles.output_limit()
+    if limit is None:
+        return args, None
+    if limit <= 0:
+        raise tempfiles.TempBudgetExceeded("This command ran out of temporary storage space.")
+    return (*args[:-1], "-fs", str(limit), args[-1]), limit
+
+
+def check_output_limit(output: str, limit: int | None):
+    """
+    ffmpeg stops writing at -fs without failing, so a cut off output has to be caught after
+    """
+    from utils import tempfiles
+    if limit is not None and os.path.isfile(output) and os.path.getsize(output) >= limit:
+        raise tempfiles.TempBudgetExceeded(f"This command needs more than {humanize.naturalsize(limit)} of temporary "
+                                           f"storage space. Try shorter or smaller media.")
+
+
+async def run_command(*args: str):
+    """
+    run a cli command
+
+    :param args: the args of the command, what would normally be seperated by a space
+    :return: the result of the command
+    """
+    args, limit = limit_output(args)
+    if any(isinstance(arg, PipeSource) or hasattr(arg, "pipe_source") for arg in args):
+        args = await _expand_pipes(args)
+    if isinstance(args, _Piped):
+        pid, returncode, stdout, stderr = await _run_piped(args)
+    else:
+        pid, returncode, stdout, stderr = await _run(args)
 
     try:
         result = stdout.decode().strip() + stderr.decode().strip()
@@ -44,22 +478,143 @@ async def run_command(*args: str):
     # no ffmpeg you cannot hide from me
     result = re.sub(r'\r(?!\n)', '\n', result)
     # Progress
-    if process.returncode == 0:
-        logger.debug(f"PID {process.pid} Done.")
+    if returncode == 0:
+        logger.debug(f"PID {pid} Done.")
         logger.debug(f"Results: {result}")
     else:
 
         logger.error(
-            f"PID {process.pid} Failed: {args} result: {result}",
+            f"PID {pid} Failed: {args} result: {result}",
         )
         # adds command output to traceback
-        raise CMDError(f"Command failed with exit code {process.returncode}: {args}.") from CMDError(result)
+        raise CMDError(f"Command failed with exit code {returncode}: {args}.") from CMDError(result)
+    check_output_limit(args[-1], limit)
     # Result
 
     # Return stdout
     return result
 
 
+async def pipe_command(*args: str, stdin: bytes) -> bytes:
+    """
+    run a cli command that reads its input from stdin and writes its output to stdout, without touching the disk
+
+    :param args: the args of the command, what would normally be seperated by a space
+    :param stdin: data to send to the command
+    :return: the raw stdout of the command
+    """
+    pid, returncode, stdout, stderr = await _run(args, stdin)
+    if returncode != 0:
+        result = stderr.decode("ascii", "ignore").strip()
+        logger.error(f"PID {pid} Failed: {args} result: {result}")
+        raise CMDError(f"Command failed with exit code {returncode}: {args}.") from CMDError(result)
+    return stdout
+
+
+class PipeSource:
+    """
+    an ffmpeg command that isn't run on its own. pass it to run_command() in place of an input file, and it runs
+    alongside that command with its output piped straight in, so the intermediate is never written anywhere and both
+    run at once.
+    if piping is off (or unsupported, ie on windows), it's written to a temp file first instead, like before.
+    """
+
+    def __init__(self, *args):
+        # the command without any output options, they're added depending on where it goes
+        self.args = args
+
+    def __repr__(self):
+        return f"PipeSource{self.args}"
+
+    def output_args(self) -> tuple[str, ...]:
+        return "-c:v", config.temp_vcodec, "-pix_fmt", config.temp_vpixfmt, "-c:a", config.temp_acodec
+
+    def pipe_args(self) -> tuple[str, ...]:
+        # rawvideo costs nothing to encode or decode, and nut can carry it and every audio codec
+        return "-c:v", "rawvideo", "-pix_fmt", config.temp_vpixfmt, "-c:a", config.temp_acodec, "-f", "nut"
+
+
+class _Piped(tuple):
+    """
+    args of a command whose inputs include pipes from other commands
+    """
+    # (args, write fd) of each command feeding this one, including commands feeding those
+    producers: list[tuple[tuple, int]]
+    # read ends of the pipes, passed to the command
+    fds: tuple[int, ...]
+
+
+def piping_enabled() -> bool:
+    return sys.platform != "win32" and (config.pipe_intermediates if hasattr(config, "pipe_intermediates") else True)
+
+
+async def _expand_pipes(args: tuple) -> tuple:
+    """
+    replaces PipeSources (and anything with a pipe_source() method, ie lazy Pipelines) in args with pipes from them.
+    if piping is off, they're written to temp files instead.
+    """
+    from utils.tempfiles import reserve_tempfile
+    producers = []
+    opened = []
+
+    async def expand(cmd: tuple) -> tuple[tuple, list[int]]:
+        out = []
+        fds = []
+        for arg in cmd:
+            if hasattr(arg, "pipe_source"):
+                arg = await arg.pipe_source()
+            if not isinstance(arg, PipeSource):
+                out.append(arg)
+                continue
+            if not piping_enabled():
+                file = reserve_tempfile("mkv")
+                await run_command(*arg.args, *arg.output_args(), file)
+                out.append(file)
+                continue
+            source_args, source_fds = await expand(arg.args)
+            read, write = os.pipe()
+            opened.extend((read, write))
+            producers.append(((*source_args, *arg.pipe_args(), f"pipe:{write}"), (write, *source_fds)))
+            if out and out[-1] == "-i":
+                # there's nothing to probe the format from until it's written
+                out[-1:] = ["-f", "nut", "-i"]
+            out.append(f"pipe:{read}")
+            fds.append(read)
+        return tuple(out), fds
+
+    try:
+        expanded, fds = await expand(args)
+    except BaseException:
+        for fd in opened:
+            os.close(fd)
+        raise
+    if not producers:
+        return expanded
+    piped = _Piped(expanded)
+    piped.producers = producers
+    piped.fds = tuple(fds)
+    return piped
+
+
+async def _run_piped(args: _Piped) -> tuple[int, int, bytes, bytes]:
+    """
+    runs a command and every command piping into it at once
+    :return: same as _run(), for the last command
+    """
+    who = caller()
+    results = await asyncio.gather(*[_run(cmd, pass_fds=fds, who=who) for cmd, fds in args.producers],
+                                   _run(tuple(args), pass_fds=args.fds, who=who))
+    *producers, consumer = results
+    if consumer[1] == 0:
+        for (cmd, _), (pid, returncode, _, stderr) in zip(args.producers, producers):
+            result = stderr.decode("ascii", "ignore").strip()
+            # it's fine if the consumer stopped reading early, ie with -shortest or -t
+            if returncode != 0 and "Broken pipe" not in result:
+                logger.error(f"PID {pid} Failed: {cmd} result: {result}")
+                raise CMDError(f"Command failed with exit code {returncode}: {cmd}.") from CMDError(result)
+    return consumer
+
+
 class CMDError(Exception):
     """raised by run_command"""
     pass
@@ -3,6 +3,7 @@ import random
 from PIL import Image, ImageDraw, ImageFont
 
 from config import temp_vipscodec
+from processing.common import uncacheable
 from utils.tempfiles import reserve_tempfile
 
 # the y coordinate for where the text and the face split
@@ -50,6 +51,7 @@ def get_text_dimensions(text_string, font):
 
 
 # get input string
+@uncacheable
 def sus(input_string: str):
     """
     Cuts and slices the popular Jerma sus meme to any message
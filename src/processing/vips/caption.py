@@ -4,6 +4,7 @@ import typing
 import pyvips
 
 from config import temp_vipscodec
+from processing.common import template
 from processing.vips.vipsutils import ImageSize, escape, outline, overlay_in_middle, vips_text
 from processing.vips.vipsutils import normalize
 from utils.tempfiles import reserve_tempfile
@@ -285,7 +286,7 @@ def generic_image_caption(image: str, captions: typing.Sequence[str], size: Imag
         wrap=pyvips.TextWrap.WORD_CHAR
     )
     # load stuff
-    im = normalize(pyvips.Image.new_from_file(image))
+    im = normalize(template(image))
 
     # resize
     im = im.resize((size.width / 3) / im.width)
@@ -3,6 +3,7 @@ import typing
 import pyvips
 
 from config import temp_vipscodec
+from processing.common import template
 from processing.vips.vipsutils import escape
 from processing.vips.vipsutils import normalize, vips_text
 from utils.tempfiles import reserve_tempfile
@@ -10,7 +11,7 @@ from utils.tempfiles import reserve_tempfile
 
 def yskysn(captions: typing.Sequence[str]):
     # load stuff
-    im = normalize(pyvips.Image.new_from_file("rendering/images/yskysn.png"))
+    im = normalize(template("rendering/images/yskysn.png"))
     # here for my sanity, dimensions of text area
     w = 500
     h = 582
@@ -68,9 +69,9 @@ def f1984(captions: typing.Sequence[str]):
     originaldate = captions[1].lower() == "january 1984"
 
     if originaldate:
-        im = normalize(pyvips.Image.new_from_file("rendering/images/1984/1984originaldate.png"))
+        im = normalize(template("rendering/images/1984/1984originaldate.png"))
     else:
-        im = normalize(pyvips.Image.new_from_file("rendering/images/1984/1984.png"))
+        im = normalize(template("rendering/images/1984/1984.png"))
 
     # generate text
     speech_bubble = vips_text(
@@ -106,7 +107,7 @@ def f1984(captions: typing.Sequence[str]):
         # add date
         im = im.composite2(date, pyvips.BlendMode.OVER, x=454, y=138)
         # add cover
-        im = im.composite2(normalize(pyvips.Image.new_from_file("rendering/images/1984/1984cover.png")),
+        im = im.composite2(normalize(template("rendering/images/1984/1984cover.png")),
                            pyvips.BlendMode.OVER)
 
     outfile = reserve_tempfile(temp_vipscodec)
@@ -0,0 +1,102 @@
+"""
+gif encoding with libvips' gifsave (cgif + libimagequant), used by processing.ffmpeg.conversion.videotogif when
+config.gif_engine is "vips".
+ffmpeg only decodes the frames, once, to a raw file that's memory mapped here. everything else happens in one worker:
+colour crushing is a LUT instead of a per pixel geq expression, palettes are shared between similar frames, pixels that
+didn't change since the last frame are made transparent, and if there's a target size it's hit by resizing the frames
+already in memory instead of decoding and encoding the whole thing again.
+"""
+import math
+import os
+
+import pyvips
+
+import config
+
+# interpalette_maxerror and interframe_maxerror are new in 8.15
+MIN_VERSION = (8, 15)
+# how many times to resize to hit a target size before giving up
+SIZE_ATTEMPTS = 5
+# aim this far under the target, gif size isn't quite proportional to pixel count
+SIZE_MARGIN = 0.95
+
+gif_effort = config.gif_effort if hasattr(config, "gif_effort") else 7
+gif_interframe_maxerror = config.gif_interframe_maxerror if hasattr(config, "gif_interframe_maxerror") else 8
+gif_interpalette_maxerror = config.gif_interpalette_maxerror if hasattr(config, "gif_interpalette_maxerror") else 3
+
+
+def available() -> bool:
+    return pyvips.at_least_libvips(*MIN_VERSION) and pyvips.type_find("VipsOperation", "gifsave") != 0
+
+
+def crush_lut() -> pyvips.Image:
+    """
+    "What happens is that the color values are rounded to the nearest value that has a remainder of 4 when divided
+    by 8." https://glq.pages.dev/posts/high_quality_gifs/
+    this is only in the image preview, the effect goes away when downloaded, but thats where most of these are viewed
+    from. same as lilliput's, but as a lookup table.
+    https://github.com/discord/lilliput/blob/e1547514bd5f32800c612e5564b18a60f046b1af/giflib.cpp#L848
+    """
+    return ((pyvips.Image.identity() & 248) | 4).cast(pyvips.BandFormat.UCHAR)
+
+
+def scale_frames(im: pyvips.Image, page_height: int, n_pages: int, scale: float) -> tuple[pyvips.Image, int]:
+    """
+    resizes each frame of a multi page image. it's one resize of the whole strip, scaled so every frame lands on a
+    whole number of rows, like libvips' thumbnail does with animations. the kernel reaches a few rows into the
+    neighbouring frames at the edges, which doesn't survive quantizing, and it's one operation instead of one per frame.
+    :return: resized image and its page height
+    """
+    w = max(1, round(im.width * scale))
+    h = max(1, round(page_height * scale))
+    resized = im.resize(w / im.width, vscale=h * n_pages / im.height, kernel=pyvips.Kernel.LANCZOS3)
+    if (resized.width, resized.height) != (w, h * n_pages):
+        # rounding can leave it a row off
+        resized = resized.embed(0, 0, w, h * n_pages, extend=pyvips.Extend.COPY)
+    return resized, h
+
+
+def encode(frames: str, width: int, height: int, fps: float, loop: int, out: str,
+           target_size: int | None = None) -> int:
+    """
+    encodes raw rgba frames as a gif
+    :param frames: file of raw rgba frames, one after another
+    :param width: width of a frame
+    :param height: height of a frame
+    :param fps: constant frame rate of the frames
+    :param loop: gif loop count, 0 is forever
+    :param out: gif to write
+    :param target_size: if set, the frames are shrunk until the gif is under this many bytes
+    :return: size of the gif in bytes, which is still over target_size if it couldn't be hit
+    """
+    n_pages = os.path.getsize(frames) // (width * height * 4)
+    if n_pages == 0:
+        raise ValueError(f"{frames} has no frames")
+    # memory mapped, not read in
+    im = pyvips.Image.rawload(frames, width, height * n_pages, 4).copy(interpretation=pyvips.Interpretation.SRGB)
+    # gif delays are in centiseconds, it's rounded to that when saved
+    delay = round(1000 / fps)
+    # making unchanged pixels transparent breaks frames that are partly transparent themselves
+    transparent = im[3].min() < 255
+    lut = crush_lut()
+
+    def save(image: pyvips.Image, page_height: int):
+        image = image[:3].maplut(lut).bandjoin(image[3]).copy(interpretation=pyvips.Interpretation.SRGB)
+        image.set_type(pyvips.GValue.gint_type, "page-height", page_height)
+        image.set_type(pyvips.GValue.array_int_type, "delay", [delay] * n_pages)
+        image.set_type(pyvips.GValue.gint_type, "loop", loop)
+        # discord destroys any dither that isn't bayer, which libimagequant doesn't do
+        image.gifsave(out, dither=0, effort=gif_effort,
+                      interframe_maxerror=0 if transparent else gif_interframe_maxerror,
+                      interpalette_maxerror=gif_interpalette_maxerror)
+        return os.path.getsize(out)
+
+    size = save(im, height)
+    scale = 1
+    for _ in range(SIZE_ATTEMPTS):
+        if target_size is None or size <= target_size:
+            break
+        # always from the full size frames, so quality isn't lost over attempts
+        scale *= math.sqrt(target_size / size) * SIZE_MARGIN
+        size = save(*scale_frames(im, height, n_pages, scale))
+    return size
@@ -5,7 +5,7 @@ import pyvips
 
 import processing.ffmpeg.ffprobe
 import processing.vips.vipsutils
-from processing.common import run_parallel, NonBugError
+from processing.common import run_parallel, NonBugError, frame_function, deterministic
 from config import temp_vipscodec
 from processing.ffmpeg.conversion import mediatopng
 from processing.vips.vipsutils import normalize
@@ -30,16 +30,15 @@ async def uncaption(file, frame_to_try: int, tolerance: float):
     return await processing.ffmpeg.ffutils.trim_top(file, cap_height)
 
 
-def jpeg(file: TempFile, strength: int, stretch: list[tuple[int, int]] | None, quality: int):
+def jpeg_image(im: pyvips.Image, strength: int, stretch: list[tuple[int, int]] | None, quality: int) -> pyvips.Image:
     """
     repeatedly jpeg compress an image, optionally resizing it each time to simulate reposting
-    :param file: input file
+    :param im: input image
     :param strength: how many times to compress
     :param stretch: a list of how much to stretch by each time, generated by processing.ffmpeg.other.handle_jpeg
     :param quality: the JPEG quality per compression
     """
     do_stretching = stretch is not None
-    im = normalize(pyvips.Image.new_from_file(file))
     orig_w = im.width
     orig_h = im.height
     for i in range(strength):
@@ -52,6 +51,16 @@ def jpeg(file: TempFile, strength: int, stretch: list[tuple[int, int]] | None, q
     if do_stretching:
         # resize back to original size
         im = processing.vips.vipsutils.resize(im, orig_w, orig_h)
+    return im
+
+
+@deterministic
+@frame_function(jpeg_image)
+def jpeg(file: TempFile, strength: int, stretch: list[tuple[int, int]] | None, quality: int):
+    """
+    file version of jpeg_image()
+    """
+    im = jpeg_image(normalize(pyvips.Image.new_from_file(file)), strength, stretch, quality)
     # save
     outfile = reserve_tempfile(temp_vipscodec)
     im.write_to_file(outfile)
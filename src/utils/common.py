@@ -2,22 +2,20 @@ import datetime
 import textwrap
 import typing
 
-import aiohttp
 import discord
 import requests
 from discord.ext import commands
 
 import config
 from core import database
+from utils.web import get_session
 
 
 async def fetch(url):
-    async with aiohttp.ClientSession(headers={'Connection': 'keep-alive'},
-                                     timeout=aiohttp.ClientTimeout(total=600)) as session:
-        async with session.get(url) as response:
-            if response.status != 200:
-                response.raise_for_status()
-            return await response.text()
+    async with get_session().get(url) as response:
+        if response.status != 200:
+            response.raise_for_status()
+        return await response.text()
 
 
 def get_full_class_name(obj):
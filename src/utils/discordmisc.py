@@ -8,7 +8,7 @@ from core.clogs import logger
 from processing.ffmpeg.conversion import mediatopng, toapng, allreencode
 from processing.ffmpeg.ensuresize import intelligentdownsize
 from processing.ffmpeg.ffprobe import is_apng
-from processing.mediatype import GIF, MediaType
+from processing.mediatype import GIF, IMAGE, MediaType
 
 
 async def count_emoji(guild: discord.Guild):
@@ -62,7 +62,13 @@ async def add_sticker(file, guild: discord.Guild, sticker_emoji, name):
     :param name: sticker name
     :return: result text
     """
-    file_f = await allreencode(file) if not await is_apng(file) else file
+    if await is_apng(file):
+        file_f = file
+    elif await file.mediatype() == IMAGE:
+        # allreencode() passes jpegs through, but stickers have to be png
+        file_f = await mediatopng(file)
+    else:
+        file_f = await allreencode(file)
     rfile = await intelligentdownsize(file_f, file, config.sticker_upload_limit)
     try:
         await guild.create_sticker(name=name, emoji=sticker_emoji, file=discord.File(rfile),
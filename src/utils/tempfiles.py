@@ -5,6 +5,7 @@ import random
 import shutil
 import string
 import tempfile
+import time
 import typing
 
 import aiofiles.os
@@ -12,6 +13,7 @@ import aiofiles.os
 import config
 from core.clogs import logger
 from processing.ffmpeg.glc import get_gif_loop_count
+from processing.ffmpeg.mediainfo import MediaInfo, probe
 from processing.mediatype import MediaType, mediatype
 
 
@@ -19,6 +21,7 @@ class TempFile(str):
     mt: MediaType = None
     lock_codec: bool = False
     glc: int = None
+    mi: MediaInfo = None
 
     async def mediatype(self):
         if self.mt is None:
@@ -27,15 +30,20 @@ class TempFile(str):
 
     async def gif_loop_count(self):
         if self.glc is None:
-            self.glc = await get_gif_loop_count(self)
+            self.glc = await get_gif_loop_count(self, await self.mediainfo())
         return self.glc
 
+    async def mediainfo(self):
+        if self.mi is None:
+            self.mi = await probe(self)
+        return self.mi
+
 
 def init():
-    global temp_dir
-    if os.path.isdir(temp_dir):
-        shutil.rmtree(temp_dir)
-    os.makedirs(temp_dir)
+    for directory in tiers():
+        if os.path.isdir(directory):
+            shutil.rmtree(directory)
+        os.makedirs(directory)
 
 
 if config.override_temp_dir is not None:
@@ -43,7 +51,121 @@ if config.override_temp_dir is not None:
 else:
     temp_dir = os.path.join(tempfile.gettempdir(), "mediaforge")
 
-logger.debug(f"temp dir is {temp_dir}")
+# temp_dir is meant to be fast (ie /dev/shm). big files go here instead, so they don't fill up memory
+spill_dir = config.spill_temp_dir if hasattr(config, "spill_temp_dir") else None
+# bytes temp_dir can hold before new files spill
+fast_budget = config.fast_temp_budget if hasattr(config, "fast_temp_budget") else 1_000_000_000
+# files expected to be bigger than this go straight to spill_dir
+small_file_size = config.small_temp_file_size if hasattr(config, "small_temp_file_size") else 50_000_000
+# bytes every TempFileSession together may use. None for no limit.
+global_budget = config.temp_budget if hasattr(config, "temp_budget") else None
+# bytes one TempFileSession may use. None for no limit.
+session_quota = config.temp_session_quota if hasattr(config, "temp_session_quota") else None
+# seconds a session waits for room in global_budget before giving up
+budget_timeout = config.temp_budget_timeout if hasattr(config, "temp_budget_timeout") else 60
+# files older than this that no session owns are deleted by sweep(), in seconds
+max_age = config.temp_max_age if hasattr(config, "temp_max_age") else 60 * 60
+
+# dir_usage() scans every file, don't do it more than this often for the same directory, in seconds
+USAGE_CACHE_TIME = 1
+
+logger.debug(f"temp dir is {temp_dir}" + (f", spilling to {spill_dir}" if spill_dir else ""))
+
+
+class TempBudgetExceeded(Exception):
+    """raised when a command needs more temp space than it's allowed. shown to the user without a traceback, like
+    NonBugError."""
+    pass
+
+
+def tiers() -> list[str]:
+    return [temp_dir, spill_dir] if spill_dir else [temp_dir]
+
+
+def dir_usage(path: str) -> tuple[int, int]:
+    """
+    :return: total bytes and number of files under path
+    """
+    size = 0
+    count = 0
+    for root, _, files in os.walk(path):
+        for file in files:
+            try:
+                size += os.path.getsize(os.path.join(root, file))
+                count += 1
+            except OSError:
+                # deleted while walking
+                pass
+    return size, count
+
+
+_usage_cache: dict[str, tuple[float, int]] = {}
+
+
+def cached_usage(path: str) -> int:
+    """
+    :return: bytes under path, as of at most USAGE_CACHE_TIME ago
+    """
+    checked, size = _usage_cache.get(path, (0, 0))
+    if time.monotonic() - checked > USAGE_CACHE_TIME:
+        size = dir_usage(path)[0]
+        _usage_cache[path] = (time.monotonic(), size)
+    return size
+
+
+def total_usage() -> int:
+    return sum(cached_usage(d) for d in tiers())
+
+
+def pick_dir(size_hint: int | None = None) -> str:
+    """
+    :param size_hint: how big the file is expected to get, if known
+    :return: which tier a new file should go in
+    """
+    if spill_dir is None:
+        return temp_dir
+    if size_hint is not None and size_hint > small_file_size:
+        return spill_dir
+    if cached_usage(temp_dir) >= fast_budget:
+        return spill_dir
+    return temp_dir
+
+
+def parse_size(size: str | int) -> int:
+    """
+    :param size: bytes, or a string like ffmpeg's, ie "1G" or "500M"
+    """
+    if isinstance(size, int):
+        return size
+    units = {"K": 1000, "M": 1000 ** 2, "G": 1000 ** 3, "T": 1000 ** 4}
+    if size and size[-1].upper() in units:
+        return int(float(size[:-1]) * units[size[-1].upper()])
+    return int(size)
+
+
+def session_usage(files: list) -> int:
+    size = 0
+    for file in files:
+        try:
+            size += os.path.getsize(file)
+        except OSError:
+            pass
+    return size
+
+
+def output_limit() -> int | None:
+    """
+    :return: how many bytes the next file written in this session may take up, None for no limit
+    """
+    limits = []
+    if config.max_temp_file_size:
+        limits.append(parse_size(config.max_temp_file_size))
+    files = session.get(None)
+    if session_quota is not None and files is not None:
+        limits.append(session_quota - session_usage(files))
+    elif global_budget is not None:
+        limits.append(global_budget - total_usage())
+    return max(0, min(limits)) if limits else None
 
 
 def get_random_string(length):
@@ -54,20 +176,21 @@ def is_named_used(name):
     return os.path.exists(name)
 
 
-def temp_file_name(extension=None):
+def temp_file_name(extension=None, size_hint: int | None = None):
+    directory = pick_dir(size_hint)
     while True:
-        name = os.path.join(temp_dir, get_random_string(8))
+        name = os.path.join(directory, get_random_string(8))
         if extension:
             name += f".{extension}"
         if not is_named_used(name):
             return name
 
 
-def reserve_tempfile(arg):
+def reserve_tempfile(arg, size_hint: int | None = None):
     if arg is None:  # default
-        arg = temp_file_name()
+        arg = temp_file_name(size_hint=size_hint)
     elif "." not in arg:  # just extension
-        arg = temp_file_name(arg)
+        arg = temp_file_name(arg, size_hint)
     # full filename otherwise
 
     tfs = session.get()
@@ -77,6 +200,48 @@ def reserve_tempfile(arg):
     return TempFile(arg)
 
 
+# bytes of global_budget held by open sessions
+reserved = 0
+_budget_changed: asyncio.Condition | None = None
+# the files of every open session, so sweep() leaves them alone
+live_sessions: list[list[str]] = []
+
+
+def has_room() -> bool:
+    if session_quota is not None:
+        # every session may grow to its quota, so only start one if all of them can
+        return reserved + session_quota <= global_budget
+    return total_usage() < global_budget
+
+
+async def acquire_budget():
+    """
+    waits until there's room in global_budget for another session
+    """
+    global reserved, _budget_changed
+    if global_budget is None:
+        return
+    if _budget_changed is None:
+        _budget_changed = asyncio.Condition()
+    async with _budget_changed:
+        if not has_room():
+            logger.info("Temp storage is full, waiting for room")
+            try:
+                await asyncio.wait_for(_budget_changed.wait_for(has_room), budget_timeout)
+            except asyncio.TimeoutError:
+                raise TempBudgetExceeded("MediaForge is out of temporary storage right now. Try again in a bit.")
+        reserved += session_quota or 0
+
+
+async def release_budget():
+    global reserved
+    if global_budget is None:
+        return
+    async with _budget_changed:
+        reserved -= session_quota or 0
+        _budget_changed.notify_all()
+
+
 class TempFileSession:
     def __init__(self):
         pass
@@ -88,7 +253,9 @@ class TempFileSession:
         except LookupError:
             pass
         logger.debug("Created new TempFileSession")
-        session.set([])
+        files = []
+        session.set(files)
+        live_sessions.append(files)
 
     async def __aexit__(self, *_):
         files = session.get()
@@ -97,9 +264,47 @@ class TempFileSession:
         for f in fls:
             if isinstance(f, Exception):
                 logger.warn(f)
+        live_sessions.remove(files)
+        _usage_cache.clear()
         logger.debug(f"TempFileSession exited!")
 
 
+class TempBudget:
+    """
+    holds a share of global_budget while a job runs. entered when the job starts, not when its session opens, so
+    commands waiting in the queue don't keep running ones from starting.
+    """
+
+    async def __aenter__(self):
+        await acquire_budget()
+
+    async def __aexit__(self, *_):
+        await release_budget()
+
+
+def sweep() -> int:
+    """
+    deletes files older than max_age that no open session owns, ie left behind by a crash
+    :return: number of files deleted
+    """
+    owned = {os.path.abspath(f) for files in live_sessions for f in files}
+    cutoff = time.time() - max_age
+    removed = 0
+    for directory in tiers():
+        for root, _, names in os.walk(directory):
+            for name in names:
+                path = os.path.abspath(os.path.join(root, name))
+                try:
+                    if path not in owned and os.path.getmtime(path) < cutoff:
+                        os.remove(path)
+                        removed += 1
+                except OSError:
+                    pass
+    if removed:
+        logger.info(f"Swept {removed} orphaned temp files")
+    return removed
+
+
 session: contextvars.ContextVar[list[TempFile]] = contextvars.ContextVar("session")
 
 
@@ -1,3 +1,9 @@
+import asyncio
+import mimetypes
+import os
+import time
+from urllib.parse import urlparse
+
 import aiofiles
 import aiohttp
 import humanize
@@ -5,79 +11,126 @@ import humanize
 import config
 import processing.common
 import processing.ffmpeg.conversion
+from core import metrics
 from core.clogs import logger
 from processing.mediatype import GIF
 from utils.tempfiles import reserve_tempfile, GifvUrl
-from urllib.parse import urlparse
-import mimetypes
+
+# size of each chunk written to disk while downloading
+CHUNK_SIZE = 64 * 1024
+
+_session: aiohttp.ClientSession | None = None
+
+
+def get_session() -> aiohttp.ClientSession:
+    """
+    one long-lived session shared by every request the bot makes, so connections are pooled and reused instead of
+    doing a new TCP + TLS handshake for every file.
+    created on first use because it has to be made inside the running event loop.
+    """
+    global _session
+    if _session is None or _session.closed:
+        # https://github.com/aio-libs/aiohttp/issues/3904#issuecomment-632661245
+        _session = aiohttp.ClientSession(headers={'Connection': 'keep-alive'},
+                                         timeout=aiohttp.ClientTimeout(total=600))
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def toobig(size: int):
+    return processing.common.NonBugError(f"Your file is too big ({humanize.naturalsize(size)}). "
+                                         f"I'm configured to only download files up to "
+                                         f"{humanize.naturalsize(config.max_file_size)}.")
 
 
 async def saveurl(url: str) -> str:
     """
-    save a url
+    save a url. the body is streamed to disk in chunks, so it's never all held in memory.
 
     :param url: web url of a file
     :return: path to file
     """
+    started = time.perf_counter()
+    try:
+        name = await _saveurl(url)
+    except Exception:
+        metrics.download_errors.inc()
+        raise
+    metrics.download_time.observe(time.perf_counter() - started)
+    metrics.download_bytes.observe(os.path.getsize(name))
+    return name
+
+
+async def _saveurl(url: str) -> str:
     gifv = isinstance(url, GifvUrl)
 
-    # https://github.com/aio-libs/aiohttp/issues/3904#issuecomment-632661245
-    async with aiohttp.ClientSession(headers={'Connection': 'keep-alive'},
-                                     timeout=aiohttp.ClientTimeout(total=600)) as session:
-        # i used to make a head request to check size first, but for some reason head requests can be super slow
-        async with session.get(url) as resp:
-            if resp.status == 200:
-                if "Content-Length" not in resp.headers:  # size of file to download
-                    raise Exception("Cannot determine filesize!")
-                size = int(resp.headers["Content-Length"])
-                logger.info(f"Url is {humanize.naturalsize(size)}")
-                if config.max_file_size < size:  # file size to download must be under max configured size.
-                    raise processing.common.NonBugError(f"Your file is too big ({humanize.naturalsize(size)}). "
-                                                        f"I'm configured to only download files up to "
-                                                        f"{humanize.naturalsize(config.max_file_size)}.")
-                logger.info(f"Saving url {url}")
-                # more intelligently get file extension (not that ffmpeg cares much anyways)
-                if "Content-Type" in resp.headers and resp.headers["Content-Type"] \
-                        and (guess_ext := mimetypes.guess_extension(resp.headers["Content-Type"])):
-                    extension = guess_ext[1:]  # remove dot
-                else:
-                    path = urlparse(url).path
-                    if "." in path:
-                        extension = path.split(".")[-1]
-                    else:
-                        extension = None
-                name = reserve_tempfile(extension)
-                if gifv:
-                    name.mt = GIF
-                async with aiofiles.open(name, mode='wb') as f:
-                    await f.write(await resp.read())
+    # i used to make a head request to check size first, but for some reason head requests can be super slow
+    async with get_session().get(url) as resp:
+        if resp.status == 200:
+            # size of file to download, if the server tells us. checked again while streaming in case it lies or
+            # doesn't say
+            if resp.content_length is not None:
+                logger.info(f"Url is {humanize.naturalsize(resp.content_length)}")
+                if config.max_file_size < resp.content_length:
+                    raise toobig(resp.content_length)
+            logger.info(f"Saving url {url}")
+            # more intelligently get file extension (not that ffmpeg cares much anyways)
+            if "Content-Type" in resp.headers and resp.headers["Content-Type"] \
+                    and (guess_ext := mimetypes.guess_extension(resp.headers["Content-Type"])):
+                extension = guess_ext[1:]  # remove dot
             else:
-                logger.error(f"aiohttp status {resp.status}")
-                logger.error(f"aiohttp status {await resp.read()}")
-                resp.raise_for_status()
+                path = urlparse(url).path
+                if "." in path:
+                    extension = path.split(".")[-1]
+                else:
+                    extension = None
+            # big downloads go straight to disk
+            name = reserve_tempfile(extension, resp.content_length)
+            if gifv:
+                name.mt = GIF
+            size = 0
+            async with aiofiles.open(name, mode='wb') as f:
+                async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+                    size += len(chunk)
+                    if config.max_file_size < size:
+                        raise toobig(size)
+                    await f.write(chunk)
+        else:
+            logger.error(f"aiohttp status {resp.status}")
+            logger.error(f"aiohttp status {await resp.read()}")
+            resp.raise_for_status()
     return name
 
 
 async def saveurls(urls: list):
     """
-    saves list of URLs and returns it
+    saves list of URLs concurrently and returns it
     :param urls: list of urls
-    :return: list of files
+    :return: list of files, in the same order as urls
     """
     if not urls:
         return False
-    files = []
-    for url in urls:
-        files.append(await saveurl(url))
-    return files
+    downloads = [asyncio.create_task(saveurl(url)) for url in urls]
+    try:
+        return list(await asyncio.gather(*downloads))
+    finally:
+        # if one fails, stop the rest and wait for them to stop, so nothing writes into the session once it's cleaned up
+        for download in downloads:
+            download.cancel()
+        await asyncio.gather(*downloads, return_exceptions=True)
 
 
 async def contentlength(url):
-    async with aiohttp.ClientSession(headers={'Connection': 'keep-alive'}) as session:
-        # i used to make a head request to check size first, but for some reason head requests can be super slow
-        async with session.get(url) as resp:
-            if resp.status == 200:
-                if "Content-Length" not in resp.headers:  # size of file to download
-                    return False
-                else:
-                    return int(resp.headers["Content-Length"])
+    # i used to make a head request to check size first, but for some reason head requests can be super slow
+    async with get_session().get(url) as resp:
+        if resp.status == 200:
+            if "Content-Length" not in resp.headers:  # size of file to download
+                return False
+            else:
+                return int(resp.headers["Content-Length"])
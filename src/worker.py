@@ -0,0 +1,161 @@
+"""
+a MediaForge processing worker. the bot sends it jobs (see core.remote) and it runs them and streams back the result,
+so processing can be spread over more processes or hosts than the one running the bot.
+jobs are sent as pickles, so remote_worker_token has to be set in the config and is required on every request. the only
+exception is a worker listening on a unix socket, which is then only accessible to the user running it.
+
+usage: python src/worker.py [--host 127.0.0.1] [--port 8101] [--unix /path/to/socket] [--slots N]
+several workers can run on one host, ie with --port 8101 and --port 8102 and
+remote_workers = ["http://127.0.0.1:8101", "http://127.0.0.1:8102"] in the bot's config.
+"""
+import argparse
+import hmac
+import os
+import pickle
+import sys
+import tempfile
+
+sys.path.insert(0, os.getcwd())
+
+try:
+    import aiofiles
+    from aiohttp import web
+except ModuleNotFoundError as e:
+    sys.exit(f"MediaForge worker was unable to import the required libraries: {e}")
+
+import config
+import core.jobs
+import core.remote
+import processing.common
+import processing.run_command
+from core.clogs import logger
+from utils import tempfiles
+from utils.web import CHUNK_SIZE
+
+slots = 1
+running = 0
+
+
+def authorized(request: web.Request) -> bool:
+    if not core.remote.token:
+        # only allowed on a private unix socket, see main()
+        return True
+    return hmac.compare_digest(request.headers.get("Authorization", "").encode(),
+                               f"Bearer {core.remote.token}".encode())
+
+
+async def status(request: web.Request):
+    if not authorized(request):
+        raise web.HTTPUnauthorized()
+    return web.json_response({"slots": slots, "running": running})
+
+
+async def receive(request: web.Request) -> core.jobs.Job:
+    reader = await request.multipart()
+    part = await reader.next()
+    if part is None or part.name != "job":
+        raise web.HTTPBadRequest(text="job must be the first part")
+    spec: core.jobs.Job = pickle.loads(await part.read())
+    files = []
+    for wire in spec.files:
+        part = await reader.next()
+        if part is None:
+            raise web.HTTPBadRequest(text="missing input file")
+        file = tempfiles.reserve_tempfile(wire.ext or None)
+        async with aiofiles.open(file, "wb") as f:
+            while chunk := await part.read_chunk(CHUNK_SIZE):
+                await f.write(chunk)
+        files.append(file)
+    return core.remote.decode(spec, files)
+
+
+async def send_file(request: web.Request, result: tempfiles.TempFile, headers: dict) -> web.StreamResponse:
+    headers |= {"X-Result": "file", "X-Ext": os.path.splitext(result)[1][1:],
+                "X-Lock-Codec": str(int(result.lock_codec))}
+    if result.mt is not None:
+        headers["X-Media-Type"] = str(result.mt)
+    if result.glc is not None:
+        headers["X-Gif-Loop-Count"] = str(result.glc)
+    resp = web.StreamResponse(headers=headers)
+    resp.content_length = os.path.getsize(result)
+    await resp.prepare(request)
+    async with aiofiles.open(result, "rb") as f:
+        while chunk := await f.read(CHUNK_SIZE):
+            await resp.write(chunk)
+    await resp.write_eof()
+    return resp
+
+
+async def job(request: web.Request):
+    global running
+    if not authorized(request):
+        raise web.HTTPUnauthorized()
+    if running >= slots:
+        # the bot will run it itself
+        raise web.HTTPServiceUnavailable()
+    running += 1
+    try:
+        # the files have to stay around until the result is sent, so this covers the whole response
+        async with tempfiles.TempFileSession():
+            received = await receive(request)
+            logger.info(f"Running {received.func} for {request.remote}")
+            usage = processing.run_command.Usage()
+            token = processing.run_command.job_usage.set(usage)
+            try:
+                result = await core.jobs.execute(received)
+            except Exception as e:
+                logger.error(e, exc_info=(type(e), e, e.__traceback__))
+                return web.json_response(core.remote.dump_exception(e), status=500)
+            finally:
+                processing.run_command.job_usage.reset(token)
+            headers = {"X-Cpu-Seconds": str(usage.cpu_seconds), "X-Peak-Memory": str(usage.peak_memory)}
+            if received.expectimage and result:
+                return await send_file(request, result, headers)
+            return web.json_response({"result": result}, headers=headers | {"X-Result": "value"})
+    finally:
+        running -= 1
+
+
+async def on_cleanup(_):
+    processing.common.shutdown_pool()
+
+
+def main():
+    global slots
+    parser = argparse.ArgumentParser(description="MediaForge processing worker")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8101)
+    parser.add_argument("--unix", help="listen on this unix socket instead of tcp")
+    parser.add_argument("--slots", type=int, help="jobs to run at once. defaults to config.workers or the core count")
+    parser.add_argument("--temp-dir", help="defaults to a directory per worker, so it can share a host with the bot")
+    args = parser.parse_args()
+    if not core.remote.token:
+        if not args.unix:
+            sys.exit("Refusing to start a worker on tcp without remote_worker_token set in the config, anyone who can "
+                     "reach it could run code as this user.")
+        # the socket (and everything else this makes) is only accessible to this user
+        os.umask(0o077)
+        logger.warning("remote_worker_token isn't set, the socket is only accessible to this user.")
+
+    slots = args.slots or (config.workers if config.workers and config.workers > 0 else None) or os.cpu_count() or 1
+    # tempfiles.init() empties the temp dir, so never use the bot's
+    worker_name = f"mediaforge-worker-{os.path.basename(args.unix or '')}{args.port if not args.unix else ''}"
+    tempfiles.temp_dir = args.temp_dir or os.path.join(tempfile.gettempdir(), worker_name)
+    if tempfiles.spill_dir:
+        # next to the bot's, not inside it, since the bot empties its own on startup
+        spill_parent = os.path.dirname(os.path.normpath(tempfiles.spill_dir))
+        tempfiles.spill_dir = os.path.join(spill_parent, f"{worker_name}-spill")
+    tempfiles.init()
+
+    app = web.Application()
+    app.add_routes([web.get("/status", status), web.post("/job", job)])
+    app.on_cleanup.append(on_cleanup)
+    logger.log(25, f"Worker starting with {slots} slots on {args.unix or f'{args.host}:{args.port}'}")
+    if args.unix:
+        web.run_app(app, path=args.unix)
+    else:
+        web.run_app(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
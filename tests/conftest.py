@@ -0,0 +1,25 @@
+"""
+tests run from the repo root, the same as the bot and benchmarks/run.py
+"""
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+if importlib.util.find_spec("config") is None:
+    # no config.py set up, the example's defaults are fine
+    spec = importlib.util.spec_from_file_location("config", os.path.join(ROOT, "config.example.py"))
+    config = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(config)
+    sys.modules["config"] = config
+
+
+@pytest.fixture(autouse=True)
+def repo_root(monkeypatch):
+    # assets like rendering/ are found relative to it
+    monkeypatch.chdir(ROOT)
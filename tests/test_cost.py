@@ -0,0 +1,17 @@
+import asyncio
+
+from processing import cost
+from processing.ffmpeg.mediainfo import MediaInfo
+from processing.mediatype import VIDEO
+from utils.tempfiles import TempFile
+
+
+def test_features_without_duration(tmp_path):
+    # no duration in the format and not an apng, so MediaInfo.duration raises
+    file = TempFile(str(tmp_path / "broken.mp4"))
+    file.mt = VIDEO
+    file.mi = MediaInfo(file, [{"codec_type": "video", "codec_name": "h264", "width": 1000, "height": 1000,
+                                "r_frame_rate": "30/1"}], {})
+    feats = asyncio.run(cost.features([file]))
+    assert feats.megapixels == 1
+    assert feats.megapixel_frames == 1
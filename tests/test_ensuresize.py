@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+try:
+    import pyvips  # noqa: F401
+except (ImportError, OSError):
+    # pyvips is installed but libvips isn't
+    pytest.skip("needs libvips", allow_module_level=True)
+
+from processing.ffmpeg import ensuresize  # noqa: E402
+from utils import tempfiles  # noqa: E402
+
+DURATION = 10
+MAXSIZE = 1_000_000
+AUDIO = 128000
+
+
+@pytest.fixture
+def fake_encoder(monkeypatch, tmp_path):
+    """
+    replaces ffmpeg with something that writes outputs exactly the size of their bitrate
+    :return: the -b:v of every second pass, in order
+    """
+    monkeypatch.setattr(tempfiles, "temp_dir", str(tmp_path))
+    monkeypatch.setattr(tempfiles, "spill_dir", None)
+    second_passes = []
+
+    async def run_command(*args):
+        if "-pass" in args and args[args.index("-pass") + 1] == "2":
+            bitrate = int(args[args.index("-b:v") + 1])
+            second_passes.append(bitrate)
+            with open(args[-1], "wb") as f:
+                f.write(b"\0" * int((bitrate + AUDIO) * DURATION / 8))
+        return ""
+
+    async def get_duration(_):
+        return DURATION
+
+    async def hasaudio(_):
+        return True
+
+    monkeypatch.setattr(ensuresize, "run_command", run_command)
+    monkeypatch.setattr(ensuresize, "get_duration", get_duration)
+    monkeypatch.setattr(ensuresize, "hasaudio", hasaudio)
+    return second_passes
+
+
+@pytest.mark.parametrize("slots", [1, 3])
+def test_twopass_first_candidate(fake_encoder, monkeypatch, tmp_path, slots):
+    monkeypatch.setattr(ensuresize, "idle_encode_slots", lambda: slots)
+    video = tmp_path / "in.mp4"
+    video.write_bytes(b"\0" * MAXSIZE * 2)
+
+    async def run():
+        tempfiles.session.set([])
+        return await ensuresize.twopasscapvideo(tempfiles.TempFile(str(video)), MAXSIZE, AUDIO)
+
+    out = asyncio.run(run())
+    total = MAXSIZE * 8 / DURATION
+    assert fake_encoder[0] == int(ensuresize.TOLERANCES[0] * (total - AUDIO))
+    assert fake_encoder[:slots] == [int(t * (total - AUDIO)) for t in ensuresize.TOLERANCES[:slots]]
+    assert (tmp_path / out).stat().st_size < MAXSIZE
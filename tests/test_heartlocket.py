@@ -0,0 +1,43 @@
+import asyncio
+import os
+import shutil
+import subprocess
+
+import pytest
+
+try:
+    import pyvips  # noqa: F401
+except (ImportError, OSError):
+    # pyvips is installed but libvips isn't
+    pytest.skip("needs libvips", allow_module_level=True)
+
+from processing.ffmpeg import heartlocket  # noqa: E402
+
+# not every asset is in the repo
+AVAILABLE = [(name, asset, filters) for name, (asset, filters) in heartlocket.heart_locket_map_filters().items()
+             if os.path.isfile(os.path.join(heartlocket.ASSETS, asset))]
+
+
+@pytest.mark.skipif(shutil.which("ffmpeg") is None, reason="needs ffmpeg")
+@pytest.mark.parametrize("name,asset,filters", AVAILABLE, ids=[name for name, _, _ in AVAILABLE])
+def test_map_filters(tmp_path, name, asset, filters):
+    out = tmp_path / f"{name}.mkv"
+    result = subprocess.run(["ffmpeg", "-y", "-hide_banner", "-i", os.path.join(heartlocket.ASSETS, asset),
+                             "-vf", filters, "-c:v", "ffv1", "-an", "-frames:v", "1", str(out)],
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+    assert out.stat().st_size > 0
+
+
+def test_failed_map_leaves_no_partial(tmp_path, monkeypatch):
+    async def run_command(*args):
+        # ffmpeg gets partway through the output, then dies
+        with open(args[-1], "wb") as f:
+            f.write(b"half a map")
+        raise RuntimeError("ffmpeg failed")
+
+    monkeypatch.setattr(heartlocket, "MAPS", str(tmp_path))
+    monkeypatch.setattr(heartlocket, "run_command", run_command)
+    with pytest.raises(RuntimeError):
+        asyncio.run(heartlocket.heart_locket_maps())
+    assert os.listdir(tmp_path) == []
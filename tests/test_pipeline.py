@@ -0,0 +1,60 @@
+import asyncio
+
+import pytest
+
+try:
+    import pyvips  # noqa: F401
+except (ImportError, OSError):
+    # pyvips is installed but libvips isn't
+    pytest.skip("needs libvips", allow_module_level=True)
+
+from processing.common import NonBugError  # noqa: E402
+from processing.ffmpeg import ffutils  # noqa: E402
+from processing.ffmpeg.mediainfo import MediaInfo  # noqa: E402
+from processing.ffmpeg.pipeline import Pipeline  # noqa: E402
+from processing.mediatype import AUDIO, VIDEO  # noqa: E402
+from utils.tempfiles import TempFile  # noqa: E402
+
+
+def probed(name: str, mt, streams: list[dict], duration: float) -> TempFile:
+    """
+    a file that's already been "probed", so nothing runs ffprobe
+    """
+    file = TempFile(name)
+    file.mt = mt
+    file.mi = MediaInfo(name, streams, {"duration": str(duration)})
+    return file
+
+
+AUDIO_STREAM = {"codec_type": "audio", "codec_name": "mp3", "sample_rate": "44100"}
+VIDEO_STREAM = {"codec_type": "video", "codec_name": "h264", "width": 640, "height": 360, "r_frame_rate": "30/1"}
+
+
+def test_trim_audio_only():
+    async def run():
+        pipeline = await ffutils.trim(Pipeline(probed("song.mp3", AUDIO, [AUDIO_STREAM], 10)), 3, 1)
+        assert not pipeline.vfilters
+        assert pipeline.afilters
+        assert await pipeline.duration() == 3
+        command = await pipeline._command()
+        assert "[0:a]atrim=start=1:duration=3,asetpts=PTS-STARTPTS[a]" in command
+
+    asyncio.run(run())
+
+
+def test_trim_video():
+    async def run():
+        pipeline = await ffutils.trim(Pipeline(probed("clip.mp4", VIDEO, [VIDEO_STREAM, AUDIO_STREAM], 10)), 3)
+        assert pipeline.vfilters and pipeline.afilters
+        await pipeline._command()
+
+    asyncio.run(run())
+
+
+def test_video_filter_on_audio_refused():
+    async def run():
+        pipeline = Pipeline(probed("song.mp3", AUDIO, [AUDIO_STREAM], 10)).video("hflip")
+        with pytest.raises(NonBugError):
+            await pipeline._command()
+
+    asyncio.run(run())
@@ -0,0 +1,33 @@
+import asyncio
+
+import pytest
+
+try:
+    import pyvips  # noqa: F401
+except (ImportError, OSError):
+    # pyvips is installed but libvips isn't
+    pytest.skip("needs libvips", allow_module_level=True)
+
+from utils import web  # noqa: E402
+
+
+def test_saveurls_stops_other_downloads(monkeypatch):
+    stopped = []
+
+    async def saveurl(url):
+        if url == "bad":
+            raise ValueError("download failed")
+        try:
+            await asyncio.sleep(10)
+        finally:
+            stopped.append(url)
+
+    monkeypatch.setattr(web, "saveurl", saveurl)
+
+    async def run():
+        with pytest.raises(ValueError):
+            await asyncio.wait_for(web.saveurls(["slow", "bad", "slower"]), 5)
+        # already stopped by the time saveurls() raised, not just asked to
+        assert sorted(stopped) == ["slow", "slower"]
+
+    asyncio.run(run())